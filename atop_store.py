@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# Converts the atop_raw.log files of a log pack (logtype atop_blades of collect.py/collect-fuse.py) into
+# NumPy arrays, one .npz per blade in <log pack>/atop-store/, so the load of every blade can be queried
+# at once instead of replaying the raw files with atop one by one.
+#
+# The raw files are replayed with the local atop in parseable mode (atop -r <file> -P ...), so it has to be
+# installed. Every interval (sample) of a blade is one row:
+#  - cpu_busy, cpu_wait: % of all CPUs
+#  - mem_total, mem_free, mem_cache, mem_buffers, mem_slab: bytes
+#  - disk_read, disk_write: bytes/s (all disks), disk_busy: % of the busiest disk
+#  - net_rx, net_tx: bytes/s (all interfaces except lo)
+# and the top processes (by CPU and by RSS) of every interval are rows of the proc_* columns
+# (time, pid, name, cpu %, rss bytes), the names are stored once in 'names' and referred by index.
+# Every time is in UTC (epoch seconds), like the timestamps in the logs of the blades.
+#
+# usage:
+#   atop_store.py ingest <log pack>      (collect.py and collect-fuse.py run it when atop_blades are collected)
+#   atop_store.py max-cpu <log pack> --since '2024-01-30 17:05' --until '2024-01-30 17:10'
+#   atop_store.py rss-growth <log pack> --process nfsd --min-growth 20
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+
+import collect_utils
+
+STORE_DIRNAME = 'atop-store'
+ATOP_RAW_RE = re.compile(r'^atop_raw\.log(\..*)?$')
+ATOP_LABELS = 'CPU,MEM,DSK,NET,PRC,PRM'
+# number of processes kept from every interval, by CPU and by RSS (a process can be in both)
+TOP_PROCESSES = 10
+
+SAMPLE_COLUMNS = {
+    'time': np.int64, 'interval': np.int32,
+    'cpu_busy': np.float32, 'cpu_wait': np.float32,
+    'mem_total': np.int64, 'mem_free': np.int64, 'mem_cache': np.int64, 'mem_buffers': np.int64, 'mem_slab': np.int64,
+    'disk_read': np.float32, 'disk_write': np.float32, 'disk_busy': np.float32,
+    'net_rx': np.float32, 'net_tx': np.float32,
+}
+PROC_COLUMNS = {'proc_time': np.int64, 'proc_pid': np.int32, 'proc_name': np.int32, 'proc_cpu': np.float32, 'proc_rss': np.int64}
+
+# the header of every line: label, host, epoch, date, time, interval; PRC and PRM lines go on with: pid, (name), state
+LINE_RE = re.compile(r'^(\S+) \S+ (\d+) \S+ \S+ (\d+) (.*)$')
+PROC_RE = re.compile(r'^(\d+) \((.*)\) (\S) (.*)$')
+
+# yields the lines of atop -P of a raw file, .zst files are decompressed into a temporary file first
+def atop_lines(filepath: str):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if filepath.endswith('.zst'):
+            decompressed = os.path.join(tmpdir, 'atop_raw.log')
+            subprocess.run(['zstd', '-d', '-q', filepath, '-o', decompressed], check=True)
+            filepath = decompressed
+        env = dict(os.environ, TZ='UTC')
+        with subprocess.Popen(['atop', '-r', filepath, '-P', ATOP_LABELS], stdout=subprocess.PIPE, text=True, errors='replace', env=env) as atop:
+            yield from atop.stdout
+        if atop.returncode:
+            raise Exception(f'atop -r {filepath} failed with exit status {atop.returncode}')
+
+# One sample (interval) of a blade, built from the lines of atop -P between two SEP lines
+class Sample:
+    def __init__(self, time: int, interval: int):
+        self.row = dict.fromkeys(SAMPLE_COLUMNS, 0)
+        self.row['time'] = time
+        self.row['interval'] = interval
+        # pid: [name, cpu %, rss bytes]
+        self.procs = collections.defaultdict(lambda: [None, 0.0, 0])
+
+    def add(self, label: str, fields: str):
+        row = self.row
+        interval = max(row['interval'], 1)
+        if label == 'CPU':
+            hz, cpus, system, user, nice, idle, wait, irq, softirq, steal = map(int, fields.split()[:10])
+            ticks = system + user + nice + idle + wait + irq + softirq + steal
+            if ticks:
+                row['cpu_busy'] = (ticks - idle - wait) / ticks * 100
+                row['cpu_wait'] = wait / ticks * 100
+        elif label == 'MEM':
+            pagesize, total, free, cache, buffers, slab = map(int, fields.split()[:6])
+            row.update(mem_total=total * pagesize, mem_free=free * pagesize, mem_cache=cache * pagesize,
+                       mem_buffers=buffers * pagesize, mem_slab=slab * pagesize)
+        elif label == 'DSK':
+            name, io_ms, reads, read_sectors, writes, write_sectors = fields.split()[:6]
+            row['disk_read'] += int(read_sectors) * 512 / interval
+            row['disk_write'] += int(write_sectors) * 512 / interval
+            row['disk_busy'] = max(row['disk_busy'], min(100.0, int(io_ms) / (interval * 10)))
+        elif label == 'NET':
+            name, rx_packets, rx_bytes, tx_packets, tx_bytes = fields.split()[:5]
+            # the first NET line is the 'upper' line with the TCP/UDP/IP counters
+            if name not in ('upper', 'lo'):
+                row['net_rx'] += int(rx_bytes) / interval
+                row['net_tx'] += int(tx_bytes) / interval
+        elif label in ('PRC', 'PRM'):
+            match = PROC_RE.match(fields)
+            if not match:
+                return
+            pid, name, state, rest = match.groups()
+            rest = rest.split()
+            proc = self.procs[int(pid)]
+            proc[0] = name
+            if label == 'PRC':
+                hz, user, system = map(int, rest[:3])
+                proc[1] = (user + system) / (hz * interval) * 100
+            else:
+                proc[2] = int(rest[2]) * 1024
+
+    # the top processes by CPU and by RSS: [(pid, name, cpu %, rss bytes)]
+    def top_procs(self, top: int) -> list[tuple]:
+        procs = [(pid, *proc) for pid, proc in self.procs.items() if proc[0] is not None]
+        by_cpu = sorted(procs, key=lambda p: p[2], reverse=True)[:top]
+        by_rss = sorted(procs, key=lambda p: p[3], reverse=True)[:top]
+        return list({p[0]: p for p in by_cpu + by_rss}.values())
+
+# Replays the raw files of a blade and returns the columns
+def parse_atop(filepaths: list[str], top: int = TOP_PROCESSES) -> dict:
+    columns = {name: [] for name in [*SAMPLE_COLUMNS, *PROC_COLUMNS]}
+    names = {}
+    def add_sample(sample: Sample):
+        for name in SAMPLE_COLUMNS:
+            columns[name].append(sample.row[name])
+        for pid, name, cpu, rss in sample.top_procs(top):
+            columns['proc_time'].append(sample.row['time'])
+            columns['proc_pid'].append(pid)
+            columns['proc_name'].append(names.setdefault(name, len(names)))
+            columns['proc_cpu'].append(cpu)
+            columns['proc_rss'].append(rss)
+
+    for filepath in filepaths:
+        sample = None
+        for line in atop_lines(filepath):
+            if line.startswith(('RESET', 'SEP')):
+                if sample:
+                    add_sample(sample)
+                sample = None
+                continue
+            match = LINE_RE.match(line.rstrip('\n'))
+            if not match:
+                continue
+            label, time, interval, fields = match.groups()
+            if sample is None:
+                sample = Sample(int(time), int(interval))
+            sample.add(label, fields)
+        if sample:
+            add_sample(sample)
+
+    arrays = {name: np.array(columns[name], dtype=dtype) for name, dtype in {**SAMPLE_COLUMNS, **PROC_COLUMNS}.items()}
+    arrays['names'] = np.array(list(names), dtype=str)
+    # the raw files of a blade may overlap (eg. a rotated file and the live one)
+    order = np.argsort(arrays['time'], kind='stable')
+    first = np.unique(arrays['time'][order], return_index=True)[1]
+    for name in SAMPLE_COLUMNS:
+        arrays[name] = arrays[name][order][first]
+    # (also sorts the processes by time and pid)
+    first = np.unique(np.stack([arrays['proc_time'], arrays['proc_pid']], axis=1), axis=0, return_index=True)[1]
+    for name in PROC_COLUMNS:
+        arrays[name] = arrays[name][first]
+    return arrays
+
+def store_filepath(pack_dir: str, cluster: str, host: str) -> str:
+    return os.path.join(pack_dir, STORE_DIRNAME, f'{cluster}_{host}.npz')
+
+# the raw files of the pack by blade: {(cluster, blade): [relpath]}
+def find_atop_files(pack_dir: str) -> dict:
+    files = collections.defaultdict(list)
+    for root, dirs, filenames in os.walk(pack_dir):
+        for filename in filenames:
+            if ATOP_RAW_RE.match(filename) and not filename.endswith('.part'):
+                relpath = os.path.relpath(os.path.join(root, filename), pack_dir)
+                files[collect_utils.parse_pack_path(pack_dir, relpath)].append(relpath)
+    return files
+
+# the sizes and mtimes of the raw files, the store of a blade is rebuilt only if they changed
+def sources_of(pack_dir: str, relpaths: list[str]) -> str:
+    stats = {relpath: os.stat(os.path.join(pack_dir, relpath)) for relpath in sorted(relpaths)}
+    return json.dumps({relpath: [stat.st_size, int(stat.st_mtime)] for relpath, stat in stats.items()})
+
+def ingest_blade(pack_dir: str, cluster: str, host: str, relpaths: list[str], top: int = TOP_PROCESSES) -> bool:
+    filepath = store_filepath(pack_dir, cluster, host)
+    sources = sources_of(pack_dir, relpaths)
+    if os.path.exists(filepath):
+        with np.load(filepath) as stored:
+            if str(stored['sources']) == sources:
+                return False
+    arrays = parse_atop([os.path.join(pack_dir, relpath) for relpath in relpaths], top)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    # written under a temporary name, so a killed ingestion never leaves a half written store behind
+    with open(filepath + '.tmp', 'wb') as f:
+        np.savez_compressed(f, sources=np.array(sources), **arrays)
+    os.replace(filepath + '.tmp', filepath)
+    return True
+
+# Converts the raw files of every blade of the pack (on multiple processes), returns the blades which failed
+def ingest(pack_dir: str, workers: int = None, top: int = TOP_PROCESSES) -> list[tuple[str, str]]:
+    files = find_atop_files(pack_dir)
+    if not files:
+        return []
+    if not shutil.which('atop'):
+        print(f'Error: atop is not installed, the atop_raw.log files of {len(files)} blades are not converted')
+        return list(files)
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {executor.submit(ingest_blade, pack_dir, cluster, host, relpaths, top): (cluster, host)
+                   for (cluster, host), relpaths in sorted(files.items())}
+        for future in concurrent.futures.as_completed(futures):
+            cluster, host = futures[future]
+            try:
+                if future.result():
+                    print(f'atop: converted {cluster}/{host}')
+            except Exception as e:
+                print(f'Error: could not convert the atop files of {cluster}/{host}: {e!r}')
+                failed.append((cluster, host))
+    return failed
+
+# The store of every blade of the pack: {'<cluster>/<blade>': {column: array}}
+def load(pack_dir: str, host_re: str = None) -> dict:
+    stores = {}
+    store_dir = os.path.join(pack_dir, STORE_DIRNAME)
+    for filename in sorted(os.listdir(store_dir)) if os.path.isdir(store_dir) else []:
+        if not filename.endswith('.npz'):
+            continue
+        cluster, host = filename[:-len('.npz')].rsplit('_', 1)
+        if host_re and not re.search(host_re, f'{cluster}/{host}'):
+            continue
+        with np.load(os.path.join(store_dir, filename)) as stored:
+            stores[f'{cluster}/{host}'] = {name: stored[name] for name in stored.files if name != 'sources'}
+    return stores
+
+def to_epoch(time_str: str) -> int:
+    return int(collect_utils.parse_time(time_str).replace(tzinfo=datetime.timezone.utc).timestamp())
+
+def from_epoch(epoch: int) -> str:
+    return datetime.datetime.fromtimestamp(int(epoch), datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+# the indexes of the rows between since and until (epoch, both inclusive, None: no limit) of a sorted time column
+def window(times: np.ndarray, since: int = None, until: int = None) -> slice:
+    start = np.searchsorted(times, since, side='left') if since is not None else 0
+    end = np.searchsorted(times, until, side='right') if until is not None else len(times)
+    return slice(start, end)
+
+# {blade: (time, max value)} of a sample column in the window
+def max_per_blade(stores: dict, column: str, since: int = None, until: int = None) -> dict:
+    result = {}
+    for blade, store in stores.items():
+        rows = window(store['time'], since, until)
+        values = store[column][rows]
+        if len(values):
+            i = np.argmax(values)
+            result[blade] = (int(store['time'][rows][i]), float(values[i]))
+    return result
+
+# the total RSS of the processes called process in every interval of the window: (times, rss)
+def process_rss(store: dict, process: str, since: int = None, until: int = None) -> tuple[np.ndarray, np.ndarray]:
+    codes = np.flatnonzero(store['names'] == process)
+    if not len(codes):
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    rows = window(store['proc_time'], since, until)
+    mask = store['proc_name'][rows] == codes[0]
+    times, inverse = np.unique(store['proc_time'][rows][mask], return_inverse=True)
+    return times, np.bincount(inverse, weights=store['proc_rss'][rows][mask]).astype(np.int64)
+
+# {blade: (first rss, last rss, growth %)} of the blades where the RSS of process grew more than min_growth % in the window
+def rss_growth(stores: dict, process: str, min_growth: float, since: int = None, until: int = None) -> dict:
+    result = {}
+    for blade, store in stores.items():
+        times, rss = process_rss(store, process, since, until)
+        if len(rss) < 2 or not rss[0]:
+            continue
+        growth = (rss[-1] - rss[0]) / rss[0] * 100
+        if growth > min_growth:
+            result[blade] = (int(rss[0]), int(rss[-1]), float(growth))
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                        prog='atop_store.py',
+                        description='Converts the atop_raw.log files of a log pack into NumPy arrays and queries them',
+                        formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = subparsers.add_parser('ingest', help='convert (or update) the atop files of a log pack')
+    ingest_parser.add_argument('pack', type=str, help='the directory of the log pack')
+    ingest_parser.add_argument('-j', '--jobs', type=int, help='number of blades converted at the same time (default: number of CPUs)')
+    ingest_parser.add_argument('--top', type=int, default=TOP_PROCESSES, help=f'number of processes kept from every interval by CPU and by RSS (default: {TOP_PROCESSES})')
+    max_parser = subparsers.add_parser('max', help='the max of a column per blade (ex. cpu_busy, disk_busy, net_rx)')
+    max_cpu_parser = subparsers.add_parser('max-cpu', help='the max CPU usage per blade')
+    rss_parser = subparsers.add_parser('rss-growth', help='the blades where the RSS of a process grew more than --min-growth %%')
+    rss_parser.add_argument('--process', type=str, required=True, help='name of the process (ex. nfsd)')
+    rss_parser.add_argument('--min-growth', type=float, default=0, help='in %% (default: 0)')
+    max_parser.add_argument('column', type=str, choices=[c for c in SAMPLE_COLUMNS if c not in ('time', 'interval')])
+    for query_parser in (max_parser, max_cpu_parser, rss_parser):
+        query_parser.add_argument('pack', type=str, help='the directory of the log pack')
+        query_parser.add_argument('--since', type=str, help='format: "YYYY-MM-DD HH:MM[:SS]" (UTC)')
+        query_parser.add_argument('--until', type=str, help='format: "YYYY-MM-DD HH:MM[:SS]" (UTC)')
+        query_parser.add_argument('--host', type=str, help='only the blades matching this regex (matched against <cluster>/<blade>)')
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        failed = ingest(args.pack, args.jobs, args.top)
+        exit(1 if failed else 0)
+
+    stores = load(args.pack, args.host)
+    if not stores:
+        print(f'Error: no atop store in {args.pack}, run: atop_store.py ingest {args.pack}')
+        exit(1)
+    since = to_epoch(args.since) if args.since else None
+    until = to_epoch(args.until) if args.until else None
+    if args.command in ('max', 'max-cpu'):
+        column = 'cpu_busy' if args.command == 'max-cpu' else args.column
+        for blade, (time, value) in sorted(max_per_blade(stores, column, since, until).items(), key=lambda item: -item[1][1]):
+            print(f'{blade:<30} {value:>14.1f}  at {from_epoch(time)}')
+    elif args.command == 'rss-growth':
+        for blade, (first, last, growth) in sorted(rss_growth(stores, args.process, args.min_growth, since, until).items(), key=lambda item: -item[1][2]):
+            print(f'{blade:<30} {collect_utils.format_size(first):>10} -> {collect_utils.format_size(last):>10}  +{growth:.1f}%')
@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+# Benchmarks collect.py and collect-fuse.py without any cluster: an in-process paramiko server stands in
+# for every host (the VIP of the clusters, the FMs, the blades behind the FMs and fuse) and serves
+# synthetic /logs trees from a temporary directory, so it runs offline on one Linux box.
+#
+# Every collection mode (scp, --bundle, --keep-compressed, --index, --since/--until, --grep, warm --store,
+# collect-fuse.py) is run as a separate process and measured:
+#  - wall time of the whole run
+#  - handshakes, channels (nested connections), execs, sftp sessions and their sum, the round trips,
+#    counted by the server
+#  - bytes sent by the server and the size of the log pack
+#  - peak RSS of the collector
+# The results are appended to a JSON lines file together with the commit and the parameters of the run,
+# and every run is compared with the previous one with the same parameters, so a change making the
+# collection slower (or doing more handshakes/round trips, or moving more bytes) is visible right away.
+#
+# How the stand-in works: the collectors are started through this script, which patches
+# paramiko.SSHClient.connect, so every direct connection goes to the local server, prefixed with the name
+# of the host it wanted. Nested connections (direct-tcpip channels, eg. FM -> blade) are served on the channel.
+# The commands run with bash in the directory of the host, /logs and /home/ir are rewritten to its subdirectories
+# and the fake pure* commands (purenetwork, puremastership, pureblade) are in its bin directory.
+#
+# usage:
+#   benchmark.py run                                   (every mode with the default topology)
+#   benchmark.py run --modes scp,bundle --blades 8 --files 12 --file-size 1024 --zst-ratio 0.5 --repeat 3
+#   benchmark.py compare                               (the last runs with the ones before them)
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+import random
+import resource
+import runpy
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+import paramiko
+
+import collect_utils
+
+DEFAULT_RESULTS_FILE = os.path.expanduser('~/.cache/collect-benchmark.jsonl')
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DATE = '2024-01-30'
+USERNAME = 'ir'
+FM_LOGS = ['middleware.log', 'platform.log']
+BLADE_LOGS = ['nfs.log', 'platform.log']
+LOGTYPES = 'middleware,platform,nfs,platform_blades'
+
+# name: (script, extra arguments, run it once before the measurement)
+MODES = {
+    'scp': ('collect.py', [], False),
+    'bundle': ('collect.py', ['--bundle'], False),
+    'keep-compressed': ('collect.py', ['--keep-compressed'], False),
+    'index': ('collect.py', ['--index'], False),
+    'time-window': ('collect.py', ['--since', f'{DATE} 01:10', '--until', f'{DATE} 01:20'], False),
+    'grep': ('collect.py', ['--grep', 'line 1[0-9]+ '], False),
+    # everything is in the store from the first run, the second one only checks the remote files
+    'store-warm': ('collect.py', ['--store', '{workdir}/store'], True),
+    'fuse-scp': ('collect-fuse.py', [], False),
+    'fuse-bundle': ('collect-fuse.py', ['--bundle'], False),
+}
+# the metrics compared between the runs, the ones where a higher value is worse
+COMPARED_METRICS = ['wall_seconds', 'handshakes', 'round_trips', 'bytes_sent', 'pack_size', 'peak_rss']
+
+# The synthetic hosts: <workdir>/hosts/<host>/{bin,logs,home/ir/.ssh}, where host is the name of a cluster (VIP),
+# an FM IP or <cluster>.<blade> (blades have the same names in every cluster, they're told apart by the FM
+# they're reached through), and <workdir>/fuse/<cluster>/<date>/{fm1,fm2,fb1,...} for collect-fuse.py
+class Topology:
+    def __init__(self, workdir: str, clusters: int, blades: int, files: int, file_size: int, zst_ratio: float, seed: int = 0):
+        self.workdir = workdir
+        self.hosts_dir = os.path.join(workdir, 'hosts')
+        self.clusters = [f'irp9{i:02d}-c01' for i in range(1, clusters + 1)]
+        self.blades = blades
+        self.files = files
+        self.file_size = file_size
+        self.zst_ratio = zst_ratio
+        self._random = random.Random(seed)
+        # FM IP -> cluster
+        self.fm_clusters = {}
+
+    def root_of(self, host: str) -> str:
+        return os.path.join(self.hosts_dir, host)
+
+    # the host served on a direct-tcpip channel opened on parent to dest
+    def nested_host(self, parent: str, dest: str) -> str:
+        cluster = self.fm_clusters.get(parent)
+        return f'{cluster}.{dest}' if cluster else dest
+
+    def create(self):
+        key = paramiko.RSAKey.generate(2048)
+        for c, cluster in enumerate(self.clusters, start=1):
+            fm_ips = [f'10.0.{c}.1', f'10.0.{c}.2']
+            self._write_command(cluster, 'purenetwork', ['Name,Enabled,Subnet,Address,Address2'] +
+                                [f'fm{n}.admin0,True,,x,{ip}' for n, ip in enumerate(fm_ips, start=1)])
+            self._write_command(cluster, 'puremastership', ['Name Status', 'CH1.FM1  master', 'CH1.FM2  secondary'])
+            fuse_dir = os.path.join(self.workdir, 'fuse', cluster, DATE.replace('-', '_'))
+            for n, ip in enumerate(fm_ips, start=1):
+                self.fm_clusters[ip] = cluster
+                self._write_command(ip, 'pureblade', [f'CH1.FB{b}   healthy' for b in range(1, self.blades + 1)])
+                self._write_command(ip, 'puremastership', ['Name Status', 'CH1.FM1  master', 'CH1.FM2  secondary'])
+                os.makedirs(os.path.join(self.root_of(ip), 'home', USERNAME, '.ssh'))
+                key.write_private_key_file(os.path.join(self.root_of(ip), 'home', USERNAME, '.ssh', 'id_rsa'))
+                self._write_logs(ip, FM_LOGS, os.path.join(fuse_dir, f'fm{n}'))
+            for b in range(1, self.blades + 1):
+                self._write_logs(f'{cluster}.ir{b}', BLADE_LOGS, os.path.join(fuse_dir, f'fb{b}'))
+        # collect-fuse.py uses absolute paths on fuse, the host needs only a directory to run the commands in
+        for host in ('fuse', 'fuse-staging'):
+            os.makedirs(self.root_of(host))
+
+    def _write_command(self, host: str, name: str, lines: list[str]):
+        bin_dir = os.path.join(self.root_of(host), 'bin')
+        os.makedirs(bin_dir, exist_ok=True)
+        with open(os.path.join(bin_dir, name), 'w') as f:
+            f.write('#!/bin/bash\n' + ''.join(f"echo '{line}'\n" for line in lines))
+        os.chmod(os.path.join(bin_dir, name), 0o755)
+
+    # one rotated file per hour (a part of them compressed) and the live file, the rotated ones go to fuse too
+    def _write_logs(self, host: str, lognames: list[str], fuse_dir: str):
+        logs_dir = os.path.join(self.root_of(host), 'logs')
+        os.makedirs(logs_dir, exist_ok=True)
+        os.makedirs(fuse_dir, exist_ok=True)
+        compressed = round(self.files * self.zst_ratio)
+        for logname in lognames:
+            for hour in range(self.files):
+                filepath = os.path.join(logs_dir, f'{logname}.{DATE}.{hour:02d}-00-00')
+                with open(filepath, 'wb') as f:
+                    f.write(self._log_content(host, hour))
+                if hour < compressed:
+                    subprocess.run(['zstd', '-q', '--rm', filepath], check=True)
+                    filepath += '.zst'
+                else:
+                    # fuse has only compressed files
+                    subprocess.run(['zstd', '-q', filepath, '-o', os.path.join(fuse_dir, os.path.basename(filepath) + '.zst')], check=True)
+                if hour < compressed:
+                    collect_utils.link_or_copy(filepath, os.path.join(fuse_dir, os.path.basename(filepath)))
+            with open(os.path.join(logs_dir, logname), 'wb') as f:
+                f.write(self._log_content(host, self.files))
+
+    # about file_size bytes of log lines spread over the hour
+    def _log_content(self, host: str, hour: int) -> bytes:
+        words = ['replica', 'link', 'array', 'heartbeat', 'snapshot', 'transfer', 'retry', 'ok', 'failed', 'session']
+        services = ['replication::replica_link_manager', 'replication.client', 'nfs::server', 'platform.health']
+        lines = []
+        size = 0
+        n = 0
+        while size < self.file_size:
+            n += 1
+            seconds = min(3599, size * 3600 // self.file_size)
+            message = ' '.join(self._random.choices(words, k=6))
+            line = (f'{DATE} {hour % 24:02d}:{seconds // 60:02d}:{seconds % 60:02d}.{n % 1000:03d} INFO {self._random.choice(services)} '
+                    f'host={host} line {n} {message} id={self._random.getrandbits(32):08x}\n')
+            lines.append(line)
+            size += len(line)
+        return ''.join(lines).encode()
+
+class Counters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = collections.Counter()
+
+    def add(self, name: str, n: int = 1):
+        with self._lock:
+            self._counts[name] += n
+
+    # returns the counts and starts again from 0
+    def take(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+            self._counts.clear()
+        return counts
+
+class StandInHost(paramiko.ServerInterface):
+    def __init__(self, server: 'StandInServer', host: str):
+        self.server = server
+        self.host = host
+        self.root = server.topology.root_of(host)
+        # chanid -> the host the direct-tcpip channel goes to
+        self.nested = {}
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.nested[chanid] = self.server.topology.nested_host(self.host, destination[0])
+        self.server.counters.add('channels')
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        self.server.counters.add('execs')
+        command = command.decode().replace('/logs', f'{self.root}/logs').replace(f'/home/{USERNAME}', f'{self.root}/home/{USERNAME}')
+        threading.Thread(target=self.server.run_command, args=(channel, command, self.root), daemon=True).start()
+        return True
+
+class StandInSFTP(paramiko.SFTPServerInterface):
+    def __init__(self, host: StandInHost, *args, **kwargs):
+        super().__init__(host, *args, **kwargs)
+        host.server.counters.add('sftp')
+        self.root = host.root
+
+    def open(self, path, flags, attr):
+        handle = paramiko.SFTPHandle(flags)
+        handle.readfile = open(self.root + path, 'rb')
+        handle.filename = self.root + path
+        return handle
+
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat(self.root + path))
+
+    lstat = stat
+
+class StandInServer:
+    def __init__(self, topology: Topology):
+        self.topology = topology
+        self.counters = Counters()
+        self._host_key = paramiko.RSAKey.generate(2048)
+        self._socket = socket.create_server(('127.0.0.1', 0))
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            sock, address = self._socket.accept()
+            threading.Thread(target=self._serve_direct, args=(sock,), daemon=True).start()
+
+    # a direct connection starts with the name of the host and a newline (see connect_to_stand_in)
+    def _serve_direct(self, sock: socket.socket):
+        host = b''
+        while not host.endswith(b'\n'):
+            data = sock.recv(1)
+            if not data:
+                return
+            host += data
+        self.serve(sock, host.decode().strip())
+
+    def serve(self, sock, host: str):
+        self.counters.add('handshakes')
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self._host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, StandInSFTP)
+        interface = StandInHost(self, host)
+        transport.start_server(server=interface)
+        # the accepted channels are kept, because a garbage collected Channel closes itself
+        channels = []
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is None:
+                continue
+            channels = [c for c in channels if not c.closed] + [channel]
+            nested_host = interface.nested.pop(channel.get_id(), None)
+            if nested_host:
+                threading.Thread(target=self.serve, args=(channel, nested_host), daemon=True).start()
+
+    def run_command(self, channel: paramiko.Channel, command: str, root: str):
+        env = dict(os.environ, PATH=f'{root}/bin:{os.environ["PATH"]}')
+        try:
+            process = subprocess.Popen(['bash', '-c', command], cwd=root, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            # eg. an unknown host without a directory
+            channel.sendall_stderr(f'{e}\n'.encode())
+            channel.send_exit_status(127)
+            channel.close()
+            return
+        def pump_stdin():
+            while data := channel.recv(32768):
+                try:
+                    process.stdin.write(data)
+                    process.stdin.flush()
+                except OSError:
+                    break
+            process.stdin.close()
+        def pump_stderr():
+            while data := process.stderr.read1(32768):
+                channel.sendall_stderr(data)
+                self.counters.add('bytes_sent', len(data))
+        threading.Thread(target=pump_stdin, daemon=True).start()
+        stderr_thread = threading.Thread(target=pump_stderr, daemon=True)
+        stderr_thread.start()
+        try:
+            while data := process.stdout.read1(32768):
+                channel.sendall(data)
+                self.counters.add('bytes_sent', len(data))
+        except OSError:
+            # the client closed the channel (eg. head, or a failed download)
+            process.kill()
+        process.wait()
+        stderr_thread.join()
+        channel.send_exit_status(process.returncode)
+        channel.close()
+
+# a nested transport fails in its thread when it closes its channel after the outer connection was closed
+def ignore_closed_connections(args):
+    if not issubclass(args.exc_type, (EOFError, OSError)):
+        threading.__excepthook__(args)
+
+# In the process of the collector: every direct connection goes to the stand-in server
+def connect_to_stand_in(port: int):
+    original_connect = paramiko.SSHClient.connect
+    def connect(self, hostname, port_=22, *args, **kwargs):
+        if kwargs.get('sock') is None:
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall(f'{hostname}\n'.encode())
+            kwargs['sock'] = sock
+        # the stand-in accepts anything, but there's no ssh-agent or key when the collector relies on them
+        if not kwargs.get('pkey'):
+            kwargs.setdefault('password', 'stand-in')
+        return original_connect(self, hostname, port_, *args, **kwargs)
+    paramiko.SSHClient.connect = connect
+
+# The collector process: benchmark.py _collector <port> <stats file> <script> <args of the script>
+def run_collector(port: int, stats_filepath: str, script: str, args: list[str]):
+    connect_to_stand_in(port)
+    sys.argv = [script] + args
+    sys.path.insert(0, SCRIPT_DIR)
+    exit_status = 0
+    try:
+        runpy.run_path(os.path.join(SCRIPT_DIR, script), run_name='__main__')
+    except SystemExit as e:
+        exit_status = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+        exit_status = 1
+    finally:
+        # ru_maxrss is in KB on Linux
+        with open(stats_filepath, 'w') as f:
+            json.dump({'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, 'exit_status': exit_status}, f)
+        sys.stdout.flush()
+    # the threads of the connection pool and the server must not keep it running
+    os._exit(exit_status)
+
+def directory_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(path) for f in files)
+
+# Runs one mode once in a fresh directory (and HOME, so no cache or store is shared between the runs)
+def run_mode(server: StandInServer, topology: Topology, mode: str, run_dir: str) -> dict:
+    script, extra_args, warmup = MODES[mode]
+    extra_args = [a.format(workdir=run_dir) for a in extra_args]
+    if script == 'collect.py':
+        args = ['-c', ','.join(topology.clusters), '-l', LOGTYPES, '--i-want-a-lot'] + extra_args
+    else:
+        args = ['-c', topology.clusters[0], '--date', DATE, '--max-hour', str(topology.files - 1),
+                '--cluster-dir-on-fuse', os.path.join(topology.workdir, 'fuse', topology.clusters[0]), '-l', LOGTYPES] + extra_args
+    home = os.path.join(run_dir, 'home')
+    os.makedirs(home)
+    env = dict(os.environ, HOME=home, PASSWORD_QA1='x', PASSWORD_QA2='x', PASSWORD_SIMPLE='x')
+    env.pop('SSH_AUTH_SOCK', None)
+    stats_filepath = os.path.join(run_dir, 'stats.json')
+    command = [sys.executable, os.path.abspath(__file__), '_collector', str(server.port), stats_filepath, script] + args
+
+    for attempt in (['warmup', 'measured'] if warmup else ['measured']):
+        pack_dir = os.path.join(run_dir, attempt)
+        os.makedirs(pack_dir)
+        server.counters.take()
+        start_time = time.monotonic()
+        with open(os.path.join(run_dir, f'{attempt}.log'), 'w') as output:
+            subprocess.run(command, cwd=pack_dir, env=env, stdout=output, stderr=subprocess.STDOUT)
+        wall_seconds = time.monotonic() - start_time
+    counts = server.counters.take()
+    with open(stats_filepath) as f:
+        stats = json.load(f)
+    result = {
+        'wall_seconds': wall_seconds,
+        'handshakes': counts.get('handshakes', 0),
+        'channels': counts.get('channels', 0),
+        'execs': counts.get('execs', 0),
+        'sftp': counts.get('sftp', 0),
+        'round_trips': sum(counts.get(name, 0) for name in ('handshakes', 'channels', 'execs', 'sftp')),
+        'bytes_sent': counts.get('bytes_sent', 0),
+        'pack_size': directory_size(pack_dir),
+        **stats,
+    }
+    if stats['exit_status']:
+        print(f'Error: {mode} exited with {stats["exit_status"]}, see {os.path.join(run_dir, "measured.log")}')
+    return result
+
+def git_commit() -> str:
+    result = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=SCRIPT_DIR, capture_output=True, text=True)
+    return result.stdout.strip() or 'unknown'
+
+def load_results(results_filepath: str) -> list[dict]:
+    if not os.path.exists(results_filepath):
+        return []
+    with open(results_filepath) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# compares the result with the last earlier one of the same mode and config, returns the regressions
+def compare(result: dict, earlier_results: list[dict], threshold: float) -> list[str]:
+    baselines = [r for r in earlier_results if r['mode'] == result['mode'] and r['config'] == result['config'] and not r['metrics'].get('exit_status')]
+    if not baselines:
+        return []
+    baseline = baselines[-1]
+    regressions = []
+    for metric in COMPARED_METRICS:
+        old, new = baseline['metrics'].get(metric), result['metrics'].get(metric)
+        if old is None or new is None:
+            continue
+        if new > old * (1 + threshold / 100) and new - old > (0.05 if metric == 'wall_seconds' else 0):
+            regressions.append(f'{result["mode"]}: {metric} {old:.6g} -> {new:.6g} (baseline: {baseline["commit"]} at {baseline["time"]})')
+    return regressions
+
+def format_row(mode: str, metrics: dict) -> str:
+    return (f'{mode:<16} {metrics["wall_seconds"]:>8.2f} {metrics["handshakes"]:>6} {metrics["round_trips"]:>6} '
+            f'{collect_utils.format_size(metrics["bytes_sent"]):>10} {collect_utils.format_size(metrics["pack_size"]):>10} '
+            f'{collect_utils.format_size(metrics["peak_rss"]):>10}')
+
+HEADER = f'{"MODE":<16} {"WALL(s)":>8} {"HANDSH":>6} {"RTRIPS":>6} {"SENT":>10} {"PACK":>10} {"PEAK RSS":>10}'
+
+def run(args):
+    modes = args.modes.split(',') if args.modes else list(MODES)
+    for mode in modes:
+        assert mode in MODES, f'unknown mode: {mode}, possible modes: {", ".join(MODES)}'
+    config = {'clusters': args.clusters, 'blades': args.blades, 'files': args.files, 'file_size': args.file_size, 'zst_ratio': args.zst_ratio}
+    # the server side of the connections closed by the collectors would be logged with tracebacks
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    threading.excepthook = ignore_closed_connections
+    workdir = tempfile.mkdtemp(prefix='collect-benchmark-')
+    print(f'workdir = {workdir}')
+    topology = Topology(workdir, args.clusters, args.blades, args.files, args.file_size * 1024, args.zst_ratio)
+    topology.create()
+    server = StandInServer(topology)
+
+    earlier_results = load_results(args.results)
+    results = []
+    print(HEADER)
+    for mode in modes:
+        runs = [run_mode(server, topology, mode, os.path.join(workdir, 'runs', f'{mode}-{i}')) for i in range(args.repeat)]
+        # the counts are the same every time, the times and the memory usage are not
+        metrics = dict(runs[-1])
+        for metric in ('wall_seconds', 'peak_rss'):
+            metrics[metric] = statistics.median(r[metric] for r in runs)
+        results.append({'time': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(),
+                        'mode': mode, 'config': config, 'repeat': args.repeat, 'metrics': metrics})
+        print(format_row(mode, metrics), flush=True)
+
+    os.makedirs(os.path.dirname(args.results) or '.', exist_ok=True)
+    with open(args.results, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+    print(f'results: {args.results}')
+    if not args.keep:
+        shutil.rmtree(workdir)
+    return report_regressions(results, earlier_results, args.threshold)
+
+def report_regressions(results: list[dict], earlier_results: list[dict], threshold: float) -> bool:
+    regressions = [line for result in results for line in compare(result, earlier_results, threshold)]
+    if regressions:
+        print(f'\nREGRESSIONS (more than {threshold}% worse than the previous run):')
+        print('\n'.join(regressions))
+    return not regressions
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '_collector':
+        run_collector(int(sys.argv[2]), sys.argv[3], sys.argv[4], sys.argv[5:])
+
+    parser = argparse.ArgumentParser(
+                        prog='benchmark.py',
+                        description='Benchmarks the collectors against a local stand-in of the clusters',
+                        formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='run the benchmark and compare it with the previous run')
+    run_parser.add_argument('--modes', type=str, help=f'modes separated by comma (default: all of them: {",".join(MODES)})')
+    run_parser.add_argument('--clusters', type=int, default=1, help='number of clusters (default: 1)')
+    run_parser.add_argument('--blades', type=int, default=4, help='number of blades in every cluster (default: 4)')
+    run_parser.add_argument('--files', type=int, default=4, help='number of rotated files of every log (default: 4)')
+    run_parser.add_argument('--file-size', type=int, default=256, help='size of a logfile in KB, before compression (default: 256)')
+    run_parser.add_argument('--zst-ratio', type=float, default=1.0, help='ratio of the rotated files which are compressed (default: 1.0)')
+    run_parser.add_argument('--repeat', type=int, default=1, help='run every mode this many times, the median is kept (default: 1)')
+    run_parser.add_argument('--keep', action='store_true', default=False, help='keep the synthetic hosts and the log packs')
+    compare_parser = subparsers.add_parser('compare', help='compare the last run of every mode with the one before it')
+    for subparser in (run_parser, compare_parser):
+        subparser.add_argument('--results', type=str, default=DEFAULT_RESULTS_FILE, help=f'the results file (default: {DEFAULT_RESULTS_FILE})')
+        subparser.add_argument('--threshold', type=float, default=10, help='a metric is a regression if it is worse by more than this %% (default: 10)')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        exit(0 if run(args) else 1)
+
+    results = load_results(args.results)
+    last = {}
+    for i, result in enumerate(results):
+        last[(result['mode'], json.dumps(result['config'], sort_keys=True))] = i
+    print(HEADER)
+    ok = True
+    for i in sorted(last.values()):
+        print(format_row(results[i]['mode'], results[i]['metrics']))
+        ok = report_regressions([results[i]], results[:i], args.threshold) and ok
+    exit(0 if ok else 1)
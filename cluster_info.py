@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# Finds out the basic facts of the clusters of a log pack (made by collect.py or collect-fuse.py):
+#  - the portal blades: the ones with an nfs.log containing 'Starting heartbeat rpc_type=array_conn_heartbeat'
+#  - the names and admin VIPs of the clusters from ir_test.log
+# and writes them into cluster-info.txt (same format as cluster-info.sh) and cluster-info.json.
+#
+# The nfs.logs are scanned on multiple threads (.zst files too, through zstd), a file is read only until
+# the first match, and the other files of a blade are not read at all once the blade turned out to be a portal.
+# The collectors submit the files as soon as they land, so most of the scanning is done by the end
+# of the downloads. The scanned files are remembered in cluster-info.json, so running it again
+# (eg. after more logs were downloaded into the pack) reads only the new files.
+#
+# usage:
+#   cluster_info.py <log pack>
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import threading
+
+import collect_utils
+
+CLUSTER_INFO_FILENAME = 'cluster-info.txt'
+CLUSTER_INFO_JSON_FILENAME = 'cluster-info.json'
+
+PORTAL_PATTERN = b'Starting heartbeat rpc_type=array_conn_heartbeat'
+# the same as the regex of 'ack --match' in cluster-info.sh
+IR_TEST_LOG_RE = re.compile(r'"ipv4_admin_vip": "(?P<admin_vip>[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+)"|"name": "(?P<name>irp[0-9]{3}-c[0-9]{2})"')
+CLUSTER_DIR_RE = re.compile(r'^irp[0-9]{3}-c[0-9]{2}$')
+
+def is_nfs_log(filename: str) -> bool:
+    return 'nfs.log' in filename and not filename.endswith('.part')
+
+# reads the file until the first occurrence of pattern
+def file_contains(filepath: str, pattern: bytes, chunk_size: int = 1024 * 1024) -> bool:
+    tail = b''
+    with collect_utils.open_log(filepath) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return False
+            # the pattern can be split between two chunks
+            if pattern in chunk or pattern in tail + chunk[:len(pattern) - 1]:
+                return True
+            tail = chunk[-(len(pattern) - 1):]
+
+# The lines of ir_test.log with the admin VIPs and names of the clusters, like cluster-info.sh collects them:
+# stripped, without repeating the same line, every admin VIP with the name after it.
+# Returns the lines for cluster-info.txt and the clusters: [{'name': ..., 'admin_vip': ...}]
+def parse_ir_test_log(filepath: str) -> tuple[list[str], list[dict]]:
+    matched_lines = []
+    clusters = []
+    with collect_utils.open_log(filepath) as f:
+        for line in f:
+            line = line.decode('utf-8', errors='replace')
+            match = IR_TEST_LOG_RE.search(line)
+            if not match or (matched_lines and matched_lines[-1] == ' '.join(line.split())):
+                continue
+            matched_lines.append(' '.join(line.split()))
+            key = 'admin_vip' if match.group('admin_vip') else 'name'
+            if not clusters or key in clusters[-1]:
+                clusters.append({})
+            clusters[-1][key] = match.group(key)
+    lines = [' '.join(matched_lines[i:i + 2]) for i in range(0, len(matched_lines), 2)]
+    return lines, clusters
+
+class ClusterInfo:
+    def __init__(self, logdir: str, workers: int = None):
+        self.logdir = logdir
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self._futures = {}
+        # relpath: [size, mtime, is portal], the ones from the last run are reused if the file didn't change
+        self._scanned = {}
+        self._portal_hosts = set()
+        json_filepath = os.path.join(logdir, CLUSTER_INFO_JSON_FILENAME)
+        if os.path.exists(json_filepath):
+            with open(json_filepath) as f:
+                self._scanned = json.load(f).get('scanned', {})
+            self._portal_hosts = {collect_utils.parse_pack_path(logdir, relpath)
+                                  for relpath, (size, mtime, portal) in self._scanned.items() if portal}
+
+    # can be called with any file (eg. as on_done of the Decompressor), only the nfs.logs are scanned
+    def submit(self, filepath: str):
+        if not is_nfs_log(os.path.basename(filepath)):
+            return
+        relpath = os.path.relpath(filepath, self.logdir)
+        with self._lock:
+            if relpath not in self._futures:
+                self._futures[relpath] = self._executor.submit(self._scan, relpath)
+
+    def _scan(self, relpath: str):
+        filepath = os.path.join(self.logdir, relpath)
+        host = collect_utils.parse_pack_path(self.logdir, relpath)
+        stat = os.stat(filepath)
+        with self._lock:
+            previous = self._scanned.get(relpath)
+            if previous and previous[:2] == [stat.st_size, int(stat.st_mtime)]:
+                return
+            if host in self._portal_hosts:
+                # one logfile is enough to know that it's a portal, this one is scanned next time if it's needed
+                return
+        portal = file_contains(filepath, PORTAL_PATTERN)
+        with self._lock:
+            self._scanned[relpath] = [stat.st_size, int(stat.st_mtime), portal]
+            if portal:
+                self._portal_hosts.add(host)
+
+    # scans the files which were not submitted, then writes cluster-info.txt and cluster-info.json
+    def wait(self) -> dict:
+        existing = set()
+        for root, dirs, files in os.walk(self.logdir):
+            for filename in files:
+                if is_nfs_log(filename):
+                    filepath = os.path.join(root, filename)
+                    existing.add(os.path.relpath(filepath, self.logdir))
+                    self.submit(filepath)
+        failed = []
+        for relpath, future in self._futures.items():
+            if future.exception():
+                print(f'Error: could not scan {relpath}: {future.exception()!r}')
+                failed.append(relpath)
+        self._executor.shutdown()
+
+        # the deleted files are forgotten
+        self._scanned = {relpath: scan for relpath, scan in self._scanned.items() if relpath in existing}
+        portal_blades = {}
+        for relpath, (size, mtime, portal) in self._scanned.items():
+            if portal:
+                cluster, host = collect_utils.parse_pack_path(self.logdir, relpath)
+                portal_blades.setdefault(cluster, set()).add(host)
+
+        lines = []
+        cluster_dirs = sorted(d for d in os.listdir(self.logdir) if CLUSTER_DIR_RE.match(d) and os.path.isdir(os.path.join(self.logdir, d)))
+        if cluster_dirs:
+            for cluster in cluster_dirs:
+                lines.append(f'portal blade on cluster {cluster}: {",".join(sorted(portal_blades.get(cluster, [])))}')
+        else:
+            lines.append(f'portal blade: {",".join(sorted(set().union(*portal_blades.values())))}')
+
+        clusters = []
+        ir_test_logs = [f for f in ('ir_test.log', 'ir_test.log.zst') if os.path.exists(os.path.join(self.logdir, f))]
+        if ir_test_logs:
+            ir_test_lines, clusters = parse_ir_test_log(os.path.join(self.logdir, ir_test_logs[0]))
+            lines += ir_test_lines
+        else:
+            print('no ir_test.log found')
+
+        with open(os.path.join(self.logdir, CLUSTER_INFO_FILENAME), 'w') as f:
+            f.writelines(f'{line}\n' for line in lines)
+        info = {
+            'portal_blades': {cluster: sorted(hosts) for cluster, hosts in sorted(portal_blades.items())},
+            'clusters': clusters,
+            'failed': failed,
+            'scanned': self._scanned,
+        }
+        with open(os.path.join(self.logdir, CLUSTER_INFO_JSON_FILENAME), 'w') as f:
+            json.dump(info, f, indent=2)
+        return info
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                        prog='cluster_info.py',
+                        description=f'Finds the portal blades, cluster names and admin VIPs of a log pack, writes them into {CLUSTER_INFO_FILENAME} and {CLUSTER_INFO_JSON_FILENAME}',
+                        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('logdir', type=str, nargs='?', default='.', help='the directory of the log pack (default: the current directory)')
+    args = parser.parse_args()
+
+    ClusterInfo(args.logdir).wait()
+    with open(os.path.join(args.logdir, CLUSTER_INFO_FILENAME)) as f:
+        print(f.read(), end='')
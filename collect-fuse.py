@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
 import os
 import re
 import subprocess
+import sys
+import threading
+import time
 
 import paramiko
 import paramiko.agent
 from scp import SCPClient
 
+import cluster_info
+import collect_utils
+import log_index
+import middleware_db
 import paramiko_utils
 
 # Workaround for paramiko: AgentKey skips PKey.__init__ and never sets
@@ -47,7 +55,22 @@ only irpXXX-cXX... directory will be created but no parents (for safety consider
 parser.add_argument('--date', type=str, required=True, help='the date we need data for (format: YYYY-MM-DD)')
 parser.add_argument('--min-hour', type=int, default=0, help='the minimum hour we need data for in 24 hour format')
 parser.add_argument('--max-hour', type=int, default=23, help='the maximum hour we need data for in 24 hour format')
+parser.add_argument('--since', type=str, help='download only the lines after this time on --date (format: HH:MM[:SS]), the filtering is done on fuse')
+parser.add_argument('--until', type=str, help='download only the lines until this time on --date, inclusive (format: HH:MM[:SS], HH:MM means the end of that minute), use together with --since')
+parser.add_argument('--grep', type=str, help='do not download the logs, only print the lines matching this (extended) regex, the grep is done on fuse')
+parser.add_argument('--service', type=str, help='do not download the logs, only print the lines of these services (separated by comma, ex. "replication::replica_link_manager,replication.client")')
+parser.add_argument('--bundle', action='store_true', default=False, help='download the logs of each FM/blade dir as one tar stream instead of file by file')
+parser.add_argument('--keep-compressed', action='store_true', default=False, help='do not decompress the downloaded .zst files (use zstdcat/zstdgrep/zstdless on them)')
+parser.add_argument('--index', action='store_true', default=False, help='index the logs by time and service while they are downloaded (see log_index.py query)')
+parser.add_argument('--store', type=str, nargs='?', const=collect_utils.DEFAULT_STORE_DIR, help=f'''\
+keep the downloaded logs in a local store too (default: {collect_utils.DEFAULT_STORE_DIR}),
+files which did not change since the last run are not downloaded again, only linked from the store''')
 parser.add_argument('--cluster-dir-on-fuse', type=str, required=True, help='the dir where \'goto <cluster>\' brings on fuse (without date)')
+parser.add_argument('-j', '--jobs', type=int, default=4, help='''\
+number of downloads (and dir listings) running in parallel on the connection to fuse (default: 4),
+fuse is shared with others, so don't go too high''')
+parser.add_argument('--channels-per-dir', type=int, default=2, help='max. number of downloads from the same FM/blade dir at the same time (default: 2)')
+parser.add_argument('--bandwidth', type=float, help='max. bandwidth of all the downloads together (MB/s)')
 
 args = parser.parse_args()
 
@@ -60,6 +83,21 @@ logtypes = args.logtypes.split(',')
 print(f'logtypes to download: [{logtypes}]')
 print(f'date: [{args.date}]')
 
+time_window = None
+if args.since or args.until:
+    if not (args.since and args.until):
+        print('Error: both --since and --until has to be provided!')
+        exit(1)
+    time_window = (collect_utils.parse_time(f'{args.date} {args.since}'), collect_utils.parse_until(f'{args.date} {args.until}'))
+    print(f'time window: [{time_window[0]}] - [{time_window[1]}]')
+    if time_window[1] < time_window[0]:
+        print('Error: --since should be before --until!')
+        exit(1)
+    # the hourly files are selected with one more hour on both sides, in case a file has some lines
+    # from the previous/next hour (only the lines in the window are downloaded anyway)
+    args.min_hour = max(0, time_window[0].hour - 1)
+    args.max_hour = min(23, time_window[1].hour + 1)
+
 if args.max_hour < args.min_hour:
     print(f'Error: min-hour should be less or equal to max-hour! MIN_HOUR=[{args.min_hour}], MAX_HOUR=[{args.max_hour}]')
     exit(1)
@@ -108,7 +146,9 @@ def connect_via_ssh_config(host: str) -> paramiko.SSHClient:
     # if 'proxycommand' in cfg:
     #     connect_kwargs['sock'] = paramiko.ProxyCommand(cfg['proxycommand'])
 
-    client.connect(**connect_kwargs)
+    with paramiko_utils.metrics.measure('handshake', host):
+        client.connect(**connect_kwargs)
+    paramiko_utils.metrics.setHostname(client, host)
 
     # forward the local ssh-agent on every session opened on this transport
     # (covers both client.exec_command and SCPClient channels)
@@ -128,21 +168,111 @@ def get_desired_log_patterns(logfilename: str) -> list[str]:
     return [f'{logfilename}.{date}.{hour:02d}-*' for hour in range(args.min_hour, args.max_hour + 1)]
 
 
-def download_file(scp: SCPClient, remote_filepath: str, local_filepath: str):
+store = collect_utils.LogStore(args.store) if args.store else None
+print(f'store=[{args.store}]')
+
+grep_services = args.service.split(',') if args.service else None
+grep_mode = bool(args.grep or grep_services)
+# the matching lines are written into the log dir too
+grep_file = open(os.path.join(logdir, 'grep.log'), 'w') if grep_mode else None
+# the greps run on the threads of the scheduler, their lines must not get mixed
+print_lock = threading.Lock()
+
+def write_grep_line(line: str):
+    with print_lock:
+        print(line, flush=True)
+        grep_file.write(line + '\n')
+
+# the logfiles are indexed while the others are downloaded (after the decompression of the .zst files)
+indexer = log_index.LogIndexer(logdir) if args.index else None
+# the nfs.logs are searched for the portal blades while the others are downloaded
+cluster_info_scan = cluster_info.ClusterInfo(logdir)
+
+def on_file_done(filepath: str):
+    cluster_info_scan.submit(filepath)
+    if indexer:
+        indexer.submit(filepath)
+
+# .zst files are decompressed in the background while the other downloads are going on
+decompressor = collect_utils.Decompressor(enabled=not args.keep_compressed, on_done=on_file_done)
+
+
+def download_file(client: paramiko.SSHClient, remote_filepath: str, local_filepath: str, throttle: collect_utils.Throttle):
     print(f'Downloading: {remote_filepath} ...')
+    received = 0
+    # scp reports the progress after every chunk, that's where the bytes are counted
+    def progress(filename, size, sent):
+        nonlocal received
+        throttle.consume(sent - received)
+        received = sent
+    scp = SCPClient(client.get_transport(), progress=progress)
     scp.get(remote_path=remote_filepath, local_path=local_filepath, preserve_times=True)
+    decompressor.submit(os.path.join(local_filepath, os.path.basename(remote_filepath)))
+
+
+assert args.jobs > 0 and args.channels_per_dir > 0, 'jobs and channels should be at least 1'
+print(f'jobs=[{args.jobs}], channels_per_dir=[{args.channels_per_dir}], bandwidth=[{args.bandwidth} MB/s]')
+# the downloads of a dir are planned as soon as it's listed, and they start while the other dirs are being listed,
+# every download is a new channel on the same connection to fuse
+# (a failed grep is not retried, the lines it found before the failure would be printed again)
+scheduler = collect_utils.TransferScheduler(workers=args.jobs, max_channels_per_host=args.channels_per_dir,
+                                            bandwidth=args.bandwidth * 1024 * 1024 if args.bandwidth else None,
+                                            retries=0 if grep_mode else 1)
 
 
-def download_desired_logs(client: paramiko.SSHClient, scp: SCPClient, remote_dir: str, logfilename: str, local_dir: str):
-    desired_patterns = get_desired_log_patterns(logfilename)
+# lists the logfiles of every wanted logtype in remote_dir with one remote command, then plans their downloads
+def plan_desired_logs(client: paramiko.SSHClient, remote_dir: str, logtype_to_filename: list[tuple[str, str]], local_dir: str):
     remote_basedir = f'{cluster_dir_on_fuse}/{fuse_date}/{remote_dir}'
-    print(f'remote_dir={remote_dir}, desired_patterns={desired_patterns}, local_dir={local_dir}')
-    ls_command = f'cd {remote_basedir}; ls ' + ' '.join(desired_patterns)
-    output = paramiko_utils.run(client, ls_command)
-    logfiles = [l for l in output.split() if l]
-    print(f'logfiles=[{logfiles}]')
+    listings = [(logtype, 'ls ' + ' '.join(get_desired_log_patterns(filename))) for logtype, filename in logtype_to_filename if logtype in logtypes]
+    print(f'remote_dir={remote_dir}, listings={listings}, local_dir={local_dir}')
+    files_by_logtype = collect_utils.list_remote_files(client, remote_basedir, listings)
+    logfiles = [f for logtype, _ in listings for f in files_by_logtype.get(logtype, [])]
+    total_size = sum(f.size for f in logfiles)
+    print(f'logfiles=[{[f.name for f in logfiles]}], total size: {collect_utils.format_size(total_size)}')
+
+    def add(size: int, fn, name: str):
+        scheduler.add(size, [remote_dir], remote_dir, fn, name=name)
+
+    if grep_mode:
+        # nothing is downloaded, only the matching lines are streamed back
+        def grep(throttle):
+            for filename, line in collect_utils.remote_grep(client, remote_basedir, [f.name for f in logfiles], args.grep, grep_services, time_window):
+                write_grep_line(f'{cluster}/{remote_dir}/{filename}: {line}')
+        add(total_size, grep, f'grep in {len(logfiles)} files')
+        return
+    if time_window:
+        # slices of the logs are not the same as the files, so they're not put into the store
+        for logfile in logfiles:
+            def download_slice(throttle, logfile=logfile):
+                print(f'Downloading lines between [{time_window[0]}] and [{time_window[1]}] from {remote_dir}/{logfile.name} ...')
+                local_filepath = collect_utils.download_time_window(client, remote_basedir, logfile, *time_window, local_dir, decompress=not args.keep_compressed, throttle=throttle)
+                if local_filepath:
+                    # it's decompressed already (if it had to be), only for the index
+                    decompressor.submit(local_filepath)
+            add(logfile.size, download_slice, logfile.name)
+        return
+    if store:
+        # fuse days are stored under the cluster, like: <store>/<cluster>/<fuse_date>/fb1
+        def fetch(throttle):
+            local_filepaths, num_downloaded = store.fetch(client, cluster, f'{fuse_date}/{remote_dir}', remote_basedir, logfiles, local_dir, bundle=args.bundle, throttle=throttle)
+            print(f'{remote_dir}: {num_downloaded} files downloaded, {len(logfiles) - num_downloaded} reused from the store')
+            for local_filepath in local_filepaths:
+                decompressor.submit(local_filepath)
+        add(sum(f.size for f in logfiles if not store.is_stored(cluster, f'{fuse_date}/{remote_dir}', remote_basedir, f)), fetch, f'{len(logfiles)} files via the store')
+        return
+    if args.bundle:
+        def download_bundle(throttle):
+            print(f'Downloading {len(logfiles)} files from {remote_dir} as a bundle ...')
+            local_filepaths = collect_utils.download_bundle(client, remote_basedir, [f.name for f in logfiles], local_dir, decompress=not args.keep_compressed, throttle=throttle)
+            # they're decompressed already (if they had to be), only for the index
+            for local_filepath in local_filepaths:
+                decompressor.submit(local_filepath)
+        add(total_size, download_bundle, f'bundle of {len(logfiles)} files')
+        return
     for logfile in logfiles:
-        download_file(scp, f'{remote_basedir}/{logfile}', local_dir)
+        def download(throttle, logfile=logfile):
+            download_file(client, f'{remote_basedir}/{logfile.name}', local_dir, throttle)
+        add(logfile.size, download, logfile.name)
 
 
 fm_logtype_to_filename = [
@@ -165,49 +295,106 @@ blade_logtype_to_filename = [
 
 print(f'\n-------- Collecting logs from CLUSTER=[{cluster}] --------\n')
 
-def download_fm_logs(scp, logdirs):
+# returns the FM dirs to list: [(remote dir, logtype_to_filename)]
+def fm_dirs_to_list(logdirs) -> list[tuple[str, list]]:
     want_fm_logs = any(lt in logtypes for lt, _ in fm_logtype_to_filename)
     if not want_fm_logs:
-        return
+        return []
 
     fm_dirs = [d for d in logdirs if re.search(r'fm[12]$', d)]
     print(f'fm_dirs=[{fm_dirs}]')
-    for fm in fm_dirs:
-        local_fm_dir = os.path.join(logdir, fm)
-        os.mkdir(local_fm_dir)
-        print(f'collecting from FM: {fm}')
-        for logtype, filename in fm_logtype_to_filename:
-            if logtype in logtypes:
-                download_desired_logs(client, scp, fm, filename, local_fm_dir)
-
-def download_blade_logs(scp, logdirs):
+    return [(fm, fm_logtype_to_filename) for fm in fm_dirs]
+
+# returns the blade dirs to list: [(remote dir, logtype_to_filename)]
+def blade_dirs_to_list(logdirs) -> list[tuple[str, list]]:
     want_blade_logs = any(lt in logtypes for lt, _ in blade_logtype_to_filename)
     if not want_blade_logs:
-        return
+        return []
 
     blade_dirs = [d for d in logdirs if re.search(r'fb[0-9]+$', d)]
     print(f'blade_dirs=[{blade_dirs}]')
-    for blade in blade_dirs:
-        local_blade_dir = os.path.join(logdir, blade)
-        os.mkdir(local_blade_dir)
-        print(f'collecting from BLADE: {blade}')
-        for logtype, filename in blade_logtype_to_filename:
-            if logtype in logtypes:
-                download_desired_logs(client, scp, blade, filename, local_blade_dir)
-
+    return [(blade, blade_logtype_to_filename) for blade in blade_dirs]
+
+# lists the dirs (jobs at the same time) and plans their downloads, the downloads of a dir start as soon as it's listed
+def plan_dirs(dirs: list[tuple[str, list]]):
+    def plan_dir(remote_dir: str, logtype_to_filename: list):
+        local_dir = os.path.join(logdir, remote_dir)
+        os.mkdir(local_dir)
+        print(f'collecting from: {remote_dir}')
+        plan_desired_logs(client, remote_dir, logtype_to_filename, local_dir)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(plan_dir, remote_dir, logtype_to_filename): remote_dir for remote_dir, logtype_to_filename in dirs}
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception():
+                print(f'Error: listing {futures[future]} FAILED: {future.exception()!r}')
+
+# the overall progress and the progress of the dirs which are not done yet, like:
+#   [progress] 45% 1.2 GB/2.6 GB, 12.3 MB/s, ETA 1m55s, 20/72 transfers done, 4 running
+#   [dirs] 3/10 done, fb4 60% (3/5 files), fb5 10% (0/5 files)
+def report_progress(line: str):
+    progress = scheduler.tag_progress()
+    done = [d for d, p in progress.items() if p['done'] == p['transfers']]
+    in_progress = [f'{d} {100 * p["bytes"] / p["size"] if p["size"] else 0:.0f}% ({p["done"]}/{p["transfers"]} files)'
+                   for d, p in progress.items() if p['done'] < p['transfers'] and (p['done'] or p['bytes'])]
+    print(line)
+    print(f'[dirs] {len(done)}/{len(progress)} done' + ''.join(f', {d}' for d in in_progress))
+
+# for collect-report.json: how long the planning, the downloads and the decompression took
+phases = {}
 with connect_via_ssh_config(fuse_server) as client:
-    scp = SCPClient(client.get_transport())
+    start_time = time.monotonic()
     logdirs_str = paramiko_utils.run(client, f'cd {cluster_dir_on_fuse}/{fuse_date}; ls')
     logdirs = logdirs_str.split()
     print(f'logdirs=[{logdirs}]')
-
-    download_fm_logs(scp, logdirs)
-    download_blade_logs(scp, logdirs)
-
-print(f'decompressing every .zst file we downloaded in logdir=[{logdir}] ...')
-subprocess.run(["find", logdir, "-name", "*.zst", "-exec", "sh", "-c", 'zstd -d "{}"; rm -f "{}"', ";"])
+    dirs = fm_dirs_to_list(logdirs) + blade_dirs_to_list(logdirs)
+
+    # the listing and the downloads overlap, so the planning is the time until the last dir was listed
+    def planner():
+        plan_dirs(dirs)
+        phases['planning'] = time.monotonic() - start_time
+        print(f'\nplanned downloads: {collect_utils.format_size(scheduler.planned_size)} in {sum(p["transfers"] for p in scheduler.tag_progress().values())} transfers')
+    failures = scheduler.run(report_progress=report_progress, planner=planner)
+    for remote_dir, e in failures:
+        print(f'Error: download from {remote_dir} FAILED: {e!r}')
+    phases['downloads'] = time.monotonic() - start_time
+
+print(f'waiting for the decompression of the .zst files we downloaded in logdir=[{logdir}] ...')
+failed_decompressions = decompressor.wait()
+if failed_decompressions:
+    print(f'Error: could not decompress: {failed_decompressions}')
+phases['decompression_wait'] = decompressor.stats['wait_seconds']
+if indexer:
+    print('waiting for the indexing of the logs ...')
+    start_time = time.monotonic()
+    failed_indexing = indexer.wait()
+    if failed_indexing:
+        print(f'Error: could not index: {failed_indexing}')
+    phases['index_wait'] = time.monotonic() - start_time
+if 'atop_blades' in logtypes:
+    # in its own process: it forks worker processes, which must not inherit the threads of paramiko
+    print('converting the atop files of the blades ...')
+    start_time = time.monotonic()
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'atop_store.py'), 'ingest', logdir])
+    phases['atop_ingest'] = time.monotonic() - start_time
+if 'middleware_db_dump' in logtypes:
+    print(f'loading the middleware DB dumps into {os.path.join(logdir, middleware_db.DB_FILENAME)} ...')
+    start_time = time.monotonic()
+    failed_db_loads = middleware_db.load(logdir)
+    if failed_db_loads:
+        print(f'Error: could not load: {failed_db_loads}')
+    phases['db_load'] = time.monotonic() - start_time
+
+report = collect_utils.build_report(scheduler, decompressor, phases, {'cluster': cluster, 'date': date, 'failed_decompressions': failed_decompressions})
+collect_utils.write_report(os.path.join(logdir, 'collect-report.json'), report)
+print('\n'.join(collect_utils.report_summary(report)))
+if store:
+    store.close()
+if grep_file:
+    grep_file.close()
+    print(f'matching lines are in {os.path.join(logdir, "grep.log")}')
 
 print(f'logdir=[{logdir}]')
-subprocess.run(['cluster-info.sh'], cwd=logdir)
+cluster_info_scan.wait()
+print(f'cluster info: {os.path.join(logdir, cluster_info.CLUSTER_INFO_FILENAME)}')
 
 print(f'Directory in which the logs are downloaded: {logdir}')
@@ -1,14 +1,26 @@
 import argparse
+import concurrent.futures
+import contextlib
 import datetime
 import os
 import re
-import subprocess
 import shutil
+import subprocess
+import sys
+import threading
+import time
 from scp import SCPClient
 
+import cluster_info
+import collect_utils
+import log_follow
+import log_index
+import middleware_db
 import paramiko_utils
 
 LOGTYPES_DEFAULT_ARG="middleware,platform,nfs,platform_blades"
+# the lines of ir_test.log with a failed/errored test or an exception
+DEFAULT_TRIGGER = r'\bFAILED\b|\bERROR\b|Traceback'
 
 parser = argparse.ArgumentParser(
                     prog='collect.py',
@@ -39,8 +51,46 @@ only irpXXX-cXX... directory will be created but no parents (for safety consider
 parser.add_argument('-n', '--num', type=int, help=f'collect only the last <number> of logfiles')
 parser.add_argument('--min-date', type=str, help='the minimum hour we need data for (format: YYYY-MM-DD.HH)')
 parser.add_argument('--max-date', type=str, help='the maximum date we need data for (format: YYYY-MM-DD.HH)')
+parser.add_argument('--since', type=str, help='download only the lines after this time (format: "YYYY-MM-DD HH:MM[:SS]"), the filtering is done on the FMs/blades')
+parser.add_argument('--until', type=str, help='download only the lines until this time, inclusive (format: "YYYY-MM-DD HH:MM[:SS]", HH:MM means the end of that minute), use together with --since')
+parser.add_argument('--grep', type=str, help='do not download the logs, only print the lines matching this (extended) regex, the grep is done on the FMs/blades')
+parser.add_argument('--service', type=str, help='do not download the logs, only print the lines of these services (separated by comma, ex. "replication::replica_link_manager,replication.client")')
+parser.add_argument('--follow', action='store_true', default=False, help='''\
+do not download the logs, follow them (tail -F) on every FM/blade and print the new lines merged by time (stop with Ctrl-C),
+the lines can be filtered with --grep and --service (on the FMs/blades), they're written into follow.log in the log pack too''')
+parser.add_argument('--follow-delay', type=float, default=1, help='with --follow: the lines are held back for this many seconds, so the lines of slower hosts still get into their place (default: 1)')
+parser.add_argument('--follow-buffer', type=float, default=4, help='with --follow: max. this many MBs of lines are held back per log, a log is not read while it is full (default: 4)')
+parser.add_argument('--watch', type=str, nargs='?', const='ir_test.log', help='''\
+do not download the logs now, watch ir_test.log (or this file) and when a line matches --trigger, download the time window
+around it from every FM/blade right away (before the logs are rotated), into a log pack under the log pack of the watch,
+the connections are opened at the start and kept open until Ctrl-C.
+The timestamp of the line is taken as UTC, the clock of the FM/blade logs (a line without timestamp triggers at the current UTC time)''')
+parser.add_argument('--trigger', type=str, default=DEFAULT_TRIGGER, help=f'with --watch: the (python) regex of the lines which trigger a capture (default: "{DEFAULT_TRIGGER}")')
+parser.add_argument('--capture-before', type=float, default=10, help='with --watch: the captured window starts this many minutes before the trigger (default: 10)')
+parser.add_argument('--capture-after', type=float, default=0, help='with --watch: the captured window ends this many minutes after the trigger, the capture waits for it (default: 0)')
+parser.add_argument('--debounce', type=float, default=600, help='''\
+with --watch: the triggers within this many seconds after the start of a capture (or while it's running) don't start a new one,
+they're only added to its triggers.log (default: 600)''')
+parser.add_argument('--keepalive', type=float, default=60, help='with --watch: a command is run on every FM/blade this often (seconds), to keep the connections alive (default: 60)')
 parser.add_argument('--i-want-a-lot', action='store_true', default=False, help='acknowledge that I want to download a lot of data (without this max. 5 logs are allowed each log type)')
 parser.add_argument('--only-few-blades', action='store_true', default=False, help='download logs only from the first 3 blades')
+parser.add_argument('--bundle', action='store_true', default=False, help='download the logs of each FM/blade as one tar stream instead of file by file')
+parser.add_argument('--keep-compressed', action='store_true', default=False, help='do not decompress the downloaded .zst files (use zstdcat/zstdgrep/zstdless on them)')
+parser.add_argument('--index', action='store_true', default=False, help='index the logs by time and service while they are downloaded (see log_index.py query)')
+parser.add_argument('--store', type=str, nargs='?', const=collect_utils.DEFAULT_STORE_DIR, help=f'''\
+keep the downloaded logs in a local store too (default: {collect_utils.DEFAULT_STORE_DIR}),
+files which did not change since the last run are not downloaded again, only linked from the store''')
+parser.add_argument('--refresh-topology', action='store_true', default=False, help='do not use the cached topology (FM IPs, blades) of the clusters, discover it again')
+parser.add_argument('--topology-ttl', type=float, default=12, help='how many hours the cached topology of a cluster is used (default: 12)')
+parser.add_argument('-j', '--jobs', type=int, default=4, help='number of downloads running in parallel (default: 4), the largest files are downloaded first')
+parser.add_argument('--channels-per-host', type=int, default=2, help='max. number of downloads from the same FM/blade at the same time (default: 2)')
+parser.add_argument('--fm-channels', type=int, default=4, help='''\
+max. number of downloads going through the standby FM at the same time (default: 4),
+every blade log is tunneled through it, and it serves production traffic too''')
+parser.add_argument('--bandwidth', type=float, help='max. bandwidth of all the downloads together (MB/s)')
+parser.add_argument('--fm-bandwidth', type=float, help='max. bandwidth going through the standby FM of a cluster (MB/s)')
+parser.add_argument('--retries', type=int, default=1, help='how many times a failed download is tried again (default: 1)')
+parser.add_argument('--max-size', type=float, default=10, help='if more than this (GB) would be downloaded, nothing is downloaded without --i-want-a-lot (default: 10)')
 
 args = parser.parse_args()
 
@@ -72,12 +122,51 @@ print(f'number_of_logfiles = {number_of_logfiles}')
 if number_of_logfiles:
     assert number_of_logfiles <= 5 or i_want_a_lot, "if you want more than 5 logfiles each log type, please specify --i-want-a-lot"
 
+jobs=args.jobs
+print(f'jobs = {jobs}')
+assert jobs > 0, 'jobs should be at least 1'
+
+channels_per_host=args.channels_per_host
+fm_channels=args.fm_channels
+print(f'channels_per_host = {channels_per_host}, fm_channels = {fm_channels}')
+assert channels_per_host > 0 and fm_channels > 0, 'channels should be at least 1'
+
+bandwidth=args.bandwidth
+fm_bandwidth=args.fm_bandwidth
+print(f'bandwidth = {bandwidth} MB/s, fm_bandwidth = {fm_bandwidth} MB/s')
+
+max_size=args.max_size
+print(f'max_size = {max_size} GB')
+
+retries=args.retries
+print(f'retries = {retries}')
+
+bundle=args.bundle
+print(f'bundle = {bundle}')
+
+keep_compressed=args.keep_compressed
+print(f'keep_compressed = {keep_compressed}')
+
+store = collect_utils.LogStore(args.store) if args.store else None
+print(f'store = {args.store}')
+
+refresh_topology=args.refresh_topology
+print(f'refresh_topology = {refresh_topology}')
+topology_cache = collect_utils.TopologyCache(collect_utils.DEFAULT_TOPOLOGY_CACHE, ttl=args.topology_ttl*3600)
+
 def generate(min_date, max_date):
     d = min_date
     while d <= max_date:
         yield d
         d += datetime.timedelta(hours=1)
 
+# the hours of the rotated files of a time window, with one more hour on both sides, in case a file
+# has some lines from the previous/next hour (only the lines in the window are downloaded anyway)
+def hour_patterns(since: datetime.datetime, until: datetime.datetime) -> list[str]:
+    first_hour = since.replace(minute=0, second=0, microsecond=0) - datetime.timedelta(hours=1)
+    last_hour = until.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+    return [d.strftime('%Y-%m-%d.%H') for d in generate(first_hour, last_hour)]
+
 min_date_str = args.min_date
 max_date_str = args.max_date
 date_patterns = []
@@ -108,6 +197,43 @@ if min_date_str or max_date_str:
         date_patterns.append(d.strftime('%Y-%m-%d.%H'))
     print(date_patterns)
 
+since_str = args.since
+until_str = args.until
+time_window = None
+
+if since_str or until_str:
+    if not (since_str and until_str):
+        print('Error: both --since and --until has to be provided!')
+        exit(1)
+    if number_of_logfiles or min_date_str or max_date_str:
+        print('Error: --since and --until can not be used together with --num or --min-date/--max-date')
+        exit(1)
+    since = collect_utils.parse_time(since_str)
+    until = collect_utils.parse_until(until_str)
+    print(f'since = {since}, until = {until}')
+    assert since <= until, 'since should be before until'
+    assert until - since <= datetime.timedelta(hours=4) or i_want_a_lot, 'time window is too big, please specify --i-want-a-lot if you are serious'
+    time_window = (since, until)
+    date_patterns = hour_patterns(since, until)
+    print(date_patterns)
+
+grep_pattern = args.grep
+grep_services = args.service.split(',') if args.service else None
+grep_mode = bool(grep_pattern or grep_services)
+print(f'grep_pattern = {grep_pattern}, grep_services = {grep_services}')
+
+follow = args.follow
+print(f'follow = {follow}')
+
+watch_filepath = args.watch
+print(f'watch = {watch_filepath}')
+if watch_filepath:
+    if follow or grep_mode or time_window or number_of_logfiles or date_patterns:
+        print('Error: --watch can not be used together with --follow, --grep/--service, --since/--until, --num or --min-date/--max-date')
+        exit(1)
+    trigger_re = re.compile(args.trigger)
+    print(f'trigger = {args.trigger}, capture window: -{args.capture_before} / +{args.capture_after} minutes, debounce = {args.debounce}s')
+
 current_time=datetime.datetime.now()
 toplevel_logdir=clusters[0] + '_' + current_time.strftime('%F-T%H-%M-%S')
 if dir_prefix:
@@ -115,9 +241,132 @@ if dir_prefix:
 
 os.makedirs(toplevel_logdir)
 
-def download_file(scp, remote_filepath: str, local_filepath: str):
-    print(f'Downloading: {remote_filepath} ...')
+print_lock = threading.Lock()
+log_context = threading.local()
+
+# clusters and blades are downloaded on multiple threads, so lines are printed under a lock
+# to keep them from getting mixed up, and prefixed with the cluster the thread works on
+def log(msg: str):
+    cluster = getattr(log_context, 'cluster', None)
+    if cluster:
+        msg = f'[{cluster}] {msg}'
+    with print_lock:
+        print(msg, flush=True)
+
+# the logfiles are indexed while the others are downloaded (after the decompression of the .zst files)
+indexer = log_index.LogIndexer(toplevel_logdir) if args.index else None
+# the nfs.logs are searched for the portal blades while the others are downloaded
+cluster_info_scan = cluster_info.ClusterInfo(toplevel_logdir)
+
+def on_file_done(filepath: str):
+    cluster_info_scan.submit(filepath)
+    if indexer:
+        indexer.submit(filepath)
+
+# .zst files are decompressed in the background while the other downloads are going on
+decompressor = collect_utils.Decompressor(enabled=not keep_compressed, on_done=on_file_done)
+
+def download_file(client, remote_filepath: str, local_filepath: str, throttle: collect_utils.Throttle):
+    log(f'Downloading: {remote_filepath} ...')
+    received = 0
+    # scp reports the progress after every chunk, that's where the download is throttled
+    def progress(filename, size, sent):
+        nonlocal received
+        throttle.consume(sent - received)
+        received = sent
+    scp = SCPClient(client.get_transport(), progress=progress)
     scp.get(remote_path=remote_filepath, local_path=local_filepath, preserve_times=True)
+    decompressor.submit(os.path.join(local_filepath, os.path.basename(remote_filepath)))
+
+# the matching lines are written into the log pack too
+grep_file = open(os.path.join(toplevel_logdir, 'grep.log'), 'w') if grep_mode and not follow else None
+
+def write_grep_line(line: str):
+    with print_lock:
+        print(line, flush=True)
+        grep_file.write(line + '\n')
+
+# every download is planned first (with the size of the files), and only then they're run by the scheduler,
+# largest first, within the limits of channels per host and bandwidth (see TransferScheduler)
+# (a failed grep is not retried, the lines it found before the failure would be printed again)
+scheduler = collect_utils.TransferScheduler(workers=jobs, max_channels_per_host=channels_per_host,
+                                            bandwidth=bandwidth * 1024 * 1024 if bandwidth else None,
+                                            retries=0 if grep_mode else retries)
+
+# Plans the downloads of the logfiles of one FM/blade.
+# hosts: the hosts the downloads go through (for the limits of the scheduler)
+# connect: returns a context manager with the client of the host, it's called when the download is run,
+# the connection is taken from the pool, so it's the same as the one we listed the files with
+def plan_downloads(connect, hosts: list[str], cluster: str, hostname: str, logfiles: list[collect_utils.RemoteFile], local_dir: str):
+    def add(size: int, fn, name: str):
+        # the downloads run on the threads of the scheduler, the lines they log are prefixed with the cluster too
+        def run(throttle):
+            log_context.cluster = cluster
+            fn(throttle)
+        scheduler.add(size, hosts, (cluster, hostname), run, name=name)
+
+    if grep_mode:
+        # nothing is downloaded, only the matching lines are streamed back, but the whole files are read on the remote
+        def grep(throttle):
+            with connect() as client:
+                for filename, line in collect_utils.remote_grep(client, '/logs', [f.name for f in logfiles], grep_pattern, grep_services, time_window):
+                    write_grep_line(f'{cluster}/{hostname}/{filename}: {line}')
+        add(sum(f.size for f in logfiles), grep, f'grep in {len(logfiles)} files')
+        return
+    if time_window:
+        # slices of the logs are not the same as the files, so they're not put into the store
+        # (the size of the whole file is planned, although only a slice of it is downloaded)
+        for logfile in logfiles:
+            def download_slice(throttle, logfile=logfile):
+                log(f'[{hostname}] Downloading lines between {time_window[0]} and {time_window[1]} from {logfile.name} ...')
+                with connect() as client:
+                    local_filepath = collect_utils.download_time_window(client, '/logs', logfile, *time_window, local_dir, decompress=not keep_compressed, throttle=throttle)
+                if local_filepath:
+                    # it's decompressed already (if it had to be), only for the index
+                    decompressor.submit(local_filepath)
+            add(logfile.size, download_slice, logfile.name)
+        return
+    if store:
+        missing = [f for f in logfiles if not store.is_stored(cluster, hostname, '/logs', f)]
+        # the ones in the store are only linked into the log pack, that needs no transfer
+        with connect() as client:
+            fetch_from_store(client, cluster, hostname, [f for f in logfiles if f not in missing], local_dir)
+        log(f'[{hostname}] {len(logfiles) - len(missing)} files reused from the store, {len(missing)} to download')
+        if bundle:
+            def fetch_bundle(throttle):
+                with connect() as client:
+                    fetch_from_store(client, cluster, hostname, missing, local_dir, throttle=throttle)
+            if missing:
+                add(sum(f.size for f in missing), fetch_bundle, f'bundle of {len(missing)} files')
+            return
+        for logfile in missing:
+            def fetch(throttle, logfile=logfile):
+                log(f'Downloading: /logs/{logfile.name} ...')
+                with connect() as client:
+                    fetch_from_store(client, cluster, hostname, [logfile], local_dir, throttle=throttle)
+            add(logfile.size, fetch, logfile.name)
+        return
+    if bundle:
+        def download_bundle(throttle):
+            log(f'[{hostname}] Downloading {len(logfiles)} files as a bundle ...')
+            with connect() as client:
+                local_filepaths = collect_utils.download_bundle(client, '/logs', [f.name for f in logfiles], local_dir, decompress=not keep_compressed, throttle=throttle)
+            # they're decompressed already (if they had to be), only for the index
+            for local_filepath in local_filepaths:
+                decompressor.submit(local_filepath)
+        if logfiles:
+            add(sum(f.size for f in logfiles), download_bundle, f'bundle of {len(logfiles)} files')
+        return
+    for logfile in logfiles:
+        def download(throttle, logfile=logfile):
+            with connect() as client:
+                download_file(client, '/logs/'+logfile.name, local_dir, throttle)
+        add(logfile.size, download, logfile.name)
+
+def fetch_from_store(client, cluster: str, hostname: str, logfiles: list[collect_utils.RemoteFile], local_dir: str, throttle: collect_utils.Throttle = None):
+    local_filepaths, num_downloaded = store.fetch(client, cluster, hostname, '/logs', logfiles, local_dir, bundle=bundle, throttle=throttle)
+    for local_filepath in local_filepaths:
+        decompressor.submit(local_filepath)
 
 print('collecting FM IPs')
 cluster_fm_ips = []
@@ -129,15 +378,47 @@ def generate_ls_pattern(logfilename: str):
         else:
             return f'ls {logfilename}* -tr | tail --lines {number_of_logfiles}'
     else:
-        # if there's no number_of_logfiles set, that means we're using --min-date & --max-date,
+        # if there's no number_of_logfiles set, that means we're using --min-date & --max-date (or --since & --until),
         # so we're relying on date pattern
+        if not date_patterns:
+            # neither --num nor dates, eg. for --grep: every logfile of this type
+            return f'ls {logfilename} {logfilename}.* -tr'
         res = 'ls'
+        if time_window:
+            # the time window can be in the logfile which is not rotated yet
+            res += f' {logfilename}'
         for d in date_patterns:
             res += f' {logfilename}.{d}*'
         return res
 
-def add_fs_list(existing_list: list[str], new_list: list[str]):
-    [existing_list.append(s) for s in new_list if s]
+fm_logtype_to_filename = [
+    ('middleware', 'middleware.log'),
+    ('middleware_db_dump', 'middleware_db_dump'),
+    ('platform', 'platform.log'),
+    ('system', 'system.log'),
+    ('congo', 'congo.log'),
+    ('fusiond_grpc_msgs', 'fusiond_grpc_msgs.log'),
+]
+
+blade_logtype_to_filename = [
+    ('nfs', 'nfs.log'),
+    ('platform_blades', 'platform.log'),
+    ('system_blades', 'system.log'),
+    ('haproxy_blades', 'haproxy.log'),
+    ('congo_blades', 'congo.log'),
+    ('http', 'http.log'),
+    ('atop_blades', 'atop_raw.log'),
+    ('fusiond_grpc_msgs', 'fusiond_grpc_msgs.log'),
+]
+
+# lists the logfiles of every wanted logtype in /logs with only one remote command
+def list_logfiles(client, hostname: str, logtype_to_filename: list[tuple[str, str]]) -> list[collect_utils.RemoteFile]:
+    listings = [(logtype, generate_ls_pattern(filename)) for logtype, filename in logtype_to_filename if logtype in logtypes]
+    files_by_logtype = collect_utils.list_remote_files(client, '/logs', listings)
+    logfiles = [f for logtype, _ in listings for f in files_by_logtype.get(logtype, [])]
+    total_size = sum(f.size for f in logfiles)
+    log(f'[{hostname}] logfiles = {[f.name for f in logfiles]}, total size: {collect_utils.format_size(total_size)}')
+    return logfiles
 
 # input is coming from 'pureblade list' like
 # CH1.FB1
@@ -167,114 +448,465 @@ def get_bladelist(bladelist_str: list[str]) -> list[str]:
         result = [f'ch{n[0]}-fb{n[1]}' for n in num_tuples]
     return result
 
+# returns the client of the FM, or of the blade through the FM (the connections are taken from the pool)
+@contextlib.contextmanager
+def connect_host(cluster: str, fm_ip: str, bladename: str = None):
+    with pool.connectWithPassword(None, fm_ip, username="ir", password=get_password(cluster), look_for_keys=False) as client_fm:
+        if not bladename:
+            yield client_fm
+            return
+        # the key is the same for every blade, the pool reads it via sftp only once
+        key = pool.getKey(client_fm, "/home/ir/.ssh/id_rsa")
+        with pool.connectWithKey(client_fm, f'{bladename}', username="ir", key=key) as client_blade:
+            yield client_blade
+
+# every blade gets its own nested session (a direct-tcpip channel) on the transport of the standby FM,
+# so this can be called from multiple threads for the same FM
+def plan_blade_downloads(cluster: str, standby_ip: str, bladename: str):
+    log_context.cluster = cluster
+    log(f'cluster={cluster}, blade={bladename}')
+    connect = lambda: connect_host(cluster, standby_ip, bladename)
+    with connect() as client_blade:
+        logfiles = list_logfiles(client_blade, bladename, blade_logtype_to_filename)
+    local_blade_dir = os.path.join(toplevel_logdir, cluster, f'{bladename}')
+    os.makedirs(local_blade_dir)
+    # everything from the blade goes through the standby FM too
+    plan_downloads(connect, [f'{cluster}/{bladename}', f'{cluster}/{standby_ip}'], cluster, bladename, logfiles, local_blade_dir)
+    return logfiles
+
 clusters_w_qa1_pass = ['batman', 'newt', 'artemis']
 clusters_w_qa2_pass = ['krtek']
 # getting passwords from env vars, because I don't want to put them in version control
 pw_qa1=os.environ['PASSWORD_QA1']
 pw_qa2=os.environ['PASSWORD_QA2']
 pw_simple=os.environ['PASSWORD_SIMPLE']
-for cluster in clusters:
+
+def get_password(cluster: str) -> str:
     if cluster in clusters_w_qa1_pass:
-        pw = pw_qa1
+        return pw_qa1
     elif cluster in clusters_w_qa2_pass:
-        pw = pw_qa2
+        return pw_qa2
     else:
-        pw = pw_simple
+        return pw_simple
+
+# which FM is the master right now (1 or 2), the purity CLI runs on both FMs
+def get_master_fm(client) -> int:
+    master_fm = int(paramiko_utils.run(client, "puremastership list | grep master | cut -d'M' -f2 | cut -c1-1"))
+    assert master_fm in (1, 2), f'master_fm should be 1 or 2, but is {master_fm}'
+    return master_fm
 
-    ip1 = ''
-    ip2 = ''
-    master_fm = 0
-    with paramiko_utils.agentNestedConnectWithPassword(None, cluster, username="ir", password=pw, look_for_keys=False) as client:
+# asks the cluster for its FM IPs, master FM and blades
+def discover_topology(cluster: str, pw: str) -> dict:
+    log('discovering topology')
+    with pool.connectWithPassword(None, cluster, username="ir", password=pw, look_for_keys=False) as client:
         ip1 = paramiko_utils.run(client, f"purenetwork list --csv | grep 'fm1.admin0,' | cut -d',' -f5")
         ip2 = paramiko_utils.run(client, f"purenetwork list --csv | grep 'fm2.admin0,' | cut -d',' -f5")
-        master_fm = int(paramiko_utils.run(client, "puremastership list | grep master | cut -d'M' -f2 | cut -c1-1"))
-    assert master_fm in (1, 2), f'master_fm should be 1 or 2, but is {master_fm}'
+        master_fm = get_master_fm(client)
     assert ip1, 'ip1 is empty'
     assert ip2, 'ip2 is empty'
 
+    standby_ip = (ip1, ip2)[0 if master_fm == 2 else 1]
+    with pool.connectWithPassword(None, standby_ip, username="ir", password=pw, look_for_keys=False) as client_fm:
+        bladelist_str = paramiko_utils.run(client_fm, "pureblade list --notitle | grep -v unused | cut -d' ' -f1")
+    assert bladelist_str, f'bladelist is empty, bladelist_str={bladelist_str}'
+    return {
+        'fm_ips': [ip1, ip2],
+        'master_fm': master_fm,
+        # chassis layout, like ['CH1.FB1', 'CH1.FB2', ...]
+        'blade_slots': bladelist_str.split('\n'),
+        'blades': get_bladelist(bladelist_str),
+    }
+
+# returns the topology from the cache if we have it, otherwise discovers it
+def get_topology(cluster: str, pw: str) -> dict:
+    topology = None if refresh_topology else topology_cache.get(cluster)
+    if topology:
+        log(f'using cached topology: {topology}')
+        try:
+            # these connections are needed for the downloads anyway (they stay in the pool),
+            # so it costs nothing to check that the cached IPs are still valid
+            for ip in topology['fm_ips']:
+                with pool.connectWithPassword(None, ip, username="ir", password=pw, look_for_keys=False):
+                    pass
+            # mastership can fail over at any time, so it is never taken from the cache,
+            # asking it is one more command on a connection that is already open
+            with pool.connectWithPassword(None, topology['fm_ips'][0], username="ir", password=pw, look_for_keys=False) as client:
+                topology['master_fm'] = get_master_fm(client)
+            log(f'master FM: {topology["master_fm"]}')
+            return topology
+        except Exception as e:
+            log(f'could not use the cached topology ({e!r}), discovering the topology again')
+            topology_cache.invalidate(cluster)
+    topology = discover_topology(cluster, pw)
+    # only the stable parts are cached
+    topology_cache.put(cluster, {key: value for key, value in topology.items() if key != 'master_fm'})
+    return topology
+
+# lists every log of one cluster and plans their downloads, returns some numbers for the summary
+def plan_cluster(cluster: str) -> dict:
+    log_context.cluster = cluster
+    result = {'fm_logfiles': 0, 'blades': 0, 'failed_blades': [], 'failed_fms': [], 'size': 0}
+    pw = get_password(cluster)
+
+    topology = get_topology(cluster, pw)
+    # the VIP, the 2 FMs and every blade (through the standby FM) on top of the default size of the pool,
+    # so no connection is evicted (and connected again) while the downloads of the other hosts run
+    pool.reserve(3 + len(topology['blades']))
+    ip1, ip2 = topology['fm_ips']
+    master_fm = topology['master_fm']
+    # using standby_fm because it's less loaded
+    # standby_fm is indexed from 0!
+    standby_fm = 0 if master_fm == 2 else 1
+    standby_ip = (ip1, ip2)[standby_fm]
+    # the standby FM serves production traffic too, and every blade log is tunneled through it,
+    # so it gets fewer channels (and maybe less bandwidth) than the other hosts
+    scheduler.set_host_channels(f'{cluster}/{standby_ip}', fm_channels)
+    if fm_bandwidth:
+        scheduler.set_host_bandwidth(f'{cluster}/{standby_ip}', fm_bandwidth * 1024 * 1024)
+
     if want_fm_logs:
-        for ip in (ip1, ip2):
-            fm_num = 1 if ip is ip1 else 2
+        for fm_num, ip in enumerate((ip1, ip2), start=1):
             fm_dir = os.path.join(toplevel_logdir, f'{cluster}_sup{fm_num}_{ip}')
-            print(f'fm_num={fm_num}, ip={ip}, fm_dir={fm_dir}')
+            log(f'fm_num={fm_num}, ip={ip}, fm_dir={fm_dir}')
 
             os.makedirs(fm_dir)
-            with paramiko_utils.agentNestedConnectWithPassword(None, ip, username="ir", password=pw, look_for_keys=False) as client_fm:
-                logfiles = []
-                if 'middleware' in logtypes:
-                    logfiles_str = paramiko_utils.run(client_fm, f'cd /logs; ' + generate_ls_pattern('middleware.log'))
-                    add_fs_list(logfiles, logfiles_str.split('\n'))
-                if 'middleware_db_dump' in logtypes:
-                    logfiles_str = paramiko_utils.run(client_fm, f'cd /logs; ' + generate_ls_pattern('middleware_db_dump'))
-                    add_fs_list(logfiles, logfiles_str.split('\n'))
-                if 'platform' in logtypes:
-                    logfiles_str = paramiko_utils.run(client_fm, f'cd /logs; ' + generate_ls_pattern('platform.log'))
-                    add_fs_list(logfiles, logfiles_str.split('\n'))
-                if 'system' in logtypes:
-                    logfiles_str = paramiko_utils.run(client_fm, f'cd /logs; ' + generate_ls_pattern('system.log'))
-                    add_fs_list(logfiles, logfiles_str.split('\n'))
-                if 'congo' in logtypes:
-                    logfiles_str = paramiko_utils.run(client_fm, f'cd /logs; ' + generate_ls_pattern('congo.log'))
-                    add_fs_list(logfiles, logfiles_str.split('\n'))
-                if 'fusiond_grpc_msgs' in logtypes:
-                    logfiles_str = paramiko_utils.run(client_fm, f'cd /logs; ' + generate_ls_pattern('fusiond_grpc_msgs.log'))
-                    add_fs_list(logfiles, logfiles_str.split('\n'))
-                print(f'logfiles = {logfiles}')
-                for logfile in logfiles:
-                    scp = SCPClient(client_fm.get_transport())
-                    download_file(scp, '/logs/'+logfile, fm_dir)
+            connect = lambda ip=ip: connect_host(cluster, ip)
+            try:
+                with connect() as client_fm:
+                    logfiles = list_logfiles(client_fm, f'sup{fm_num}', fm_logtype_to_filename)
+            except Exception as e:
+                # the downloads of the other FM are already queued, they go on, like the ones of the good blades
+                log(f'sup{fm_num} FAILED: {e!r}')
+                result['failed_fms'].append(f'sup{fm_num}')
+                continue
+            plan_downloads(connect, [f'{cluster}/{ip}'], cluster, f'sup{fm_num}', logfiles, fm_dir)
+            result['fm_logfiles'] += len(logfiles)
+            result['size'] += sum(f.size for f in logfiles)
 
     if want_blade_logs:
-        # using standby_fm because it's less loaded
-        # standby_fm is indexed from 0!
-        standby_fm = 0 if master_fm == 2 else 1
-        standby_ip = (ip1, ip2)[standby_fm]
-        with paramiko_utils.agentNestedConnectWithPassword(None, standby_ip, username="ir", password=pw, look_for_keys=False) as client_fm:
-            bladelist_str = paramiko_utils.run(client_fm, "pureblade list --notitle | grep -v unused | cut -d' ' -f1")
-            bladelist = get_bladelist(bladelist_str)
-            if only_few_blades:
-                print(f'Restricting downloads to max 3 blades')
-                bladelist = bladelist[:3]
-            print(f'number of blades = {len(bladelist)}')
-            assert len(bladelist) > 0, f'bladelist is empty, bladelist_str={bladelist_str}'
-            for bladename in bladelist:
-                print(f'cluster={cluster}, blade={bladename}')
-                with paramiko_utils.nestedConnectWithKeyFromClient(client_fm, f'{bladename}', username="ir", key=paramiko_utils.getKeyFromClient(client_fm, "/home/ir/.ssh/id_rsa")) as client_blade:
-                    scp = SCPClient(client_blade.get_transport())
-                    logfiles = []
-                    if 'nfs' in logtypes:
-                        logfiles_str = paramiko_utils.run(client_blade, f'cd /logs; ' + generate_ls_pattern('nfs.log'))
-                        add_fs_list(logfiles, logfiles_str.split('\n'))
-                    if 'platform_blades' in logtypes:
-                        logfiles_str = paramiko_utils.run(client_blade, f'cd /logs; ' + generate_ls_pattern('platform.log'))
-                        add_fs_list(logfiles, logfiles_str.split('\n'))
-                    if 'system_blades' in logtypes:
-                        logfiles_str = paramiko_utils.run(client_blade, f'cd /logs; ' + generate_ls_pattern('system.log'))
-                        add_fs_list(logfiles, logfiles_str.split('\n'))
-                    if 'haproxy_blades' in logtypes:
-                        logfiles_str = paramiko_utils.run(client_blade, f'cd /logs; ' + generate_ls_pattern('haproxy.log'))
-                        add_fs_list(logfiles, logfiles_str.split('\n'))
-                    if 'congo_blades' in logtypes:
-                        logfiles_str = paramiko_utils.run(client_blade, f'cd /logs; ' + generate_ls_pattern('congo.log'))
-                        add_fs_list(logfiles, logfiles_str.split('\n'))
-                    if 'http' in logtypes:
-                        logfiles_str = paramiko_utils.run(client_blade, f'cd /logs; ' + generate_ls_pattern('http.log'))
-                        add_fs_list(logfiles, logfiles_str.split('\n'))
-                    if 'atop_blades' in logtypes:
-                        logfiles_str = paramiko_utils.run(client_blade, f'cd /logs; ' + generate_ls_pattern('atop_raw.log'))
-                        add_fs_list(logfiles, logfiles_str.split('\n'))
-                    if 'fusiond_grpc_msgs' in logtypes:
-                        logfiles_str = paramiko_utils.run(client_blade, f'cd /logs; ' + generate_ls_pattern('fusiond_grpc_msgs.log'))
-                        add_fs_list(logfiles, logfiles_str.split('\n'))
-                    print(f'logfiles = {logfiles}')
-                    local_blade_dir = os.path.join(toplevel_logdir, cluster, f'{bladename}')
-                    os.makedirs(local_blade_dir)
-                    for logfile in logfiles:
-                        scp = SCPClient(client_blade.get_transport())
-                        download_file(scp, '/logs/'+logfile, local_blade_dir)
-
-print(f"decompressing every .zst file we downloaded in toplevel_logdir=[{toplevel_logdir}] ...")
-subprocess.run(["find", toplevel_logdir, "-name", "*.zst", "-exec", "sh", "-c",  'zstd -d "{}"; rm -f "{}"', ";"])
+        bladelist = topology['blades']
+        if only_few_blades:
+            log(f'Restricting downloads to max 3 blades')
+            bladelist = bladelist[:3]
+        log(f'number of blades = {len(bladelist)}')
+        result['blades'] = len(bladelist)
+        # the listings are small, they can go in parallel (the downloads are limited by the scheduler)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(plan_blade_downloads, cluster, standby_ip, bladename): bladename for bladename in bladelist}
+            for future in concurrent.futures.as_completed(futures):
+                bladename = futures[future]
+                try:
+                    result['size'] += sum(f.size for f in future.result())
+                except Exception as e:
+                    # one bad blade should not make us lose the logs of the others
+                    log(f'blade {bladename} FAILED: {e!r}')
+                    result['failed_blades'].append(bladename)
+
+    log(f'planned {collect_utils.format_size(result["size"])} to download')
+    return result
+
+# the text logs on the FMs and blades of one cluster (to follow or to capture with --watch):
+# [(cluster, connect, hostname, the dir of the host in the log pack, if it goes through the standby FM, filenames)]
+# (middleware_db_dump and atop_raw.log are not text logs, they can't be followed or cut by time)
+def plan_text_logs(cluster: str) -> list[tuple]:
+    log_context.cluster = cluster
+    topology = get_topology(cluster, get_password(cluster))
+    ip1, ip2 = topology['fm_ips']
+    standby_ip = (ip1, ip2)[0 if topology['master_fm'] == 2 else 1]
+    fm_filenames = [f for logtype, f in fm_logtype_to_filename if logtype in logtypes and f.endswith('.log')]
+    blade_filenames = [f for logtype, f in blade_logtype_to_filename if logtype in logtypes and f != 'atop_raw.log']
+    hosts = []
+    if fm_filenames:
+        for fm_num, ip in enumerate((ip1, ip2), start=1):
+            hosts.append((lambda ip=ip: connect_host(cluster, ip), f'sup{fm_num}', f'{cluster}_sup{fm_num}_{ip}', False, fm_filenames))
+    if blade_filenames:
+        bladelist = topology['blades'][:3] if only_few_blades else topology['blades']
+        for bladename in bladelist:
+            hosts.append((lambda bladename=bladename: connect_host(cluster, standby_ip, bladename), bladename,
+                          os.path.join(cluster, bladename), True, blade_filenames))
+    log(f'{len(fm_filenames)} logs on 2 FMs and {len(blade_filenames)} logs on {len(hosts) - (2 if fm_filenames else 0)} blades')
+    return [(cluster, *host) for host in hosts]
+
+# plan_text_logs of every cluster (in parallel), a failing cluster is left out
+def plan_all_text_logs() -> list[tuple]:
+    hosts = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(clusters)) as executor:
+        for cluster, future in [(cluster, executor.submit(plan_text_logs, cluster)) for cluster in clusters]:
+            try:
+                hosts += future.result()
+            except Exception as e:
+                log(f'[{cluster}] FAILED: {e!r}')
+    return hosts
+
+# every log gets a channel on the connection of its host (they stay open until Ctrl-C),
+# the lines are read and merged by log_follow.LogFollower on the main thread
+def follow_logs():
+    follower = log_follow.LogFollower(delay=args.follow_delay, max_buffer=int(args.follow_buffer * 1024 * 1024))
+    hosts = plan_all_text_logs()
+    with contextlib.ExitStack() as connections:
+        lock = threading.Lock()
+        def start(cluster, connect, hostname, local_dir, via_standby, filenames):
+            log_context.cluster = cluster
+            # the connection is borrowed from the pool until the end of the following
+            connection = connect()
+            client = connection.__enter__()
+            with lock:
+                connections.push(connection.__exit__)
+            for filename in filenames:
+                command = log_follow.build_follow_command(f'/logs/{filename}', grep_pattern, grep_services)
+                with lock:
+                    follower.add(client, f'{cluster}/{hostname}/{filename}', command)
+        # the connections to the blades (nested through the standby FM) are opened in parallel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(start, *host): host for host in hosts}
+            for future in concurrent.futures.as_completed(futures):
+                cluster, connect, hostname = futures[future][:3]
+                if future.exception():
+                    log(f'[{cluster}] [{hostname}] could not start following: {future.exception()!r}')
+        print(f'following the logs, stop with Ctrl-C\n', flush=True)
+        with open(os.path.join(toplevel_logdir, 'follow.log'), 'w') as follow_file:
+            try:
+                for timestamp, tag, line in follower.lines():
+                    line = f'{tag}: {line}'
+                    print(line)
+                    follow_file.write(line + '\n')
+            except KeyboardInterrupt:
+                pass
+    print(f'\nfollowed {follower.stats["lines"]} lines ({collect_utils.format_size(follower.stats["bytes"])}), '
+          f'the reading of a log was paused {follower.stats["pauses"]} times because of the --follow-buffer')
+    print(f'the lines are in {os.path.join(toplevel_logdir, "follow.log")}')
+
+# --watch: runs a command on every FM/blade, so their connections are opened (or opened again if they died)
+# and they're not closed by the pool as idle ones. Returns the number of hosts which could not be reached.
+def keep_warm(hosts: list[tuple]) -> int:
+    def touch(cluster, connect, hostname, *_):
+        log_context.cluster = cluster
+        with connect() as client:
+            paramiko_utils.run(client, 'true')
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(touch, *host): host for host in hosts}
+        for future in concurrent.futures.as_completed(futures):
+            cluster, connect, hostname = futures[future][:3]
+            if future.exception():
+                log(f'[{cluster}] [{hostname}] could not connect: {future.exception()!r}')
+                failed += 1
+    return failed
+
+# the ls command of the current and the rotated files of a logfile of a time window (see generate_ls_pattern)
+def window_ls_pattern(logfilename: str, since: datetime.datetime, until: datetime.datetime) -> str:
+    return ' '.join(['ls', logfilename] + [f'{logfilename}.{d}*' for d in hour_patterns(since, until)])
+
+# --watch: downloads the lines between since and until of the text logs of every FM/blade into capture_dir,
+# which is a log pack in the same layout as the normal ones.
+# The hosts are captured in parallel, but max. fm_channels blades at the same time through the same standby FM.
+def capture(hosts: list[tuple], capture_dir: str, since: datetime.datetime, until: datetime.datetime):
+    wait = (until - utc_now()).total_seconds()
+    if wait > 0:
+        log(f'waiting {wait:.0f}s for the end of the capture window ...')
+        time.sleep(wait)
+    start_time = time.monotonic()
+    fm_slots = {cluster: threading.Semaphore(fm_channels) for cluster in clusters}
+    def capture_host(cluster, connect, hostname, local_dir, via_standby, filenames):
+        log_context.cluster = cluster
+        local_dir = os.path.join(capture_dir, local_dir)
+        os.makedirs(local_dir, exist_ok=True)
+        size = 0
+        with fm_slots[cluster] if via_standby else contextlib.nullcontext(), connect() as client:
+            listings = [(filename, window_ls_pattern(filename, since, until)) for filename in filenames]
+            files_by_filename = collect_utils.list_remote_files(client, '/logs', listings)
+            for logfile in [f for filename, _ in listings for f in files_by_filename.get(filename, [])]:
+                local_filepath = collect_utils.download_time_window(client, '/logs', logfile, since, until, local_dir, decompress=not keep_compressed)
+                if local_filepath:
+                    size += os.path.getsize(local_filepath)
+        return size
+    size = 0
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, len(hosts))) as executor:
+        futures = {executor.submit(capture_host, *host): host for host in hosts}
+        for future in concurrent.futures.as_completed(futures):
+            cluster, connect, hostname = futures[future][:3]
+            try:
+                size += future.result()
+            except Exception as e:
+                log(f'[{cluster}] [{hostname}] capture FAILED: {e!r}')
+                failed.append(f'{cluster}/{hostname}')
+    if os.path.exists(watch_filepath):
+        shutil.copyfile(watch_filepath, os.path.join(capture_dir, 'ir_test.log'))
+    failed_str = f', FAILED: {failed}' if failed else ''
+    log(f'captured {collect_utils.format_size(size)} from {len(hosts) - len(failed)}/{len(hosts)} hosts '
+        f'in {collect_utils.format_duration(time.monotonic() - start_time)}: {capture_dir}{failed_str}')
+
+# the logs of the FMs/blades are in UTC, so the capture windows are in UTC too (naive, like the parsed timestamps)
+def utc_now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None, microsecond=0)
+
+# the time (UTC) of a line of ir_test.log, or None if it has no timestamp
+def trigger_time_of(line: str) -> datetime.datetime:
+    match = re.search(r'\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d', line)
+    return collect_utils.parse_time(match.group()) if match else None
+
+# --watch: the connections to every FM/blade are opened at the start and kept alive in the background,
+# so a capture can start downloading right when a line of the watched file matches --trigger.
+# A capture goes into <toplevel_logdir>/<first cluster>_<time of the trigger>, the triggers which come
+# within --debounce seconds after it (or while it's running) are only written into its triggers.log.
+def watch_and_capture():
+    hosts = plan_all_text_logs()
+    # every connection has to fit into the pool, and the keepalive has to come before the idle timeout of the pool
+    pool.max_size = max(pool.max_size, len(hosts) + 4 * len(clusters))
+    pool.idle_timeout = max(pool.idle_timeout, 2 * args.keepalive)
+    start_time = time.monotonic()
+    failed = keep_warm(hosts)
+    print(f'connected to {len(hosts) - failed}/{len(hosts)} hosts in {collect_utils.format_duration(time.monotonic() - start_time)}', flush=True)
+
+    stop = threading.Event()
+    def keepalive_loop():
+        while not stop.wait(args.keepalive):
+            keep_warm(hosts)
+    threading.Thread(target=keepalive_loop, daemon=True).start()
+
+    # captures run one after the other, on their own thread, so the watched file is read during the capture too
+    capture_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    last_capture = None
+    last_capture_time = None
+    triggers_filepath = None
+    print(f'watching {watch_filepath} for "{args.trigger}", stop with Ctrl-C\n', flush=True)
+    try:
+        for line in log_follow.tail_local_file(watch_filepath):
+            if not trigger_re.search(line):
+                continue
+            if last_capture and (not last_capture.done() or time.monotonic() - last_capture_time < args.debounce):
+                log(f'trigger (debounced): {line}')
+                with open(triggers_filepath, 'a') as f:
+                    f.write(line + '\n')
+                continue
+            trigger_time = trigger_time_of(line) or utc_now()
+            capture_dir = os.path.join(toplevel_logdir, f'{clusters[0]}_{trigger_time.strftime("%F-T%H-%M-%S")}')
+            os.makedirs(capture_dir, exist_ok=True)
+            triggers_filepath = os.path.join(capture_dir, 'triggers.log')
+            with open(triggers_filepath, 'a') as f:
+                f.write(line + '\n')
+            since = trigger_time - datetime.timedelta(minutes=args.capture_before)
+            until = trigger_time + datetime.timedelta(minutes=args.capture_after)
+            log(f'trigger: {line}')
+            log(f'capturing the lines between {since} and {until} into {capture_dir} ...')
+            last_capture = capture_executor.submit(capture, hosts, capture_dir, since, until)
+            last_capture_time = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    if last_capture and not last_capture.done():
+        print('\nwaiting for the running capture to finish ...', flush=True)
+    capture_executor.shutdown()
+
+# clusters are independent from each other (and for replication we need both of them anyway),
+# so every cluster gets its own thread, and a failing cluster does not stop the others
+cluster_results = {}
+# every connection (VIP, FMs, blades) is opened once and shared between the threads
+pool = paramiko_utils.ConnectionPool()
+# for collect-report.json: how long the planning, the downloads and the decompression took
+phases = {}
+if follow:
+    with pool:
+        follow_logs()
+    exit(0)
+if watch_filepath:
+    with pool:
+        watch_and_capture()
+    exit(0)
+with pool:
+    # the largest files are downloaded first, so the connection of a host may be idle for long before its
+    # next download, it's kept anyway (keepalives keep it open, and it's closed at the end of the run)
+    pool.idle_timeout = float('inf')
+    start_time = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(clusters)) as executor:
+        futures = {executor.submit(plan_cluster, cluster): cluster for cluster in clusters}
+        for future in concurrent.futures.as_completed(futures):
+            cluster = futures[future]
+            try:
+                cluster_results[cluster] = future.result()
+            except Exception as e:
+                log(f'[{cluster}] FAILED: {e!r}')
+                cluster_results[cluster] = {'error': e}
+
+    phases['planning'] = time.monotonic() - start_time
+    total_size = scheduler.total_size
+    print(f'\nplanned downloads: {collect_utils.format_size(total_size)} in {scheduler.num_transfers} transfers')
+    # (with --grep nothing is downloaded, only the matching lines)
+    if total_size > max_size * 1024 * 1024 * 1024 and not i_want_a_lot and not grep_mode:
+        print(f'Error: this is more than --max-size={max_size} GB, please specify --i-want-a-lot if you are serious')
+        shutil.rmtree(toplevel_logdir)
+        exit(1)
+
+    start_time = time.monotonic()
+    for (cluster, hostname), e in scheduler.run(report_progress=log):
+        log(f'[{cluster}] [{hostname}] download FAILED: {e!r}')
+        res = cluster_results[cluster]
+        if 'error' in res:
+            # the planning of the cluster failed after some of its downloads were queued, it's already reported as FAILED
+            continue
+        failed = res['failed_fms'] if re.match(r'^sup\d$', hostname) else res['failed_blades']
+        if hostname not in failed:
+            failed.append(hostname)
+    phases['downloads'] = time.monotonic() - start_time
+
+for cluster in clusters:
+    res = cluster_results[cluster]
+    if 'error' not in res and res['failed_blades']:
+        print(f'[{cluster}] Error: could not collect logs from blades: {res["failed_blades"]}')
+        # maybe a blade was removed/renamed since the topology was cached
+        topology_cache.invalidate(cluster)
+    if 'error' not in res and res['failed_fms']:
+        print(f'[{cluster}] Error: could not collect logs from FMs: {res["failed_fms"]}')
+
+print('\n---------------- summary ----------------')
+print(f'{"cluster":<20} {"status":<8} {"FM logs":>8} {"blades":>8} {"size":>10}')
+for cluster in clusters:
+    res = cluster_results[cluster]
+    if 'error' in res:
+        print(f'{cluster:<20} {"FAILED":<8} {"-":>8} {"-":>8} {"-":>10}  {res["error"]!r}')
+        continue
+    status = 'PARTIAL' if res['failed_blades'] or res['failed_fms'] else 'OK'
+    blades = f'{res["blades"] - len(res["failed_blades"])}/{res["blades"]}'
+    print(f'{cluster:<20} {status:<8} {res["fm_logfiles"]:>8} {blades:>8} {collect_utils.format_size(res["size"]):>10}')
+print(f'downloads took {phases["downloads"]:.0f}s')
+print('-----------------------------------------\n')
+
+print(f"waiting for the decompression of the .zst files we downloaded in toplevel_logdir=[{toplevel_logdir}] ...")
+failed_decompressions = decompressor.wait()
+if failed_decompressions:
+    print(f'Error: could not decompress: {failed_decompressions}')
+phases['decompression_wait'] = decompressor.stats['wait_seconds']
+if indexer:
+    print('waiting for the indexing of the logs ...')
+    start_time = time.monotonic()
+    failed_indexing = indexer.wait()
+    if failed_indexing:
+        print(f'Error: could not index: {failed_indexing}')
+    phases['index_wait'] = time.monotonic() - start_time
+if 'atop_blades' in logtypes:
+    # in its own process: it forks worker processes, which must not inherit the threads of paramiko
+    print('converting the atop files of the blades ...')
+    start_time = time.monotonic()
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'atop_store.py'), 'ingest', toplevel_logdir])
+    phases['atop_ingest'] = time.monotonic() - start_time
+if 'middleware_db_dump' in logtypes:
+    print(f'loading the middleware DB dumps into {os.path.join(toplevel_logdir, middleware_db.DB_FILENAME)} ...')
+    start_time = time.monotonic()
+    failed_db_loads = middleware_db.load(toplevel_logdir)
+    if failed_db_loads:
+        print(f'Error: could not load: {failed_db_loads}')
+    phases['db_load'] = time.monotonic() - start_time
+
+report = collect_utils.build_report(scheduler, decompressor, phases, {'clusters': cluster_results, 'failed_decompressions': failed_decompressions})
+collect_utils.write_report(os.path.join(toplevel_logdir, 'collect-report.json'), report)
+print('\n'.join(collect_utils.report_summary(report)))
+print(f'report: {os.path.join(toplevel_logdir, "collect-report.json")}\n')
+if store:
+    store.close()
+if grep_file:
+    grep_file.close()
+    print(f'matching lines are in {os.path.join(toplevel_logdir, "grep.log")}')
 
 def copy_ir_test_log():
     if not os.path.exists('ir_test.log'):
@@ -297,6 +929,8 @@ def copy_ir_test_log():
     shutil.copyfile('ir_test.log', os.path.join(toplevel_logdir, 'ir_test.log'))
 
 copy_ir_test_log()
+cluster_info_scan.wait()
+print(f'cluster info: {os.path.join(toplevel_logdir, cluster_info.CLUSTER_INFO_FILENAME)}')
 
 print(f'\nlogdir = {toplevel_logdir}')
 with open('cd', 'w') as f:
@@ -0,0 +1,767 @@
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import io
+import json
+import os
+import re
+import shlex
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+
+import paramiko
+
+import paramiko_utils
+
+# a file found on the remote host, name is relative to the directory where we listed it
+RemoteFile = collections.namedtuple('RemoteFile', ['name', 'size', 'mtime'])
+
+DEFAULT_STORE_DIR = os.path.expanduser('~/.cache/collect-logstore')
+DEFAULT_TOPOLOGY_CACHE = os.path.expanduser('~/.cache/collect-topology.json')
+
+# lines starting with this separate the output of the different listings
+SECTION_MARKER = '::section::'
+
+# Builds one shell command out of many listings, so we need only one round-trip per host.
+# listings: list of (name, command) tuples, where command prints filenames (one per line)
+# relative to remote_dir, eg. 'ls nfs.log.* -tr | tail --lines 3'.
+# For every file its size and mtime is printed too (order of the filenames is kept).
+def build_listing_command(remote_dir: str, listings: list[tuple[str, str]]) -> str:
+    command = f'cd {shlex.quote(remote_dir)}'
+    for name, ls_command in listings:
+        command += f"; echo '{SECTION_MARKER}{name}'"
+        command += f"; ({ls_command}) 2>/dev/null | xargs -r -d '\\n' stat -c '%s %Y %n' --"
+    return command
+
+# parses the output of the command built by build_listing_command
+def parse_listing(output: str) -> dict[str, list[RemoteFile]]:
+    result = {}
+    files = None
+    for line in output.split('\n'):
+        if line.startswith(SECTION_MARKER):
+            files = result.setdefault(line[len(SECTION_MARKER):], [])
+        elif line and files is not None:
+            size, mtime, name = line.split(' ', 2)
+            files.append(RemoteFile(name, int(size), int(mtime)))
+    return result
+
+# returns the files of every listing: {name: [RemoteFile, ...]}
+def list_remote_files(client: paramiko.SSHClient, remote_dir: str, listings: list[tuple[str, str]]) -> dict[str, list[RemoteFile]]:
+    if not listings:
+        return {}
+    output = paramiko_utils.run(client, build_listing_command(remote_dir, listings))
+    return parse_listing(output)
+
+# Downloads the files from remote_dir with one remote tar streamed over a single channel,
+# instead of one scp per file. The stream is extracted on the fly, so no archive is written
+# on either side. Files are extracted directly into local_dir with their mtime kept.
+# With decompress=True .zst files are piped through zstd while they arrive,
+# so the compressed copy is never written to the disk. Returns the paths of the extracted files.
+def download_bundle(client: paramiko.SSHClient, remote_dir: str, filenames: list[str], local_dir: str, decompress=False, throttle: 'Throttle' = None) -> list[str]:
+    if not filenames:
+        return []
+    local_filepaths = []
+    command = f'cd {shlex.quote(remote_dir)} && tar -cf - -- ' + ' '.join(shlex.quote(f) for f in filenames)
+    stdin, stdout, stderr = client.exec_command(command)
+    with tarfile.open(fileobj=throttle.wrap(stdout) if throttle else stdout, mode='r|') as tar:
+        for member in tar:
+            # we asked for plain files in one directory, anything else is suspicious
+            if not member.isfile() or os.path.basename(member.name) != member.name:
+                raise Exception(f'unexpected entry in the bundle from {remote_dir}: {member.name}')
+            local_filepath = os.path.join(local_dir, member.name)
+            # the old file may be hardlinked into other log packs (see LogStore), so it's not overwritten in place
+            if os.path.lexists(local_filepath):
+                os.remove(local_filepath)
+            if decompress and member.name.endswith('.zst'):
+                local_filepath = local_filepath[:-len('.zst')]
+                decompress_stream(tar.extractfile(member), local_filepath)
+            else:
+                tar.extract(member, local_dir, set_attrs=False)
+            os.utime(local_filepath, (member.mtime, member.mtime))
+            local_filepaths.append(local_filepath)
+    exit_status = stdout.channel.recv_exit_status()
+    # 1 means some files changed while tar read them (eg. the current nfs.log), that's fine
+    if exit_status > 1:
+        error = stderr.read().decode('utf-8').strip()
+        raise Exception(f'remote tar failed in {remote_dir} with exit status {exit_status}: {error}')
+    return local_filepaths
+
+def decompress_stream(stream, local_filepath: str):
+    with subprocess.Popen(['zstd', '-d', '-q', '-f', '-o', local_filepath], stdin=subprocess.PIPE) as zstd:
+        shutil.copyfileobj(stream, zstd.stdin, 1024 * 1024)
+        zstd.stdin.close()
+    if zstd.returncode != 0:
+        raise Exception(f'zstd failed to decompress into {local_filepath}')
+
+# Decompresses downloaded .zst files in the background as soon as they are downloaded,
+# so it overlaps with the network transfers instead of being a separate phase at the end.
+# The compressed file is removed after successful decompression.
+# Every downloaded file can be submitted, on_done is called with the final path of each one
+# (after the decompression for .zst files), eg. to index it. With enabled=False nothing is decompressed.
+class Decompressor:
+    def __init__(self, workers: int = None, enabled: bool = True, on_done=None):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self._futures = {}
+        self.enabled = enabled
+        self.on_done = on_done
+        self._lock = threading.Lock()
+        # for the report: number of files, their compressed size, the sum of the time spent on them
+        # and how long we waited for them after the downloads
+        self.stats = {'files': 0, 'bytes': 0, 'seconds': 0, 'wait_seconds': 0}
+
+    # can be called with any file, only .zst files are decompressed
+    def submit(self, local_filepath: str):
+        if self.enabled and local_filepath.endswith('.zst'):
+            self._futures[self._executor.submit(self._decompress, local_filepath)] = local_filepath
+        elif self.on_done:
+            self.on_done(local_filepath)
+
+    def _decompress(self, local_filepath: str):
+        start_time = time.monotonic()
+        size = os.path.getsize(local_filepath)
+        subprocess.run(['zstd', '-d', '-q', '-f', '--rm', local_filepath], check=True)
+        with self._lock:
+            self.stats['files'] += 1
+            self.stats['bytes'] += size
+            self.stats['seconds'] += time.monotonic() - start_time
+        if self.on_done:
+            self.on_done(local_filepath[:-len('.zst')])
+
+    # waits for every decompression, returns the files which could not be decompressed
+    def wait(self) -> list[str]:
+        start_time = time.monotonic()
+        failed = []
+        for future in concurrent.futures.as_completed(self._futures):
+            if future.exception():
+                failed.append(self._futures[future])
+        self._executor.shutdown()
+        self.stats['wait_seconds'] = time.monotonic() - start_time
+        return failed
+
+# Yields the lines of a logfile, .zst files are decompressed on the fly (nothing is written to the disk).
+# This is what makes it possible to keep the downloaded logs compressed (--keep-compressed).
+def read_log_lines(filepath: str):
+    with open_log(filepath) as f:
+        text = io.TextIOWrapper(f, errors='replace')
+        yield from text
+        # without this the wrapper would close f, and open_log could not check the end of it
+        text.detach()
+
+# Opens a logfile for reading in binary mode, .zst files are decompressed on the fly
+# (the returned stream can't seek then, it reads the output of zstd).
+# If the whole output was read, but zstd failed (eg. a corrupt or truncated file), an exception is raised,
+# so a broken file is not taken for a shorter log.
+@contextlib.contextmanager
+def open_log(filepath: str):
+    if not filepath.endswith('.zst'):
+        with open(filepath, 'rb') as f:
+            yield f
+        return
+    with subprocess.Popen(['zstd', '-d', '-c', '-q', filepath], stdout=subprocess.PIPE, stderr=subprocess.PIPE) as zstd:
+        try:
+            yield zstd.stdout
+        except BaseException:
+            zstd.kill()
+            raise
+        # the reader can stop before the end (eg. it found what it was looking for), zstd is not needed then
+        if zstd.stdout.closed or zstd.stdout.read(1):
+            zstd.kill()
+            return
+        if zstd.wait() != 0:
+            error = zstd.stderr.read().decode('utf-8', errors='replace').strip()
+            raise Exception(f'could not decompress {filepath} (exit status {zstd.returncode}): {error}')
+
+# Downloads one file through an exec channel, so an interrupted download can be continued:
+# the data goes into a .part file first (its name contains the size & mtime of the remote file,
+# so a part of an older version is never continued) and next time only the rest is downloaded.
+# Only the first logfile.size bytes are downloaded, so a growing live log is still consistent.
+def download_resumable(client: paramiko.SSHClient, remote_dir: str, logfile: RemoteFile, local_filepath: str, throttle: 'Throttle' = None):
+    part_filepath = f'{local_filepath}.{logfile.size}-{logfile.mtime}.part'
+    # only the parts of older versions of this file, not eg. nfs.log.2024-01-30.01-00-00.zst.<size>-<mtime>.part
+    # for nfs.log (that one can be downloading on another channel right now)
+    local_dir, filename = os.path.split(local_filepath)
+    old_part_re = re.compile(re.escape(filename) + r'\.\d+-\d+\.part')
+    for old_part_filename in os.listdir(local_dir or '.'):
+        old_part_filepath = os.path.join(local_dir, old_part_filename)
+        if old_part_re.fullmatch(old_part_filename) and old_part_filepath != part_filepath:
+            os.remove(old_part_filepath)
+    offset = os.path.getsize(part_filepath) if os.path.exists(part_filepath) else 0
+    remote_filepath = shlex.quote(f'{remote_dir}/{logfile.name}')
+    stdin, stdout, stderr = client.exec_command(f'tail -c +{offset + 1} {remote_filepath} | head -c {logfile.size - offset}')
+    with open(part_filepath, 'ab') as f:
+        shutil.copyfileobj(throttle.wrap(stdout) if throttle else stdout, f, 1024 * 1024)
+    exit_status = stdout.channel.recv_exit_status()
+    if exit_status != 0 or os.path.getsize(part_filepath) != logfile.size:
+        error = stderr.read().decode('utf-8').strip()
+        raise Exception(f'could not download {remote_dir}/{logfile.name} (exit status {exit_status}): {error}')
+    os.replace(part_filepath, local_filepath)
+    os.utime(local_filepath, (logfile.mtime, logfile.mtime))
+
+TIME_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M']
+
+# parses times like '2024-01-30 17:05', '2024-01-30T17:05:30' or '2024-01-30.17:05'
+# (so it can be copy-pasted from ir_test.log or from the logs themselves)
+def parse_time(time_str: str) -> datetime.datetime:
+    normalized = time_str.strip().replace('T', ' ').replace('.', ' ', 1)
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(normalized, time_format)
+        except ValueError:
+            pass
+    raise ValueError(f'time [{time_str}] does not match any of the formats: {TIME_FORMATS}')
+
+# parse_time for the end of a time window: without seconds it means the end of that minute,
+# so '--until 17:10' keeps the lines of 17:10:xx too (the until of TIME_FILTER_AWK is inclusive)
+def parse_until(time_str: str) -> datetime.datetime:
+    until = parse_time(time_str)
+    if not re.search(r':\d\d:\d\d\s*$', time_str):
+        until += datetime.timedelta(seconds=59)
+    return until
+
+# Keeps only the lines between since and until (both inclusive, compared by the second: until 17:10:59 keeps
+# 17:10:59.999 too, and parse_until turns a 17:10 until into 17:10:59). Log lines start with a timestamp
+# like '2024-01-30 17:05:30.123' (or with 'T' instead of the space), lines without a timestamp
+# (eg. multiline messages) belong to the previous line. As the lines are in time order,
+# awk stops reading at the first line after until, so the rest of the file is never decompressed.
+# If the file has no line with such a timestamp (eg. a log in another format), NO_TIMESTAMPS_MARKER is printed to stderr.
+TIME_FILTER_AWK = r"""awk -v since="$SINCE" -v until="$UNTIL" '
+/^[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9][ T][0-9][0-9]:[0-9][0-9]:[0-9][0-9]/ {
+    stamped = 1
+    ts = substr($0, 1, 10) " " substr($0, 12, 8)
+    if (ts > until) exit
+    keep = (ts >= since)
+}
+keep { print }
+END { if (!stamped) print "$MARKER" > "/dev/stderr" }'"""
+NO_TIMESTAMPS_MARKER = '::no-timestamps::'
+
+def time_filter_awk(since: datetime.datetime, until: datetime.datetime) -> str:
+    return (TIME_FILTER_AWK.replace('$SINCE', since.strftime('%Y-%m-%d %H:%M:%S')).replace('$UNTIL', until.strftime('%Y-%m-%d %H:%M:%S'))
+            .replace('$MARKER', NO_TIMESTAMPS_MARKER))
+
+# Only the exit status of the last command of a pipeline comes back, so a reader which can't read the file
+# (missing, truncated or corrupt .zst) would look like an empty slice. Its failure is printed to stderr with
+# READ_FAILED_MARKER instead. 141 is not a failure: it's SIGPIPE, when awk stopped reading after until.
+READ_FAILED_MARKER = '::read-failed::'
+
+# the reader command of a pipeline, its failure is reported on stderr with READ_FAILED_MARKER, what: the start of the message (eg. the filename)
+def checked_reader(reader: str, what: str = '') -> str:
+    return f'{{ {reader}; status=$?; [ $status -eq 0 ] || [ $status -eq 141 ] || echo "{READ_FAILED_MARKER} {what}exit status $status" >&2; }}'
+
+# without since and until the whole file is read (compressed with zstd, like the slices)
+def build_time_filter_command(remote_filepath: str, since: datetime.datetime = None, until: datetime.datetime = None) -> str:
+    reader = 'zstd -d -c -q' if remote_filepath.endswith('.zst') else 'cat'
+    reader = checked_reader(f'{reader} {shlex.quote(remote_filepath)}')
+    if since is None:
+        return f'{reader} | zstd -c -q'
+    awk = time_filter_awk(since, until)
+    # the result is compressed again, so the wire carries only the compressed slice
+    return f'{reader} | {awk} | zstd -c -q'
+
+# Downloads only the lines between since and until from the logfile, the filtering is done on the remote host.
+# The result is written to local_dir without the .zst extension (or with it, if decompress=False).
+# Returns the local path, or None if there were no lines in the time window.
+# A file without timestamped lines (eg. a log in another format) can't be cut by time, it's downloaded whole.
+def download_time_window(client: paramiko.SSHClient, remote_dir: str, logfile: RemoteFile, since: datetime.datetime, until: datetime.datetime, local_dir: str, decompress=True, throttle: 'Throttle' = None) -> str:
+    name = logfile.name[:-len('.zst')] if logfile.name.endswith('.zst') else logfile.name
+    local_filepath = os.path.join(local_dir, name if decompress else name + '.zst')
+    def download(command: str) -> str:
+        stdin, stdout, stderr = client.exec_command(command)
+        stream = throttle.wrap(stdout) if throttle else stdout
+        if decompress:
+            decompress_stream(stream, local_filepath)
+        else:
+            with open(local_filepath, 'wb') as f:
+                shutil.copyfileobj(stream, f, 1024 * 1024)
+        exit_status = stdout.channel.recv_exit_status()
+        error = stderr.read().decode('utf-8').strip()
+        if exit_status != 0 or READ_FAILED_MARKER in error:
+            # not to leave a partial slice in the log pack
+            if os.path.exists(local_filepath):
+                os.remove(local_filepath)
+            raise Exception(f'could not filter {remote_dir}/{logfile.name} (exit status {exit_status}): {error}')
+        return error
+    if NO_TIMESTAMPS_MARKER in download(build_time_filter_command(f'{remote_dir}/{logfile.name}', since, until)):
+        download(build_time_filter_command(f'{remote_dir}/{logfile.name}'))
+        return local_filepath
+    if decompress and os.path.getsize(local_filepath) == 0:
+        os.remove(local_filepath)
+        return None
+    return local_filepath
+
+# Builds one command which prints the matching lines of the files in remote_dir prefixed with the filename,
+# like: 'nfs.log.2024-01-30.17-00-00.zst:<line>'. .zst files are decompressed on the fly on the remote.
+# services: only the lines containing any of these (eg. replication::replica_link_manager) are kept
+# pattern: only the lines matching this extended regex are kept (applied after the services)
+# time_window: (since, until), only the lines between them are kept, see TIME_FILTER_AWK
+def build_grep_command(remote_dir: str, filenames: list[str], pattern: str = None, services: list[str] = None, time_window: tuple = None) -> str:
+    filters = []
+    if time_window:
+        filters.append(time_filter_awk(*time_window))
+    if services:
+        filters.append('grep -F ' + ' '.join(f'-e {shlex.quote(s)}' for s in services))
+    if pattern:
+        filters.append(f'grep -E -e {shlex.quote(pattern)}')
+    filters.append('sed "s|^|$f:|"')
+    files = ' '.join(shlex.quote(f) for f in filenames)
+    reader = checked_reader('case "$f" in *.zst) zstd -d -c -q -- "$f";; *) cat -- "$f";; esac', what='$f: ')
+    return f'cd {shlex.quote(remote_dir)}; for f in {files}; do {reader} | {" | ".join(filters)}; done'
+
+# Runs the grep on the remote and yields (filename, line) tuples as the matching lines arrive.
+# If a file could not be read (missing, truncated or corrupt .zst), it raises at the end (after the lines of the other files),
+# so it's not mistaken for a file without matching lines.
+def remote_grep(client: paramiko.SSHClient, remote_dir: str, filenames: list[str], pattern: str = None, services: list[str] = None, time_window: tuple = None):
+    if not filenames:
+        return
+    command = paramiko_utils.RemoteCommand(client, build_grep_command(remote_dir, filenames, pattern, services, time_window))
+    for line in command.lines():
+        filename, _, line = line.partition(':')
+        yield filename, line
+    if READ_FAILED_MARKER in command.stderr:
+        # the files without timestamps are not errors, they just have no lines in the time window
+        errors = [line for line in command.stderr.splitlines() if line.strip() and NO_TIMESTAMPS_MARKER not in line]
+        raise Exception(f'could not grep every file in {remote_dir}: {errors}')
+
+# Local content store of the downloaded logfiles, shared between the collection runs.
+# The manifest (sqlite) remembers the size & mtime of every file we've downloaded,
+# and if they are the same on the remote (rotated logs never change) the file is not downloaded again,
+# it's only hardlinked (or copied if it's on a different filesystem) into the new log pack.
+# Layout: <store_dir>/<cluster>/<host>/<filename>, plus <store_dir>/manifest.sqlite
+class LogStore:
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(store_dir, 'manifest.sqlite'), check_same_thread=False)
+        with self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS files (
+                cluster TEXT, host TEXT, remote_path TEXT, size INTEGER, mtime INTEGER,
+                PRIMARY KEY (cluster, host, remote_path))""")
+
+    # True if the logfile is in the store and it did not change on the remote since it was downloaded
+    def is_stored(self, cluster: str, host: str, remote_dir: str, logfile: RemoteFile) -> bool:
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime FROM files WHERE cluster=? AND host=? AND remote_path=?',
+                                   (cluster, host, f'{remote_dir}/{logfile.name}')).fetchone()
+        return row == (logfile.size, logfile.mtime) and os.path.exists(os.path.join(self.store_dir, cluster, host, logfile.name))
+
+    def _add(self, cluster: str, host: str, remote_path: str, logfile: RemoteFile):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                             (cluster, host, remote_path, logfile.size, logfile.mtime))
+
+    # Puts the logfiles into local_dir, downloading only the new or changed ones into the store.
+    # Returns the paths of the files in local_dir and the number of the files which were downloaded.
+    def fetch(self, client: paramiko.SSHClient, cluster: str, host: str, remote_dir: str, logfiles: list[RemoteFile], local_dir: str, bundle=False, throttle: 'Throttle' = None) -> tuple[list[str], int]:
+        host_store_dir = os.path.join(self.store_dir, cluster, host)
+        os.makedirs(host_store_dir, exist_ok=True)
+        missing = [f for f in logfiles if not self.is_stored(cluster, host, remote_dir, f)]
+        if bundle:
+            download_bundle(client, remote_dir, [f.name for f in missing], host_store_dir, throttle=throttle)
+        for logfile in missing:
+            if not bundle:
+                download_resumable(client, remote_dir, logfile, os.path.join(host_store_dir, logfile.name), throttle=throttle)
+            self._add(cluster, host, f'{remote_dir}/{logfile.name}', logfile)
+
+        local_filepaths = []
+        for logfile in logfiles:
+            local_filepath = os.path.join(local_dir, logfile.name)
+            link_or_copy(os.path.join(host_store_dir, logfile.name), local_filepath)
+            local_filepaths.append(local_filepath)
+        return local_filepaths, len(missing)
+
+    def close(self):
+        self._db.close()
+
+# Remembers the topology of the clusters (FM IPs, blades), so it doesn't have to be
+# discovered at the beginning of every collection. The topology is a dict, its content is up to the caller.
+# Entries older than ttl (seconds) are not used. The cache is one json file: {cluster: {'time': ..., 'topology': ...}}
+class TopologyCache:
+    def __init__(self, cache_file: str, ttl: float):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save(self, entries: dict):
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        tmp_file = f'{self.cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(entries, f, indent=2)
+        os.replace(tmp_file, self.cache_file)
+
+    def get(self, cluster: str) -> dict:
+        with self._lock:
+            entry = self._load().get(cluster)
+        if entry and time.time() - entry['time'] < self.ttl:
+            return entry['topology']
+        return None
+
+    def put(self, cluster: str, topology: dict):
+        with self._lock:
+            entries = self._load()
+            entries[cluster] = {'time': time.time(), 'topology': topology}
+            self._save(entries)
+
+    def invalidate(self, cluster: str):
+        with self._lock:
+            entries = self._load()
+            if entries.pop(cluster, None):
+                self._save(entries)
+
+# Limits the rate of the data going through it (bytes per second), it can be shared between threads.
+# Every consume() gets a time slot after the previous ones, and sleeps until its slot comes,
+# up to a second of burst is allowed, so small reads don't sleep all the time.
+class RateLimiter:
+    def __init__(self, bytes_per_second: float):
+        self.bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        self._next_time = time.monotonic()
+
+    def consume(self, size: int):
+        with self._lock:
+            now = time.monotonic()
+            self._next_time = max(self._next_time, now - 1) + size / self.bytes_per_second
+            delay = self._next_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+# Throttles one transfer by every rate limiter it goes through (eg. the global one and the one of the FM we tunnel through)
+# It counts the bytes too, so it tells how much was transferred.
+class Throttle:
+    def __init__(self, limiters: list[RateLimiter]):
+        self.limiters = limiters
+        self.bytes = 0
+
+    def consume(self, size: int):
+        self.bytes += size
+        for limiter in self.limiters:
+            limiter.consume(size)
+
+    # returns a file-like object which reads from stream and throttles the reads
+    def wrap(self, stream):
+        return ThrottledReader(stream, self)
+
+class ThrottledReader(io.RawIOBase):
+    def __init__(self, stream, throttle: Throttle):
+        self._stream = stream
+        self._throttle = throttle
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self._throttle.consume(len(data))
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+# Plans and runs the downloads: every transfer is added with its size first, so we know the total
+# before anything is downloaded, then run() downloads them on a pool of workers, largest first,
+# so the longest transfers don't end up holding up the end of the run.
+# A transfer goes through one or more hosts (a blade's logs go through the standby FM too), and it's
+# only started if every host it goes through has a free channel (max_channels_per_host, or less
+# if set_host_channels() was called for the host). set_host_bandwidth() can limit the bytes per second
+# going through a host, bandwidth (bytes per second) limits all the transfers together.
+# A failed transfer is tried again (at the end of the queue of its size) at most retries times.
+# Every transfer is measured (bytes, seconds, attempts), see results and host_report().
+class TransferScheduler:
+    # one planned transfer, fn is called with a Throttle, tag is returned with the failures
+    Transfer = collections.namedtuple('Transfer', ['size', 'hosts', 'tag', 'fn', 'name'])
+
+    def __init__(self, workers: int, max_channels_per_host: int, bandwidth: float = None, retries: int = 0):
+        self.workers = workers
+        self.max_channels_per_host = max_channels_per_host
+        self.retries = retries
+        self.host_channels = {}
+        self._limiter = RateLimiter(bandwidth) if bandwidth else None
+        self._host_limiters = {}
+        self._transfers = []
+        # transfer -> number of attempts and the bytes of all the attempts
+        self._attempts = collections.Counter()
+        self._bytes = collections.Counter()
+        self._channels_in_use = collections.Counter()
+        self._condition = threading.Condition()
+        self._failures = []
+        # one dict per finished transfer: tag, name, hosts, size, bytes, start, end, seconds, attempts, error
+        self.results = []
+        # the throttles of the running transfers (-> the transfer), they count the bytes of the transfers in progress
+        self._running = {}
+        self._start_time = None
+        self._planned_size = 0
+        # while it's set, the planner of run() can still add transfers, so the workers don't stop when they run out of them
+        self._planning = False
+        # tag -> number of transfers, their size and the number of the finished ones (for the progress per tag)
+        self._tags = {}
+
+    def add(self, size: int, hosts: list[str], tag, fn, name: str = None):
+        with self._condition:
+            transfer = self.Transfer(size, tuple(hosts), tag, fn, name)
+            if self._start_time is None:
+                self._transfers.append(transfer)
+            else:
+                # added by the planner while running, it goes to its place by size
+                sizes = [-t.size for t in self._transfers]
+                self._transfers.insert(bisect.bisect_right(sizes, -size), transfer)
+            self._planned_size += size
+            tag_stats = self._tags.setdefault(tag, {'transfers': 0, 'size': 0, 'done': 0})
+            tag_stats['transfers'] += 1
+            tag_stats['size'] += size
+            self._condition.notify_all()
+
+    def set_host_channels(self, host: str, channels: int):
+        with self._condition:
+            self.host_channels[host] = channels
+
+    def set_host_bandwidth(self, host: str, bytes_per_second: float):
+        with self._condition:
+            self._host_limiters[host] = RateLimiter(bytes_per_second)
+
+    @property
+    def total_size(self) -> int:
+        return sum(t.size for t in self._transfers)
+
+    @property
+    def num_transfers(self) -> int:
+        return len(self._transfers)
+
+    # the size of every transfer which was ever added (total_size is only the ones which are not run yet)
+    @property
+    def planned_size(self) -> int:
+        return self._planned_size
+
+    def _has_free_channel(self, host: str) -> bool:
+        return self._channels_in_use[host] < self.host_channels.get(host, self.max_channels_per_host)
+
+    # the largest transfer whose hosts all have a free channel (the list is sorted by size)
+    def _next_transfer(self) -> Transfer:
+        for i, transfer in enumerate(self._transfers):
+            if all(self._has_free_channel(host) for host in transfer.hosts):
+                return self._transfers.pop(i)
+        return None
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                transfer = self._next_transfer()
+                while transfer is None:
+                    if not self._transfers and not self._running and not self._planning:
+                        return
+                    self._condition.wait()
+                    transfer = self._next_transfer()
+                self._channels_in_use.update(transfer.hosts)
+                self._attempts[transfer] += 1
+                limiters = [self._limiter] + [self._host_limiters.get(host) for host in transfer.hosts]
+                throttle = Throttle([limiter for limiter in limiters if limiter])
+                self._running[throttle] = transfer
+            start = time.monotonic()
+            error = None
+            try:
+                transfer.fn(throttle)
+            except Exception as e:
+                error = e
+            end = time.monotonic()
+            with self._condition:
+                self._running.pop(throttle)
+                self._channels_in_use.subtract(transfer.hosts)
+                attempts = self._attempts[transfer]
+                # the bytes of the failed attempts are counted too, they went through the network as well
+                self._bytes[transfer] += throttle.bytes
+                if error and attempts <= self.retries:
+                    self._transfers.append(transfer)
+                    self._transfers.sort(key=lambda t: t.size, reverse=True)
+                else:
+                    if error:
+                        self._failures.append((transfer.tag, error))
+                    self._tags[transfer.tag]['done'] += 1
+                    self.results.append({
+                        'tag': transfer.tag, 'name': transfer.name, 'hosts': list(transfer.hosts),
+                        'size': transfer.size, 'bytes': self._bytes[transfer],
+                        'start': start - self._start_time, 'end': end - self._start_time, 'seconds': end - start,
+                        'attempts': attempts, 'error': repr(error) if error else None,
+                    })
+                self._condition.notify_all()
+
+    def _report_progress(self, report_progress, interval: float, stop: threading.Event):
+        while not stop.wait(interval):
+            report_progress(self.progress_line())
+
+    # like: '[progress] 45% 1.2 GB/2.6 GB, 12.3 MB/s, ETA 1m55s, 20/72 transfers done, 4 running'
+    def progress_line(self) -> str:
+        with self._condition:
+            done_bytes = sum(r['bytes'] for r in self.results) + sum(t.bytes for t in self._running)
+            num_done = len(self.results)
+            num_running = len(self._running)
+            num_all = num_done + num_running + len(self._transfers)
+        elapsed = time.monotonic() - self._start_time
+        rate = done_bytes / elapsed if elapsed else 0
+        percent = 100 * done_bytes / self._planned_size if self._planned_size else 100
+        remaining = max(0, self.planned_size - done_bytes)
+        eta = format_duration(remaining / rate) if rate else '?'
+        return (f'[progress] {percent:.0f}% {format_size(done_bytes)}/{format_size(self._planned_size)}, '
+                f'{format_size(rate)}/s, ETA {eta}, {num_done}/{num_all} transfers done, {num_running} running')
+
+    # per tag (eg. per directory), in the order they were added: {tag: {'transfers', 'size', 'done', 'bytes'}},
+    # bytes are the bytes of the finished transfers and of the running ones so far
+    def tag_progress(self) -> dict:
+        with self._condition:
+            progress = {tag: dict(stats, bytes=0) for tag, stats in self._tags.items()}
+            for result in self.results:
+                progress[result['tag']]['bytes'] += result['bytes']
+            for throttle, transfer in self._running.items():
+                progress[transfer.tag]['bytes'] += throttle.bytes
+        return progress
+
+    def _plan(self, planner):
+        try:
+            planner()
+        except Exception as e:
+            self._planner_error = e
+        finally:
+            with self._condition:
+                self._planning = False
+                self._condition.notify_all()
+
+    # runs every planned transfer, returns the failed ones as a list of (tag, exception)
+    # report_progress: if it's set, it's called with a progress line every interval seconds
+    # planner: if it's set, it's called on its own thread and it can add more transfers while the ones added
+    # so far are already running (eg. the next directory is listed while the files of the first one are downloaded),
+    # the exception of the planner is raised when every transfer it added is done
+    def run(self, report_progress=None, interval: float = 10, planner=None) -> list[tuple[object, Exception]]:
+        with self._condition:
+            self._transfers.sort(key=lambda t: t.size, reverse=True)
+            self._start_time = time.monotonic()
+            self._planning = planner is not None
+        self._planner_error = None
+        stop = threading.Event()
+        threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.workers)]
+        if planner:
+            threads.append(threading.Thread(target=self._plan, args=(planner,), daemon=True))
+        for thread in threads:
+            thread.start()
+        if report_progress:
+            threading.Thread(target=self._report_progress, args=(report_progress, interval, stop), daemon=True).start()
+        for thread in threads:
+            thread.join()
+        stop.set()
+        if self._planner_error:
+            raise self._planner_error
+        return self._failures
+
+    # per host: transfers, failed, retries, bytes, seconds (from the start of its first transfer to the end of its last one)
+    # and throughput (bytes per second in that time), the slow blades/links can be spotted by the throughput
+    def host_report(self) -> dict:
+        hosts = {}
+        for result in self.results:
+            for host in result['hosts']:
+                stats = hosts.setdefault(host, {'transfers': 0, 'failed': 0, 'retries': 0, 'bytes': 0, 'start': result['start'], 'end': result['end']})
+                stats['transfers'] += 1
+                stats['failed'] += int(result['error'] is not None)
+                stats['retries'] += result['attempts'] - 1
+                stats['bytes'] += result['bytes']
+                stats['start'] = min(stats['start'], result['start'])
+                stats['end'] = max(stats['end'], result['end'])
+        for stats in hosts.values():
+            stats['seconds'] = stats['end'] - stats['start']
+            stats['throughput'] = stats['bytes'] / stats['seconds'] if stats['seconds'] else None
+        return hosts
+
+# Builds the machine-readable report of a collection (it's written as collect-report.json into the log pack),
+# so the performance of the collections can be compared across runs. phases: {name: seconds}
+# (eg. planning, downloads), extra is merged into the report (eg. the results of the clusters).
+def build_report(scheduler: TransferScheduler, decompressor: Decompressor, phases: dict, extra: dict) -> dict:
+    transferred = sum(r['bytes'] for r in scheduler.results)
+    download_seconds = phases.get('downloads')
+    return {
+        'command': sys.argv,
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'phases': phases,
+        'planned_bytes': scheduler.planned_size,
+        'transferred_bytes': transferred,
+        'throughput': transferred / download_seconds if download_seconds else None,
+        'transfers': len(scheduler.results),
+        'failed_transfers': sum(1 for r in scheduler.results if r['error']),
+        'retries': sum(r['attempts'] - 1 for r in scheduler.results),
+        'decompression': decompressor.stats,
+        'ssh': paramiko_utils.metrics.summary(),
+        'hosts': scheduler.host_report(),
+        'transfer_list': scheduler.results,
+        **extra,
+    }
+
+def write_report(filepath: str, report: dict):
+    with open(filepath, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+
+# a few lines about the report for the summary at the end of the collection
+def report_summary(report: dict, slowest: int = 3) -> list[str]:
+    lines = []
+    throughput = format_size(report['throughput']) + '/s' if report['throughput'] else '-'
+    lines.append(f'transferred {format_size(report["transferred_bytes"])} (planned {format_size(report["planned_bytes"])}) '
+                 f'in {report["transfers"]} transfers, {throughput}, {report["retries"]} retries, {report["failed_transfers"]} failed')
+    lines.append('time: ' + ', '.join(f'{name} {seconds:.1f}s' for name, seconds in report['phases'].items()))
+    ssh = report['ssh']['by_kind']
+    lines.append('ssh: ' + ', '.join(f'{kind} {stats["count"]}x {stats["seconds"]:.1f}s' for kind, stats in ssh.items()))
+    decompression = report['decompression']
+    lines.append(f'zstd: {decompression["files"]} files ({format_size(decompression["bytes"])}) in {decompression["seconds"]:.1f}s, '
+                 f'waited {decompression["wait_seconds"]:.1f}s for it after the downloads')
+    hosts = [(host, stats) for host, stats in report['hosts'].items() if stats['throughput']]
+    hosts.sort(key=lambda h: h[1]['throughput'])
+    for host, stats in hosts[:slowest]:
+        lines.append(f'slow host: {host} {format_size(stats["throughput"])}/s ({format_size(stats["bytes"])} in {stats["seconds"]:.1f}s)')
+    return lines
+
+# Tells the cluster and the host of a logfile from its path in a log pack (relative to the pack). The layouts are:
+#  collect.py: <cluster>_sup<N>_<ip>/<file> for FMs (host is supN), <cluster>/<blade>/<file> for blades
+#  collect-fuse.py: <fmN or fbN>/<file>, the cluster is in the name of the pack: <cluster>_<date>-T<hour>
+# Files directly in the pack (eg. ir_test.log) are from the local host.
+def parse_pack_path(pack_dir: str, relpath: str) -> tuple[str, str]:
+    parts = relpath.split(os.sep)
+    pack_cluster = os.path.basename(os.path.normpath(pack_dir)).split('_')[0]
+    if len(parts) == 1:
+        return pack_cluster, 'local'
+    if len(parts) == 2:
+        match = re.match(r'^(.+)_(sup\d)_[\d.]+$', parts[0])
+        if match:
+            return match.group(1), match.group(2)
+        return pack_cluster, parts[0]
+    return parts[-3], parts[-2]
+
+def link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f'{hours}h{minutes:02d}m'
+    if minutes:
+        return f'{minutes}m{seconds:02d}s'
+    return f'{seconds}s'
+
+def format_size(size: float) -> str:
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GB'
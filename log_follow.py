@@ -0,0 +1,171 @@
+# Follows logs on many hosts at the same time (collect.py --follow):
+# one 'tail -F' per log per host, every one of them on its own channel of the (pooled, nested) connections,
+# and all the channels are read by one loop with select, so there's no thread per log.
+#
+# The lines of the different logs are merged by their timestamps: a line is held back for `delay` seconds,
+# and the held back lines are released in the order of their timestamps, so the lines of a slower host
+# still get into their place. Lines without timestamp (eg. the rest of a multiline message) get the timestamp
+# of the line before them.
+#
+# Every log can have at most `max_buffer` bytes held back. When a log reaches it, its channel is not read until
+# the lines are released, so its ssh window fills up and the remote tail is stopped by the flow control of ssh
+# (instead of the memory filling up with the lines of a chatty blade). The same happens to every log when the output
+# is slow (eg. the pager is paused).
+import heapq
+import os
+import select
+import shlex
+import time
+
+import paramiko
+
+import log_index
+
+# the ssh window of a channel (paramiko's default is 2 MB), this much can be on the way from a log that is not read
+WINDOW_SIZE = 1024 * 1024
+# a longer line is cut, so one line can't fill up the buffer
+MAX_LINE_SIZE = 64 * 1024
+
+# tail -F follows the log through the rotations, -n 0: only the new lines.
+# The filters run on the remote (like with --grep), so only the matching lines are sent.
+# services: only the lines containing any of these (eg. replication::replica_link_manager) are kept
+# pattern: only the lines matching this extended regex are kept (applied after the services)
+def build_follow_command(remote_filepath: str, pattern: str = None, services: list[str] = None) -> str:
+    commands = [f'tail -F -n 0 -- {shlex.quote(remote_filepath)} 2>/dev/null']
+    if services:
+        commands.append('grep --line-buffered -F ' + ' '.join(f'-e {shlex.quote(s)}' for s in services))
+    if pattern:
+        commands.append(f'grep --line-buffered -E -e {shlex.quote(pattern)}')
+    return ' | '.join(commands)
+
+class Stream:
+    def __init__(self, tag: str, channel: paramiko.Channel):
+        self.tag = tag
+        self.channel = channel
+        # the end of the data which is not a whole line yet
+        self.partial = b''
+        self.timestamp = ''
+        # the size of the lines which are held back
+        self.buffered = 0
+        self.paused = False
+
+class LogFollower:
+    def __init__(self, delay: float = 1, max_buffer: int = 4 * 1024 * 1024):
+        self.delay = delay
+        self.max_buffer = max_buffer
+        self._streams = []
+        # (timestamp, sequence number, arrival, stream, line), the sequence number keeps the order of the lines of a log
+        self._heap = []
+        self._sequence = 0
+        self.stats = {'lines': 0, 'bytes': 0, 'pauses': 0, 'cut_lines': 0}
+
+    # starts following the command (see build_follow_command) on the client, its lines are tagged with tag
+    def add(self, client: paramiko.SSHClient, tag: str, command: str):
+        channel = client.get_transport().open_session(window_size=WINDOW_SIZE)
+        channel.exec_command(command)
+        channel.shutdown_write()
+        self._streams.append(Stream(tag, channel))
+
+    # yields (timestamp, tag, line) merged by timestamp, until every stream ended (or the generator is closed)
+    def lines(self):
+        try:
+            while self._streams or self._heap:
+                yield from self._release(time.monotonic() - self.delay if self._streams else float('inf'))
+                readable = [s.channel for s in self._streams if not s.paused]
+                # waking up when the first held back line has to be released
+                timeout = max(0, self._heap[0][2] + self.delay - time.monotonic()) if self._heap else self.delay
+                if readable:
+                    readable, _, _ = select.select(readable, [], [], min(timeout, self.delay))
+                else:
+                    time.sleep(timeout)
+                for stream in [s for s in self._streams if s.channel in readable]:
+                    self._read(stream)
+        finally:
+            self.close()
+
+    def _read(self, stream: Stream):
+        data = stream.channel.recv(65536)
+        if not data:
+            if stream.partial:
+                self._push(stream, stream.partial)
+            print(f'[{stream.tag}] following ended (exit status: {stream.channel.recv_exit_status()})', flush=True)
+            stream.channel.close()
+            self._streams.remove(stream)
+            return
+        self.stats['bytes'] += len(data)
+        *lines, stream.partial = (stream.partial + data).split(b'\n')
+        for line in lines:
+            self._push(stream, line)
+        if len(stream.partial) > MAX_LINE_SIZE:
+            self.stats['cut_lines'] += 1
+            self._push(stream, stream.partial)
+            stream.partial = b''
+        if stream.buffered >= self.max_buffer:
+            stream.paused = True
+            self.stats['pauses'] += 1
+
+    def _push(self, stream: Stream, line: bytes):
+        if log_index.TIMESTAMP_RE.match(line):
+            stream.timestamp = line[:23].decode(errors='replace').replace('T', ' ', 1)
+        stream.buffered += len(line)
+        self._sequence += 1
+        heapq.heappush(self._heap, (stream.timestamp, self._sequence, time.monotonic(), stream, line))
+
+    # releases the lines which arrived before until (in the order of their timestamps)
+    def _release(self, until: float):
+        while self._heap and self._heap[0][2] <= until:
+            timestamp, _, _, stream, line = heapq.heappop(self._heap)
+            stream.buffered -= len(line)
+            if stream.paused and stream.buffered < self.max_buffer / 2:
+                stream.paused = False
+            self.stats['lines'] += 1
+            yield timestamp, stream.tag, line.decode('utf-8', errors='replace')
+
+    def close(self):
+        for stream in self._streams:
+            stream.channel.close()
+        self._streams = []
+
+# Follows a local file like 'tail -F -n 0' (eg. ir_test.log for collect.py --watch): yields its new lines,
+# polling it every interval seconds. It waits for the file if it doesn't exist yet, and when it's replaced
+# (eg. by the next test run) or truncated, the new content is read from its beginning.
+def tail_local_file(filepath: str, interval: float = 1):
+    f = None
+    # only the lines written after the start are wanted, the ones already in the file are skipped
+    skip_existing = True
+    partial = b''
+    try:
+        while True:
+            if f is None:
+                try:
+                    f = open(filepath, 'rb')
+                except FileNotFoundError:
+                    skip_existing = False
+                    time.sleep(interval)
+                    continue
+                if skip_existing:
+                    f.seek(0, os.SEEK_END)
+                skip_existing = False
+                partial = b''
+            data = f.read()
+            if data:
+                *lines, partial = (partial + data).split(b'\n')
+                for line in lines:
+                    yield line.decode('utf-8', errors='replace')
+                continue
+            try:
+                stat = os.stat(filepath)
+            except FileNotFoundError:
+                stat = None
+            if stat is None or stat.st_ino != os.fstat(f.fileno()).st_ino:
+                f.close()
+                f = None
+                continue
+            if stat.st_size < f.tell():
+                f.seek(0)
+                partial = b''
+                continue
+            time.sleep(interval)
+    finally:
+        if f:
+            f.close()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# Index of the logfiles of a log pack (made by collect.py or collect-fuse.py), so the lines of a time window
+# (and of some services) can be found without scanning every file with ack/grep.
+#
+# The index is a sqlite file in the log pack (log-index.sqlite) with:
+#  - files: every indexed logfile with its cluster, host and the time range of its lines
+#  - runs: the byte ranges of the minutes in the files, so a query can seek to the minutes it needs
+#    (a new run starts when a line with a timestamp of a different minute comes, the lines without
+#    timestamp belong to the run of the line before them)
+#  - services: which services (loggers) have lines in which minute of which file, with the number of lines
+# For .zst files the offsets are in the decompressed data, so they're decompressed from the beginning
+# when they're queried, but only the lines in the wanted minutes are parsed.
+#
+# usage:
+#   log_index.py build <log pack>   (or use --index with collect.py/collect-fuse.py, then it's built while the files land)
+#   log_index.py query <log pack> --since '2024-01-30 17:05' --until '2024-01-30 17:10' --service replication::replica_link_manager
+import argparse
+import collections
+import concurrent.futures
+import os
+import re
+import sqlite3
+import sys
+import threading
+
+import collect_utils
+
+INDEX_FILENAME = 'log-index.sqlite'
+
+# a line starts with a timestamp like '2024-01-30 17:05:30.123' (or with 'T' instead of the space)
+TIMESTAMP_RE = re.compile(rb'^\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d')
+# the service (logger) of a line is the first word after the timestamp which looks like a module path,
+# eg. 'replication::replica_link_manager' or 'replication.client'
+SERVICE_RE = re.compile(rb' ([A-Za-z_]\w*(?:(?:::|\.)[A-Za-z_]\w*)+)[\s:\]]')
+
+# only these are indexed (the rotated ones too, like nfs.log.2024-01-30.17-00-00.zst)
+LOGFILE_RE = re.compile(r'\.log(\.|$)')
+
+def minute_of(line: bytes) -> str:
+    return (line[:10] + b' ' + line[11:16]).decode()
+
+def service_of(line: bytes) -> str:
+    match = SERVICE_RE.search(line, 19, 200)
+    return match.group(1).decode() if match else None
+
+# Reads one logfile and returns its time range, runs and services,
+# runs: [(minute, start offset, end offset)], services: {(service, minute): number of lines}
+def scan_logfile(filepath: str) -> dict:
+    runs = []
+    services = collections.Counter()
+    first_time = last_time = None
+    minute = None
+    run_start = offset = 0
+    lines = 0
+    with collect_utils.open_log(filepath) as f:
+        for line in f:
+            if TIMESTAMP_RE.match(line):
+                line_minute = minute_of(line)
+                if line_minute != minute:
+                    if minute is not None:
+                        runs.append((minute, run_start, offset))
+                    minute = line_minute
+                    run_start = offset
+                timestamp = line[:19].decode().replace('T', ' ')
+                if first_time is None or timestamp < first_time:
+                    first_time = timestamp
+                if last_time is None or timestamp > last_time:
+                    last_time = timestamp
+                service = service_of(line)
+                if service:
+                    services[(service, minute)] += 1
+            offset += len(line)
+            lines += 1
+    if minute is not None:
+        runs.append((minute, run_start, offset))
+    return {'first_time': first_time, 'last_time': last_time, 'lines': lines, 'runs': runs, 'services': services}
+
+class LogIndex:
+    def __init__(self, pack_dir: str):
+        self.pack_dir = pack_dir
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(pack_dir, INDEX_FILENAME), check_same_thread=False)
+        with self._db:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS files (
+                    id INTEGER PRIMARY KEY, path TEXT UNIQUE, cluster TEXT, host TEXT, logname TEXT,
+                    size INTEGER, mtime INTEGER, first_time TEXT, last_time TEXT, lines INTEGER);
+                CREATE TABLE IF NOT EXISTS runs (file_id INTEGER, minute TEXT, start INTEGER, end INTEGER);
+                CREATE INDEX IF NOT EXISTS runs_by_file ON runs (file_id, minute);
+                CREATE TABLE IF NOT EXISTS services (service TEXT, file_id INTEGER, minute TEXT, lines INTEGER);
+                CREATE INDEX IF NOT EXISTS services_by_name ON services (service, minute);
+            """)
+
+    # indexes the file, if it's not indexed yet (or it changed since it was indexed)
+    def add(self, filepath: str):
+        relpath = os.path.relpath(filepath, self.pack_dir)
+        stat = os.stat(filepath)
+        with self._lock:
+            row = self._db.execute('SELECT id, size, mtime FROM files WHERE path=?', (relpath,)).fetchone()
+        if row and row[1:] == (stat.st_size, int(stat.st_mtime)):
+            return
+        scan = scan_logfile(filepath)
+        cluster, host = collect_utils.parse_pack_path(self.pack_dir, relpath)
+        logname = re.sub(r'\.log\..*$', '.log', os.path.basename(relpath))
+        with self._lock, self._db:
+            if row:
+                self._remove(row[0])
+            file_id = self._db.execute('INSERT INTO files VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                       (relpath, cluster, host, logname, stat.st_size, int(stat.st_mtime),
+                                        scan['first_time'], scan['last_time'], scan['lines'])).lastrowid
+            self._db.executemany('INSERT INTO runs VALUES (?, ?, ?, ?)', [(file_id, *run) for run in scan['runs']])
+            self._db.executemany('INSERT INTO services VALUES (?, ?, ?, ?)',
+                                 [(service, file_id, minute, lines) for (service, minute), lines in scan['services'].items()])
+
+    # must be called with self._lock held
+    def _remove(self, file_id: int):
+        for table, column in (('files', 'id'), ('runs', 'file_id'), ('services', 'file_id')):
+            self._db.execute(f'DELETE FROM {table} WHERE {column}=?', (file_id,))
+
+    # (id, first_time, last_time) of an indexed file (path is relative to the pack), None if it's not indexed
+    def file(self, relpath: str) -> tuple:
+        with self._lock:
+            return self._db.execute('SELECT id, first_time, last_time FROM files WHERE path=?', (relpath,)).fetchone()
+
+    # the files with lines between since and until (strings like '2024-01-30 17:05:00'), host: regex of cluster/host
+    def files(self, since: str, until: str, host: str = None, logname: str = None) -> list[tuple]:
+        query = 'SELECT id, path, cluster, host FROM files WHERE first_time <= ? AND last_time >= ?'
+        params = [until, since]
+        if logname:
+            query += ' AND logname = ?'
+            params.append(logname)
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY cluster, host, path', params).fetchall()
+        return [r for r in rows if not host or re.search(host, f'{r[2]}/{r[3]}')]
+
+    # the byte ranges of the file to read for the lines between since and until (of the service, if it's set)
+    def ranges(self, file_id: int, since: str, until: str, service: str = None) -> list[tuple[int, int]]:
+        query = 'SELECT start, end FROM runs WHERE file_id = ? AND minute >= ? AND minute <= ?'
+        params = [file_id, since[:16], until[:16]]
+        if service:
+            query += ' AND minute IN (SELECT minute FROM services WHERE service = ? AND file_id = ?)'
+            params += [service, file_id]
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY start', params).fetchall()
+        # neighbouring runs are read at once
+        ranges = []
+        for start, end in rows:
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    # yields (cluster, host, path, line) of the lines between since and until
+    def query(self, since: str, until: str, service: str = None, host: str = None, logname: str = None):
+        for file_id, relpath, cluster, file_host in self.files(since, until, host, logname):
+            keep = False
+            for line in read_ranges(os.path.join(self.pack_dir, relpath), self.ranges(file_id, since, until, service)):
+                if TIMESTAMP_RE.match(line):
+                    timestamp = line[:19].decode().replace('T', ' ')
+                    keep = since <= timestamp <= until and (not service or service_of(line) == service)
+                if keep:
+                    yield cluster, file_host, relpath, line.decode('utf-8', errors='replace').rstrip('\n')
+
+    def close(self):
+        self._db.close()
+
+# yields the lines of the byte ranges (sorted by start) of the file
+def read_ranges(filepath: str, ranges: list[tuple[int, int]]):
+    if not ranges:
+        return
+    with collect_utils.open_log(filepath) as f:
+        position = 0
+        for start, end in ranges:
+            if f.seekable():
+                f.seek(start)
+            else:
+                while position < start:
+                    data = f.read(min(1024 * 1024, start - position))
+                    if not data:
+                        # the range is past the end of the file (it is shorter than when it was indexed)
+                        return
+                    position += len(data)
+            position = start
+            while position < end:
+                line = f.readline()
+                if not line:
+                    break
+                position += len(line)
+                yield line
+
+# Indexes the logfiles in the background while the other files are downloaded (see Decompressor's on_done).
+class LogIndexer:
+    def __init__(self, pack_dir: str, workers: int = None):
+        self.index = LogIndex(pack_dir)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self._futures = {}
+
+    # can be called with any file, only the logfiles are indexed
+    def submit(self, filepath: str):
+        if LOGFILE_RE.search(os.path.basename(filepath)):
+            self._futures[self._executor.submit(self.index.add, filepath)] = filepath
+
+    # waits for every file, returns the ones which could not be indexed
+    def wait(self) -> list[str]:
+        failed = []
+        for future in concurrent.futures.as_completed(self._futures):
+            if future.exception():
+                failed.append(self._futures[future])
+        self._executor.shutdown()
+        self.index.close()
+        return failed
+
+def build(pack_dir: str):
+    indexer = LogIndexer(pack_dir)
+    for root, dirs, files in os.walk(pack_dir):
+        for filename in files:
+            indexer.submit(os.path.join(root, filename))
+    failed = indexer.wait()
+    if failed:
+        print(f'Error: could not index: {failed}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                        prog='log_index.py',
+                        description='Indexes the logs of a log pack and finds lines in them by time, host and service',
+                        formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='index (or update the index of) a log pack')
+    build_parser.add_argument('pack', type=str, help='the directory of the log pack')
+    query_parser = subparsers.add_parser('query', help='print the lines of a time window')
+    query_parser.add_argument('pack', type=str, help='the directory of the log pack')
+    query_parser.add_argument('--since', type=str, required=True, help='format: "YYYY-MM-DD HH:MM[:SS]"')
+    query_parser.add_argument('--until', type=str, required=True, help='format: "YYYY-MM-DD HH:MM[:SS]"')
+    query_parser.add_argument('--service', type=str, help='only the lines of this service (ex. replication::replica_link_manager)')
+    query_parser.add_argument('--host', type=str, help='only the hosts matching this regex (matched against <cluster>/<host>, ex. "c01/ir[12]$")')
+    query_parser.add_argument('--log', type=str, help='only this kind of logfile (ex. nfs.log)')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build(args.pack)
+        exit(0)
+
+    if not os.path.exists(os.path.join(args.pack, INDEX_FILENAME)):
+        print(f'Error: {args.pack} is not indexed, run: log_index.py build {args.pack}')
+        exit(1)
+    since = collect_utils.parse_time(args.since).strftime('%Y-%m-%d %H:%M:%S')
+    until = collect_utils.parse_time(args.until).strftime('%Y-%m-%d %H:%M:%S')
+    index = LogIndex(args.pack)
+    try:
+        for cluster, host, relpath, line in index.query(since, until, args.service, args.host, args.log):
+            print(f'{cluster}/{host}/{os.path.basename(relpath)}: {line}')
+    except BrokenPipeError:
+        # eg. piped into head
+        sys.stderr.close()
+    index.close()
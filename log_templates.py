@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# Turns every line of the logs of a log pack into a template (the message with the variable parts masked,
+# like 'INFO replication.client link <num> to <ip> failed after <num>s') and counts the lines of every template
+# per minute per host, so two packs (eg. a failed and a good run) can be compared by what was logged:
+# which messages are new and which ones are logged much more than before.
+#
+# The logfiles are read in blocks (.zst files through zstd), and the masking is done on the whole block at once,
+# not line by line (see mask), then the (minute, template) pairs of a block are counted with a Counter.
+# The files are processed by worker processes, big uncompressed files are split into chunks between them.
+# The result is kept in the pack (log-templates.npz): the templates, minutes and hosts are stored only once
+# and the counts are arrays of (template, minute, host, count), so a whole pack fits into a few MBs.
+# Lines without timestamp (eg. the rest of a multiline message) are not counted.
+#
+# usage:
+#   log_templates.py build <log pack>   (diff and top build it if it's missing or the pack changed)
+#   log_templates.py top <log pack> --service replication -n 20
+#   log_templates.py diff <good pack> <bad pack> --host 'ir[0-9]+$'
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import re
+import sys
+
+import numpy as np
+
+import collect_utils
+import log_index
+
+STORE_FILENAME = 'log-templates.npz'
+# the size of the blocks the files are read (and masked) in
+BLOCK_SIZE = 8 * 1024 * 1024
+# uncompressed files bigger than this are split between the workers
+CHUNK_SIZE = 256 * 1024 * 1024
+# a template is cut after this many bytes (eg. a line with a big dump in it)
+MAX_TEMPLATE_SIZE = 300
+# the templates after this many different ones in a chunk are counted as '<other>' (per service),
+# so a log with badly masked lines can't eat up the memory
+MAX_TEMPLATES_PER_CHUNK = 100000
+# the counts of the chunks are summed up (rows of the same template, minute and host merged) when they have at least
+# this many rows and twice as many as after the last merge
+MIN_ROWS_TO_MERGE = 1000000
+
+# The masking is done in two steps, both on many lines at once:
+#  - mask_ids on the whole block: the ids (uuids, 0x... and hex strings of at least 8 chars) are replaced by a regex,
+#    and every digit is turned into a \1 by bytes.translate (which runs in C, much faster than a regex substitution
+#    with a match in every few bytes)
+#  - mask_numbers only on the distinct lines of the block after that (the same message with numbers of the same
+#    length is the same line by then): the runs of \1s are collapsed, the ips and the fractions are replaced,
+#    and finally every \1 becomes a <num>, again by bytes.replace on the distinct lines joined together.
+# The timestamps are masked too (<num>-<num>-<num> <num>:<num>:<num>), they are cut from the templates
+# only after the counting, so it is done only once per distinct template and not per line.
+IDS_RE = re.compile(rb'\b[0-9a-fA-F](?:x[0-9a-fA-F]+|[0-9a-fA-F]{7,}(?:-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})?)\b')
+DIGITS_TO_MARKS = bytes.maketrans(b'0123456789', b'\1' * 10)
+MASKED_TIMESTAMP_RE = re.compile(rb'^<num>-<num>-<num>[ T]<num>:<num>:<num>(?:[.,]<num>)?(?:Z|[+-]<num>(?::<num>)?)?\s*')
+LEVEL_RE = re.compile(r'^\[?(TRACE|DEBUG|INFO|NOTICE|WARN|WARNING|ERROR|ERR|CRIT|CRITICAL|FATAL|[TDIWEFC])\]?$')
+
+def mask_id(match: re.Match) -> bytes:
+    id = match.group()
+    if len(id) == 36 and id[8:9] == b'-':
+        return b'<uuid>'
+    # a number is masked as a number (so the template is the same as with a shorter one) unless it's as long as
+    # a 64 bit id, 'ax12' is not an id
+    if id.isdigit() and len(id) < 16 or id[1:2] == b'x' and id[:1] != b'0':
+        return id
+    # the fraction of a float with exponent (1.2345678e-05)
+    if id[:-1].isdigit() and id[-1:] in b'eE' and match.string[match.start() - 1:match.start()] == b'.':
+        return id
+    return b'<hex>'
+
+def mask_ids(block: bytes) -> bytes:
+    block = IDS_RE.sub(mask_id, block)
+    # the \1s of the log itself are deleted, so they can't be mistaken for digits
+    return block.translate(DIGITS_TO_MARKS, b'\1')
+
+def mask_numbers(block: bytes) -> bytes:
+    while b'\1\1' in block:
+        block = block.replace(b'\1\1\1\1', b'\1').replace(b'\1\1', b'\1')
+    block = block.replace(b'\1.\1.\1.\1', b'<ip>').replace(b'<ip>:\1', b'<ip>')
+    block = block.replace(b'\1.\1', b'\1').replace(b'\1e-\1', b'\1').replace(b'\1e+\1', b'\1')
+    return block.replace(b'\1', b'<num>')
+
+# the level and the service of a template (the first word and the first module path like word after the timestamp)
+def level_and_service(template: str) -> tuple[str, str]:
+    words = template.split(None, 1)
+    level = LEVEL_RE.match(words[0]).group(1) if words and LEVEL_RE.match(words[0]) else ''
+    service = log_index.service_of(b' ' * 19 + b' ' + template.encode())
+    return level, service or ''
+
+# counts the lines of one block into counts: Counter of (minute, template)
+def count_block(block: bytes, counts: collections.Counter):
+    lines = block.split(b'\n')
+    templates = mask_ids(block).split(b'\n')
+    block_counts = collections.Counter(zip([line[:16] for line in lines], [template[:MAX_TEMPLATE_SIZE] for template in templates]))
+    templates = mask_numbers(b'\n'.join(template for _, template in block_counts)).split(b'\n')
+    for ((minute, _), count), template in zip(block_counts.items(), templates):
+        counts[(minute, template)] += count
+
+def blocks(filepath: str, start: int = 0, end: int = None):
+    with collect_utils.open_log(filepath) as f:
+        if start:
+            # the line which started before start belongs to the previous chunk
+            f.seek(start - 1)
+            f.readline()
+        position = f.tell() if end is not None else 0
+        rest = b''
+        while end is None or position <= end:
+            data = f.read(BLOCK_SIZE if end is None else min(BLOCK_SIZE, end - position + 1))
+            if not data:
+                break
+            position += len(data)
+            block, newline, rest = (rest + data).rpartition(b'\n')
+            if newline:
+                yield block
+        if end is not None and rest:
+            # the line going over end is finished in this chunk
+            rest += f.readline()
+        if rest:
+            yield rest.rstrip(b'\n')
+
+# Runs in a worker process: {(minute, template): count} of a chunk of a file (or of the whole file)
+def count_chunk(filepath: str, start: int = 0, end: int = None) -> dict:
+    result = collections.Counter()
+    templates = set()
+    for block in blocks(filepath, start, end):
+        counts = collections.Counter()
+        count_block(block, counts)
+        for (minute, template), count in counts.items():
+            # the lines without timestamp are not counted
+            match = MASKED_TIMESTAMP_RE.match(template)
+            if not match:
+                continue
+            template = template[match.end():].strip().decode('utf-8', errors='replace')
+            if template not in templates:
+                if len(templates) >= MAX_TEMPLATES_PER_CHUNK:
+                    template = f'{level_and_service(template)[1]} <other>'
+                templates.add(template)
+            result[(minute.replace(b'T', b' ').decode(errors='replace'), template)] += count
+    return result
+
+# sums up the rows of the same (template id, minute id, host id) key: the keys are int32 arrays of shape (n, 3)
+def merge_counts(keys: list[np.ndarray], counts: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    unique_keys, inverse = np.unique(np.concatenate(keys), axis=0, return_inverse=True)
+    merged = np.bincount(inverse.reshape(-1), weights=np.concatenate(counts), minlength=len(unique_keys))
+    return unique_keys, merged.astype(np.int64)
+
+# [(relpath, start, end)], the uncompressed files are split into chunks at CHUNK_SIZE
+def plan_chunks(pack_dir: str, relpaths: list[str]) -> list[tuple]:
+    chunks = []
+    for relpath in relpaths:
+        size = os.path.getsize(os.path.join(pack_dir, relpath))
+        if relpath.endswith('.zst') or size <= CHUNK_SIZE:
+            chunks.append((relpath, 0, None))
+            continue
+        for start in range(0, size, CHUNK_SIZE):
+            chunks.append((relpath, start, min(start + CHUNK_SIZE, size) - 1))
+    return chunks
+
+def find_logfiles(pack_dir: str) -> list[str]:
+    relpaths = []
+    for root, dirs, files in os.walk(pack_dir):
+        for filename in files:
+            if log_index.LOGFILE_RE.search(filename) and not filename.startswith('atop_raw.log') and not filename.endswith('.part'):
+                relpaths.append(os.path.relpath(os.path.join(root, filename), pack_dir))
+    return sorted(relpaths)
+
+# what the store was built from, to know if it has to be built again
+def sources_of(pack_dir: str, relpaths: list[str]) -> str:
+    stats = [(relpath, os.stat(os.path.join(pack_dir, relpath))) for relpath in relpaths]
+    return json.dumps([(relpath, stat.st_size, int(stat.st_mtime)) for relpath, stat in stats])
+
+def store_filepath(pack_dir: str) -> str:
+    return os.path.join(pack_dir, STORE_FILENAME)
+
+def build(pack_dir: str, workers: int = None, force: bool = False) -> bool:
+    relpaths = find_logfiles(pack_dir)
+    sources = sources_of(pack_dir, relpaths)
+    if not force and os.path.exists(store_filepath(pack_dir)):
+        with np.load(store_filepath(pack_dir)) as stored:
+            if str(stored['sources']) == sources:
+                return False
+    chunks = plan_chunks(pack_dir, relpaths)
+    print(f'counting the templates of {len(relpaths)} logfiles ({len(chunks)} chunks) in {pack_dir} ...')
+    # the strings are stored only once, the counts refer to them by index
+    templates, minutes, hosts = {}, {}, {}
+    # the counts of the chunks as arrays (a tuple per key in a dict would take ~10x more memory),
+    # merged from time to time, so only the different keys are kept
+    keys, counts = [], []
+    rows, merged_rows = 0, 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {executor.submit(count_chunk, os.path.join(pack_dir, relpath), start, end): relpath for relpath, start, end in chunks}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            # dropping the future, so the result of the chunk is freed once it is merged
+            relpath = futures.pop(future)
+            try:
+                chunk_counts = future.result()
+            except Exception as e:
+                print(f'Error: could not read {relpath}: {e!r}')
+                continue
+            cluster, host = collect_utils.parse_pack_path(pack_dir, relpath)
+            host_id = hosts.setdefault(f'{cluster}/{host}', len(hosts))
+            keys.append(np.array([(templates.setdefault(template, len(templates)), minutes.setdefault(minute, len(minutes)), host_id)
+                                  for minute, template in chunk_counts], dtype=np.int32).reshape(-1, 3))
+            counts.append(np.fromiter(chunk_counts.values(), dtype=np.int64, count=len(chunk_counts)))
+            rows += len(chunk_counts)
+            if rows >= max(MIN_ROWS_TO_MERGE, 2 * merged_rows):
+                merged_keys, merged_counts = merge_counts(keys, counts)
+                keys, counts = [merged_keys], [merged_counts]
+                rows = merged_rows = len(merged_keys)
+            print(f'\r{done}/{len(chunks)} chunks, {len(templates)} templates', end='', flush=True)
+    print()
+    keys, counts = merge_counts(keys, counts) if keys else (np.zeros((0, 3), dtype=np.int32), np.zeros(0, dtype=np.int64))
+    levels, services = zip(*(level_and_service(t) for t in templates)) if templates else ((), ())
+    with open(store_filepath(pack_dir) + '.tmp', 'wb') as f:
+        np.savez_compressed(f, sources=np.array(sources),
+                            templates=np.array(list(templates), dtype=str), levels=np.array(levels, dtype=str), services=np.array(services, dtype=str),
+                            minutes=np.array(list(minutes), dtype=str), hosts=np.array(list(hosts), dtype=str),
+                            count_template=keys[:, 0], count_minute=keys[:, 1], count_host=keys[:, 2],
+                            count=counts)
+    os.replace(store_filepath(pack_dir) + '.tmp', store_filepath(pack_dir))
+    return True
+
+# The counts of a pack per template (in the time window, of the hosts and services matching the regexes):
+# {'templates', 'levels', 'services': arrays, 'counts': lines per template, 'peaks': max. lines in a minute, 'peak_minutes'}
+# (the store has to be built before)
+def load(pack_dir: str, since: str = None, until: str = None, host_re: str = None, service_re: str = None) -> dict:
+    with np.load(store_filepath(pack_dir)) as stored:
+        data = {key: stored[key] for key in stored.files}
+    selected = np.ones(len(data['count']), dtype=bool)
+    if since or until:
+        minutes = data['minutes']
+        in_window = np.ones(len(minutes), dtype=bool)
+        if since:
+            in_window &= minutes >= since[:16]
+        if until:
+            in_window &= minutes <= until[:16]
+        selected &= in_window[data['count_minute']]
+    if host_re:
+        selected &= np.array([bool(re.search(host_re, h)) for h in data['hosts']], dtype=bool)[data['count_host']]
+    if service_re:
+        selected &= np.array([bool(re.search(service_re, s)) for s in data['services']], dtype=bool)[data['count_template']]
+    template_ids = data['count_template'][selected]
+    minute_ids = data['count_minute'][selected]
+    count = data['count'][selected]
+    counts = np.bincount(template_ids, weights=count, minlength=len(data['templates'])).astype(np.int64)
+    # lines per (template, minute) summed over the hosts, then the busiest minute of every template
+    pairs, inverse = np.unique(template_ids.astype(np.int64) * len(data['minutes']) + minute_ids, return_inverse=True)
+    per_minute = np.bincount(inverse, weights=count).astype(np.int64)
+    peaks = np.zeros(len(data['templates']), dtype=np.int64)
+    peak_minutes = np.full(len(data['templates']), '', dtype=object)
+    order = np.lexsort((per_minute, pairs // len(data['minutes'])))
+    for pair, lines in zip(pairs[order], per_minute[order]):
+        # the last one of every template is its busiest minute
+        peaks[pair // len(data['minutes'])] = lines
+        peak_minutes[pair // len(data['minutes'])] = data['minutes'][pair % len(data['minutes'])]
+    return {'templates': data['templates'], 'levels': data['levels'], 'services': data['services'],
+            'counts': counts, 'peaks': peaks, 'peak_minutes': peak_minutes}
+
+# The templates of the bad pack, ranked: the new ones (not in the good pack) by their number of lines,
+# then the ones which have a bigger share of the lines than in the good pack, by the ratio of the shares.
+# Returns (new, over_represented), both lists of (score, good count, bad count, index in bad)
+def diff(good: dict, bad: dict, min_count: int = 10, min_ratio: float = 2) -> tuple[list, list]:
+    good_counts = dict(zip(zip(good['services'], good['templates']), good['counts']))
+    good_total = max(1, int(good['counts'].sum()))
+    bad_total = max(1, int(bad['counts'].sum()))
+    new, over_represented = [], []
+    for i, (service, template, count) in enumerate(zip(bad['services'], bad['templates'], bad['counts'])):
+        if count < min_count:
+            continue
+        good_count = good_counts.get((service, template), 0)
+        if not good_count:
+            new.append((int(count), 0, int(count), i))
+            continue
+        ratio = (count / bad_total) / (good_count / good_total)
+        if ratio >= min_ratio:
+            over_represented.append((ratio, int(good_count), int(count), i))
+    return sorted(new, reverse=True), sorted(over_represented, reverse=True)
+
+# rows: (score, good count, bad count, index), without compare only the bad count is printed (as lines)
+def print_templates(title: str, rows: list, data: dict, score_format: str, limit: int, compare: bool = True):
+    print(f'\n{title} ({len(rows)}):')
+    counts_header = f'{"score":>8} {"good":>9} {"bad":>9}' if compare else f'{"lines":>9}'
+    print(f'{counts_header} {"peak/min":>9} {"peak minute":<16}  template')
+    for score, good_count, count, i in rows[:limit]:
+        counts = f'{score_format.format(score):>8} {good_count:>9} {count:>9}' if compare else f'{count:>9}'
+        print(f'{counts} {data["peaks"][i]:>9} {data["peak_minutes"][i]:<16}  {data["templates"][i]}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                        prog='log_templates.py',
+                        description='Counts the message templates of the logs of log packs and compares two packs',
+                        formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help=f'count the templates of a log pack into {STORE_FILENAME}')
+    build_parser.add_argument('pack', type=str, help='the directory of the log pack')
+    build_parser.add_argument('--force', action='store_true', default=False, help='build it again even if the pack did not change')
+    top_parser = subparsers.add_parser('top', help='the most frequent templates of a pack')
+    top_parser.add_argument('pack', type=str, help='the directory of the log pack')
+    diff_parser = subparsers.add_parser('diff', help='the new and the over-represented templates of a pack compared to another one')
+    diff_parser.add_argument('good', type=str, help='the pack of the good run')
+    diff_parser.add_argument('bad', type=str, help='the pack of the failed run')
+    diff_parser.add_argument('--min-count', type=int, default=10, help='only the templates with at least this many lines in the failed run (default: 10)')
+    diff_parser.add_argument('--min-ratio', type=float, default=2, help='a template is over-represented if its share of the lines is this many times bigger (default: 2)')
+    for subparser in (build_parser, top_parser, diff_parser):
+        subparser.add_argument('-j', '--jobs', type=int, help='number of worker processes (default: the number of CPUs)')
+    for subparser in (top_parser, diff_parser):
+        subparser.add_argument('--since', type=str, help='only the lines after this time (format: "YYYY-MM-DD HH:MM"), for diff it is applied to both packs')
+        subparser.add_argument('--until', type=str, help='only the lines before this time (format: "YYYY-MM-DD HH:MM")')
+        subparser.add_argument('--host', type=str, help='only the hosts matching this regex (matched against <cluster>/<host>, ex. "ir[0-9]+$")')
+        subparser.add_argument('--service', type=str, help='only the templates of the services matching this regex (ex. "replication")')
+        subparser.add_argument('-n', '--num', type=int, default=30, help='number of templates to print (default: 30)')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'build':
+            if not build(args.pack, args.jobs, args.force):
+                print(f'{store_filepath(args.pack)} is up to date')
+            exit(0)
+        since = collect_utils.parse_time(args.since).strftime('%Y-%m-%d %H:%M') if args.since else None
+        until = collect_utils.parse_time(args.until).strftime('%Y-%m-%d %H:%M') if args.until else None
+        packs = [args.pack] if args.command == 'top' else [args.good, args.bad]
+        for pack in packs:
+            build(pack, args.jobs)
+        data = [load(pack, since, until, args.host, args.service) for pack in packs]
+        if args.command == 'top':
+            rows = sorted(((int(c), 0, int(c), i) for i, c in enumerate(data[0]['counts']) if c), reverse=True)
+            print(f'{int(data[0]["counts"].sum())} lines, {len(rows)} templates')
+            print_templates('most frequent templates', rows, data[0], '{}', args.num, compare=False)
+        else:
+            good, bad = data
+            print(f'good: {int(good["counts"].sum())} lines, {int(np.count_nonzero(good["counts"]))} templates')
+            print(f'bad:  {int(bad["counts"].sum())} lines, {int(np.count_nonzero(bad["counts"]))} templates')
+            new, over_represented = diff(good, bad, args.min_count, args.min_ratio)
+            print_templates('new templates (by lines)', new, bad, '{}', args.num)
+            print_templates('over-represented templates (by how many times bigger their share is)', over_represented, bad, '{:.1f}x', args.num)
+    except BrokenPipeError:
+        # eg. piped into head
+        sys.stderr.close()
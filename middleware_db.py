@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# Loads the middleware DB dumps of a log pack (logtype middleware_db_dump of collect.py/collect-fuse.py)
+# into one sqlite file in the pack (middleware-db.sqlite), so they can be queried and compared with SQL
+# instead of reading the dumps by hand.
+#
+# The dumps are plain SQL dumps (like pg_dump writes them): CREATE TABLE, then the rows with COPY ... FROM stdin
+# (or with INSERT INTO ... VALUES, one row per line), and the primary keys with ALTER TABLE ... ADD CONSTRAINT.
+# They're read line by line (.zst and .gz on the fly) and inserted in batches, so a dump is never in the memory.
+# Every table of the dumps is one table in the sqlite file with an extra _dump column (the id in the _dumps table),
+# every value is stored as text, as it is in the dump. Tables of other schemas than public are named <schema>.<table>.
+# The tables about the dumps start with _ (so they can't be mixed up with the tables of the dumps):
+#  - _dumps: every loaded dump with its cluster and host (eg. irp871-c01, sup1)
+#  - _tables: the number of rows of every table of every dump
+#  - _primary_keys: the primary key columns of the tables (from the dumps)
+# Every table is indexed by (_dump, primary key), and the key tables (array connections, replica links, realms)
+# by name too.
+#
+# A diff goes through the rows of the two dumps ordered by the primary key at the same time (on the index),
+# so it doesn't load either of them. The dumps can be in different packs (eg. two collection runs).
+#
+# usage:
+#   middleware_db.py load <log pack>      (collect.py and collect-fuse.py run it when middleware_db_dump is collected)
+#   middleware_db.py dumps <log pack>
+#   middleware_db.py diff <log pack>:irp871-c01/sup1 <log pack>:irp871-c01/sup2 --table 'replica_link|realm'
+#   middleware_db.py query <log pack> "SELECT d.cluster, d.host, r.* FROM realms r JOIN _dumps d ON d.id = r._dump"
+import argparse
+import contextlib
+import gzip
+import json
+import os
+import re
+import sqlite3
+import sys
+
+import collect_utils
+
+DB_FILENAME = 'middleware-db.sqlite'
+DUMP_RE = re.compile(r'^middleware_db_dump')
+KEY_TABLE_RE = re.compile(r'array_connection|replica_link|realm')
+BATCH_SIZE = 10000
+
+CREATE_TABLE_RE = re.compile(r'^CREATE (?:UNLOGGED )?TABLE (?:IF NOT EXISTS )?(\S+) \($')
+COPY_RE = re.compile(r'^COPY (\S+) \((.*)\) FROM stdin;$')
+INSERT_RE = re.compile(r'^INSERT INTO (\S+) (?:\((.*?)\) )?VALUES \((.*)\);$')
+ALTER_TABLE_RE = re.compile(r'^ALTER TABLE (?:ONLY )?(\S+)$')
+PRIMARY_KEY_RE = re.compile(r'PRIMARY KEY \((.*?)\)')
+# a value in VALUES (...): a string (with '' inside, maybe with a cast after it), NULL or anything else until the comma
+VALUE_RE = re.compile(r"\s*(?:E?'((?:[^']|'')*)'(?:::[\w ]+)?|(NULL)|([^,]*?))\s*(?:,|$)")
+COPY_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v', '\\': '\\'}
+
+# public.replica_links -> replica_links, "other".x -> other.x
+def table_name(name: str) -> str:
+    name = name.replace('"', '')
+    return name[len('public.'):] if name.startswith('public.') else name
+
+def column_names(columns: str) -> list[str]:
+    return [c.strip().strip('"') for c in columns.split(',')]
+
+def quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+def unescape_copy(value: str):
+    if value == '\\N':
+        return None
+    if '\\' not in value:
+        return value
+    return re.sub(r'\\(.)', lambda m: COPY_ESCAPES.get(m.group(1), m.group(1)), value)
+
+def parse_values(values: str) -> list:
+    row = []
+    for match in VALUE_RE.finditer(values):
+        if match.end() == match.start():
+            break
+        string, null, other = match.groups()
+        row.append(string.replace("''", "'") if string is not None else None if null else other)
+    return row
+
+@contextlib.contextmanager
+def open_dump(filepath: str):
+    if filepath.endswith('.gz'):
+        with gzip.open(filepath, 'rb') as f:
+            yield f
+        return
+    with collect_utils.open_log(filepath) as f:
+        yield f
+
+# Yields what's in a dump, line by line:
+#  ('table', name, columns), ('primary_key', name, columns) and ('rows', name, columns, rows) with at most BATCH_SIZE rows
+def parse_dump(lines):
+    table = None
+    alter_table = None
+    copy = None
+    rows = []
+    for line in lines:
+        line = line.decode('utf-8', errors='replace').rstrip('\n')
+        if copy:
+            if line == '\\.':
+                if rows:
+                    yield 'rows', *copy, rows
+                copy, rows = None, []
+                continue
+            rows.append([unescape_copy(value) for value in line.split('\t')])
+            if len(rows) >= BATCH_SIZE:
+                yield 'rows', *copy, rows
+                rows = []
+            continue
+        if table:
+            if line.startswith(')'):
+                yield 'table', table[0], table[1]
+                if table[2]:
+                    yield 'primary_key', table[0], table[2]
+                table = None
+                continue
+            column = line.strip().rstrip(',')
+            primary_key = PRIMARY_KEY_RE.match(column.partition('CONSTRAINT')[2].strip() if column.startswith('CONSTRAINT') else column)
+            if primary_key:
+                table[2] = column_names(primary_key.group(1))
+            elif column and not re.match(r'^(CONSTRAINT|UNIQUE|CHECK|FOREIGN KEY|EXCLUDE)\b', column):
+                name = column.split()[0].strip('"')
+                table[1].append(name)
+                if 'PRIMARY KEY' in column:
+                    table[2] = [name]
+            continue
+        if alter_table:
+            primary_key = PRIMARY_KEY_RE.search(line)
+            if primary_key:
+                yield 'primary_key', alter_table, column_names(primary_key.group(1))
+            alter_table = None
+            continue
+        if match := CREATE_TABLE_RE.match(line):
+            table = [table_name(match.group(1)), [], None]
+        elif match := COPY_RE.match(line):
+            copy = (table_name(match.group(1)), column_names(match.group(2)))
+        elif match := INSERT_RE.match(line):
+            yield 'rows', table_name(match.group(1)), column_names(match.group(2)) if match.group(2) else None, [parse_values(match.group(3))]
+        elif match := ALTER_TABLE_RE.match(line):
+            alter_table = table_name(match.group(1))
+        elif line.startswith('ALTER TABLE') and (primary_key := PRIMARY_KEY_RE.search(line)):
+            yield 'primary_key', table_name(line.split()[3] if line.split()[2] == 'ONLY' else line.split()[2]), column_names(primary_key.group(1))
+
+class MiddlewareDB:
+    def __init__(self, pack_dir: str):
+        self.pack_dir = pack_dir
+        self.db = sqlite3.connect(os.path.join(pack_dir, DB_FILENAME))
+        with self.db:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS _dumps (
+                    id INTEGER PRIMARY KEY, path TEXT UNIQUE, cluster TEXT, host TEXT, size INTEGER, mtime INTEGER);
+                CREATE TABLE IF NOT EXISTS _tables (dump_id INTEGER, name TEXT, rows INTEGER);
+                CREATE TABLE IF NOT EXISTS _primary_keys (name TEXT PRIMARY KEY, columns TEXT);
+            """)
+
+    def columns_of(self, table: str, schema: str = 'main') -> list[str]:
+        return [row[1] for row in self.db.execute(f'PRAGMA {schema}.table_info({quote(table)})')][1:]
+
+    # the primary key of the table, or all of its columns if the dump didn't have one
+    def key_of(self, table: str, schema: str = 'main') -> list[str]:
+        row = self.db.execute(f'SELECT columns FROM {schema}._primary_keys WHERE name=?', (table,)).fetchone()
+        return json.loads(row[0]) if row else self.columns_of(table, schema)
+
+    # a table gets the new columns of a newer schema version, the rows of the older dumps have NULL in them
+    def _ensure_table(self, table: str, columns: list[str]):
+        existing = self.columns_of(table)
+        if not existing:
+            self.db.execute(f'CREATE TABLE IF NOT EXISTS {quote(table)} (_dump INTEGER, {", ".join(quote(c) for c in columns)})')
+            return
+        for column in columns:
+            if column not in existing:
+                self.db.execute(f'ALTER TABLE {quote(table)} ADD COLUMN {quote(column)}')
+
+    # loads the dump, if it's not loaded yet (or it changed since it was loaded)
+    def load(self, filepath: str):
+        relpath = os.path.relpath(filepath, self.pack_dir)
+        stat = os.stat(filepath)
+        row = self.db.execute('SELECT id, size, mtime FROM _dumps WHERE path=?', (relpath,)).fetchone()
+        if row and row[1:] == (stat.st_size, int(stat.st_mtime)):
+            return
+        cluster, host = collect_utils.parse_pack_path(self.pack_dir, relpath)
+        print(f'loading {relpath} ...')
+        # one transaction for the whole dump, it's loaded either completely or not at all
+        with self.db:
+            if row:
+                self._remove(row[0])
+            dump_id = self.db.execute('INSERT INTO _dumps VALUES (NULL, ?, ?, ?, ?, ?)',
+                                      (relpath, cluster, host, stat.st_size, int(stat.st_mtime))).lastrowid
+            table_columns = {}
+            row_counts = {}
+            with open_dump(filepath) as f:
+                for kind, table, *rest in parse_dump(f):
+                    if kind == 'table':
+                        table_columns[table] = rest[0]
+                        self._ensure_table(table, rest[0])
+                    elif kind == 'primary_key':
+                        self.db.execute('INSERT OR REPLACE INTO _primary_keys VALUES (?, ?)', (table, json.dumps(rest[0])))
+                    else:
+                        columns, rows = rest
+                        columns = columns or table_columns.get(table) or self.columns_of(table)
+                        if not columns:
+                            raise Exception(f'INSERT without column names into {table}, which was not created in the dump')
+                        self._ensure_table(table, columns)
+                        placeholders = ', '.join('?' * (len(columns) + 1))
+                        self.db.executemany(f'INSERT INTO {quote(table)} (_dump, {", ".join(quote(c) for c in columns)}) VALUES ({placeholders})',
+                                            ([dump_id, *row] for row in rows))
+                        row_counts[table] = row_counts.get(table, 0) + len(rows)
+            for table in table_columns.keys() | row_counts.keys():
+                self.db.execute('INSERT INTO _tables VALUES (?, ?, ?)', (dump_id, table, row_counts.get(table, 0)))
+            self._create_indexes(table_columns.keys() | row_counts.keys())
+        print(f'loaded {relpath}: {sum(row_counts.values())} rows in {len(table_columns)} tables')
+
+    # the indexes are created after the rows are inserted (and only once), so the bulk insert doesn't update them
+    def _create_indexes(self, tables):
+        for table in tables:
+            key = self.key_of(table)
+            self.db.execute(f'CREATE INDEX IF NOT EXISTS {quote(table + "_by_key")} ON {quote(table)} (_dump, {", ".join(quote(c) for c in key)})')
+            if KEY_TABLE_RE.search(table) and 'name' in self.columns_of(table):
+                self.db.execute(f'CREATE INDEX IF NOT EXISTS {quote(table + "_by_name")} ON {quote(table)} (name)')
+
+    def _remove(self, dump_id: int):
+        for (table,) in self.db.execute('SELECT name FROM _tables WHERE dump_id=?', (dump_id,)).fetchall():
+            self.db.execute(f'DELETE FROM {quote(table)} WHERE _dump=?', (dump_id,))
+        self.db.execute('DELETE FROM _tables WHERE dump_id=?', (dump_id,))
+        self.db.execute('DELETE FROM _dumps WHERE id=?', (dump_id,))
+
+    # [(id, path, cluster, host)]
+    def dumps(self) -> list[tuple]:
+        return self.db.execute('SELECT id, path, cluster, host FROM _dumps ORDER BY cluster, host, path').fetchall()
+
+    # the dump matching the regex (against <cluster>/<host>/<file>), the newest one if more of them match
+    def find_dump(self, dump_re: str) -> tuple:
+        matching = [d for d in self.db.execute('SELECT id, path, cluster, host FROM _dumps ORDER BY mtime')
+                    if re.search(dump_re or '', f'{d[2]}/{d[3]}/{os.path.basename(d[1])}')]
+        if not matching:
+            raise Exception(f'no dump matching "{dump_re}" in {self.pack_dir}, see: middleware_db.py dumps {self.pack_dir}')
+        return matching[-1]
+
+    def close(self):
+        self.db.close()
+
+def load(pack_dir: str):
+    db = MiddlewareDB(pack_dir)
+    failed = []
+    for root, dirs, files in os.walk(pack_dir):
+        for filename in sorted(files):
+            if DUMP_RE.match(filename) and not filename.endswith('.part'):
+                try:
+                    db.load(os.path.join(root, filename))
+                except Exception as e:
+                    print(f'Error: could not load {os.path.join(root, filename)}: {e!r}')
+                    failed.append(os.path.join(root, filename))
+    db.close()
+    return failed
+
+# Yields the differences of a table between two dumps: ('-', key, row) only in a, ('+', key, row) only in b,
+# ('~', key, changes) in both but different, where changes is [(column, value in a, value in b)].
+# b_schema is the schema name of the other pack if it's attached, the columns which are only in one of them are skipped.
+def diff_table(db: MiddlewareDB, table: str, dump_a: int, dump_b: int, b_schema: str = 'main'):
+    b_columns = db.columns_of(table, b_schema)
+    columns = [c for c in db.columns_of(table) if c in b_columns] if b_columns else db.columns_of(table)
+    key = [c for c in db.key_of(table) if c in columns] or columns
+    key_indexes = [columns.index(c) for c in key]
+    select = f'SELECT {", ".join(quote(c) for c in columns)} FROM {{}}.{quote(table)} WHERE _dump=? ORDER BY {", ".join(quote(c) for c in key)}'
+    a_rows = db.db.execute(select.format('main'), (dump_a,)) if columns else iter(())
+    # a second cursor is needed for the other side
+    b_rows = db.db.cursor().execute(select.format(b_schema), (dump_b,)) if b_columns else iter(())
+    # the order of sqlite (NULL first, then the text values) in python
+    sort_key = lambda row: tuple((row[i] is not None, row[i] or '') for i in key_indexes)
+    key_of = lambda row: dict(zip(key, (row[i] for i in key_indexes)))
+    a_row, b_row = next(a_rows, None), next(b_rows, None)
+    while a_row is not None or b_row is not None:
+        if b_row is None or (a_row is not None and sort_key(a_row) < sort_key(b_row)):
+            yield '-', key_of(a_row), dict(zip(columns, a_row))
+            a_row = next(a_rows, None)
+        elif a_row is None or sort_key(b_row) < sort_key(a_row):
+            yield '+', key_of(b_row), dict(zip(columns, b_row))
+            b_row = next(b_rows, None)
+        else:
+            changes = [(c, a, b) for c, a, b in zip(columns, a_row, b_row) if a != b]
+            if changes:
+                yield '~', key_of(a_row), changes
+            a_row, b_row = next(a_rows, None), next(b_rows, None)
+
+def format_row(row: dict) -> str:
+    return ' '.join(f'{column}={value}' for column, value in row.items())
+
+def diff(spec_a: str, spec_b: str, table_re: str = None):
+    pack_a, _, dump_re_a = spec_a.partition(':')
+    pack_b, _, dump_re_b = spec_b.partition(':')
+    db = MiddlewareDB(pack_a)
+    dump_a = db.find_dump(dump_re_a)
+    b_schema = 'main'
+    if os.path.realpath(pack_a) == os.path.realpath(pack_b):
+        dump_b = db.find_dump(dump_re_b)
+    else:
+        db_b = MiddlewareDB(pack_b)
+        dump_b = db_b.find_dump(dump_re_b)
+        db_b.close()
+        db.db.execute('ATTACH DATABASE ? AS other', (os.path.join(pack_b, DB_FILENAME),))
+        b_schema = 'other'
+    print(f'--- {dump_a[2]}/{dump_a[3]}: {os.path.join(pack_a, dump_a[1])}')
+    print(f'+++ {dump_b[2]}/{dump_b[3]}: {os.path.join(pack_b, dump_b[1])}')
+    tables = sorted({name for (name,) in db.db.execute('SELECT name FROM main._tables WHERE dump_id=?', (dump_a[0],))} |
+                    {name for (name,) in db.db.execute(f'SELECT name FROM {b_schema}._tables WHERE dump_id=?', (dump_b[0],))})
+    for table in tables:
+        if table_re and not re.search(table_re, table):
+            continue
+        if not db.columns_of(table):
+            print(f'{table}: only in +++')
+            continue
+        counts = {'-': 0, '+': 0, '~': 0}
+        for sign, key, change in diff_table(db, table, dump_a[0], dump_b[0], b_schema):
+            counts[sign] += 1
+            if sign == '~':
+                print(f'{table}: ~ {format_row(key)}: ' + ', '.join(f'{c}: {a} -> {b}' for c, a, b in change))
+            else:
+                print(f'{table}: {sign} {format_row(change)}')
+        if any(counts.values()):
+            print(f'{table}: {counts["-"]} only in ---, {counts["+"]} only in +++, {counts["~"]} changed')
+    db.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                        prog='middleware_db.py',
+                        description=f'Loads the middleware DB dumps of a log pack into {DB_FILENAME}, queries and compares them',
+                        formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    load_parser = subparsers.add_parser('load', help='load the dumps of a log pack (the ones which are loaded already are skipped)')
+    load_parser.add_argument('pack', type=str, help='the directory of the log pack')
+    dumps_parser = subparsers.add_parser('dumps', help='list the loaded dumps')
+    dumps_parser.add_argument('pack', type=str, help='the directory of the log pack')
+    diff_parser = subparsers.add_parser('diff', help='compare two dumps table by table (by the primary keys)')
+    diff_parser.add_argument('a', type=str, help='<log pack>:<regex>, the regex is matched against <cluster>/<host>/<file> of the dumps,\nthe newest matching dump is used (ex. "irp871-c01_2024-01-30-T17-00-37:c01/sup1")')
+    diff_parser.add_argument('b', type=str, help='the other dump, the same way (it can be in an other log pack)')
+    diff_parser.add_argument('--table', type=str, help='only the tables matching this regex (ex. "replica_link|realm")')
+    query_parser = subparsers.add_parser('query', help='run an SQL query (the tables have a _dump column, see the _dumps table)')
+    query_parser.add_argument('pack', type=str, help='the directory of the log pack')
+    query_parser.add_argument('sql', type=str, help='the query')
+    args = parser.parse_args()
+
+    if args.command == 'load':
+        exit(1 if load(args.pack) else 0)
+    try:
+        if args.command == 'dumps':
+            db = MiddlewareDB(args.pack)
+            for dump_id, path, cluster, host in db.dumps():
+                tables, rows = db.db.execute('SELECT count(*), sum(rows) FROM _tables WHERE dump_id=?', (dump_id,)).fetchone()
+                print(f'{cluster}/{host}: {path} ({tables} tables, {rows} rows)')
+        elif args.command == 'diff':
+            diff(args.a, args.b, args.table)
+        else:
+            cursor = MiddlewareDB(args.pack).db.execute(args.sql)
+            print('\t'.join(column[0] for column in cursor.description or []))
+            for row in cursor:
+                print('\t'.join('' if value is None else str(value) for value in row))
+    except BrokenPipeError:
+        # eg. piped into head
+        sys.stderr.close()
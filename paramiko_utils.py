@@ -1,6 +1,13 @@
+import collections
+import contextlib
+import copy
 import io
 import paramiko
+import select
+import threading
+import time
 import warnings
+import weakref
 
 from cryptography.utils import CryptographyDeprecationWarning
 
@@ -10,31 +17,170 @@ warnings.filterwarnings(
     category=CryptographyDeprecationWarning
 )
 
+# Records how long the SSH operations take, so it can be told where the time went when a collection is slow.
+# Only the sums are kept (per kind and per host), so it can run for long without eating up the memory. Kinds:
+#  - channel: opening the direct-tcpip channel through the parent host (nested connections only)
+#  - handshake: ssh handshake + authentication
+#  - reuse: a connection was taken from the ConnectionPool instead of connecting again
+#  - exec: a command run by RemoteCommand (bytes is the size of stdout)
+#  - sftp: reading a key with sftp
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # kind -> stats, host -> kind -> stats
+        self._by_kind = {}
+        self._by_host = {}
+        # client -> the hostname it's connected to, so we know where a command ran
+        self._hostnames = weakref.WeakKeyDictionary()
+
+    def record(self, kind: str, host: str, seconds: float, size: int = 0, failed: bool = False, time_to_first_byte: float = None):
+        with self._lock:
+            for stats in (self._by_kind.setdefault(kind, {}), self._by_host.setdefault(str(host), {}).setdefault(kind, {})):
+                stats['count'] = stats.get('count', 0) + 1
+                stats['failed'] = stats.get('failed', 0) + int(failed)
+                stats['seconds'] = stats.get('seconds', 0) + seconds
+                stats['max_seconds'] = max(stats.get('max_seconds', 0), seconds)
+                stats['bytes'] = stats.get('bytes', 0) + size
+                if time_to_first_byte is not None:
+                    stats['time_to_first_byte'] = stats.get('time_to_first_byte', 0) + time_to_first_byte
+
+    @contextlib.contextmanager
+    def measure(self, kind: str, host: str):
+        start_time = time.monotonic()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.record(kind, host, time.monotonic() - start_time, failed=failed)
+
+    def setHostname(self, client: paramiko.SSHClient, hostname: str):
+        with self._lock:
+            self._hostnames[client] = hostname
+
+    def hostnameOf(self, client: paramiko.SSHClient) -> str:
+        with self._lock:
+            return self._hostnames.get(client)
+
+    # {'by_kind': {kind: stats}, 'by_host': {host: {kind: stats}}},
+    # where stats is {count, failed, seconds, max_seconds, bytes (, time_to_first_byte)}
+    def summary(self) -> dict:
+        with self._lock:
+            return copy.deepcopy({'by_kind': self._by_kind, 'by_host': self._by_host})
+
+# every connect/command of this module is recorded here
+metrics = Metrics()
+
+# Runs a command and streams its output while it's running. stdout and stderr are drained at the same time,
+# so a command writing a lot to stderr can't get stuck on the full stderr window while we wait for stdout.
+# The exit status, stderr and the timings are available once the output was consumed.
+# With timeout (seconds) a command which doesn't finish in time is closed and TimeoutError is raised,
+# the connection may be stuck then, so it's better to drop it (ConnectionPool.discard).
+#
+# usage:
+#   command = RemoteCommand(client, 'zstdcat /logs/nfs.log.*.zst')
+#   for line in command.lines():
+#       ...
+#   print(command.exit_status, command.duration, command.stderr)
+class RemoteCommand:
+    def __init__(self, client: paramiko.SSHClient, command: str, max_stderr_size: int = 1024 * 1024, timeout: float = None):
+        self.command = command
+        self.timeout = timeout
+        self.exit_status = None
+        self.stderr = ''
+        self.stdout_size = 0
+        self.start_time = time.monotonic()
+        # seconds until the first byte of stdout arrived and until the command finished
+        self.time_to_first_byte = None
+        self.duration = None
+        self._max_stderr_size = max_stderr_size
+        self._stderr = bytearray()
+        self._hostname = metrics.hostnameOf(client)
+        self._channel = client.get_transport().open_session()
+        self._channel.exec_command(command)
+        self._channel.shutdown_write()
+
+    # yields stdout in chunks (bytes) as they arrive
+    def chunks(self, chunk_size: int = 32768):
+        channel = self._channel
+        deadline = None if self.timeout is None else self.start_time + self.timeout
+        try:
+            while True:
+                if channel.recv_stderr_ready():
+                    self._add_stderr(channel.recv_stderr(chunk_size))
+                if channel.recv_ready():
+                    data = channel.recv(chunk_size)
+                    if self.time_to_first_byte is None:
+                        self.time_to_first_byte = time.monotonic() - self.start_time
+                    self.stdout_size += len(data)
+                    yield data
+                    continue
+                if (channel.eof_received or channel.closed) and not channel.recv_ready() and not channel.recv_stderr_ready():
+                    break
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError(f'[{self._hostname}] "{self.command}" did not finish in {self.timeout:.0f}s')
+                # the channel is readable if there's anything either on stdout or stderr
+                select.select([channel], [], [], 1)
+            self.exit_status = channel.recv_exit_status()
+        finally:
+            self.duration = time.monotonic() - self.start_time
+            self.stderr = self._stderr.decode('utf-8', errors='replace')
+            channel.close()
+            metrics.record('exec', self._hostname, self.duration, self.stdout_size, failed=self.exit_status is None,
+                           time_to_first_byte=self.time_to_first_byte)
+
+    # yields stdout line by line (without the newline) as they arrive
+    def lines(self):
+        buffer = b''
+        for chunk in self.chunks():
+            *lines, buffer = (buffer + chunk).split(b'\n')
+            for line in lines:
+                yield line.decode('utf-8', errors='replace')
+        if buffer:
+            yield buffer.decode('utf-8', errors='replace')
+
+    # waits for the command and returns the whole stdout
+    def output(self) -> str:
+        return b''.join(self.chunks()).decode('utf-8')
+
+    def _add_stderr(self, data: bytes):
+        # only the beginning is kept, so a command flooding stderr can't eat up the memory
+        self._stderr += data[:max(0, self._max_stderr_size - len(self._stderr))]
+
 def run(client: paramiko.SSHClient, command: str):
-    stdin, stdout, stderr = client.exec_command(command)
-    exit_status = stdout.channel.recv_exit_status()
-    output = stdout.read().decode('utf-8').strip()
-    error = stderr.read().decode('utf-8').strip()
+    output = RemoteCommand(client, command).output().strip()
     # print(f'run output of command: {command}\n' + output)
     return output
 
+# like run, but yields the lines of stdout as soon as they arrive,
+# so a big output is never held in memory and the caller can process it while the command is running
+def runLines(client: paramiko.SSHClient, command: str):
+    yield from RemoteCommand(client, command).lines()
+
 def rootConnect(hostname, username, password):
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(hostname, username=username, password=password, allow_agent=True, look_for_keys=True)
+    with metrics.measure('handshake', hostname):
+        client.connect(hostname, username=username, password=password, allow_agent=True, look_for_keys=True)
+    metrics.setHostname(client, hostname)
     return client
 
-def agentNestedConnectWithPassword(client, hostname, username, password, look_for_keys=True):
+# opens the direct-tcpip channel to hostname through client, which the nested connection goes through
+def openNestedSocket(client: paramiko.SSHClient, hostname: str):
     if client == None:
-        socket = None
-    else:
-        transport = client.get_transport()
-        socket = transport.open_channel("direct-tcpip", (hostname, 22), ("127.0.0.1", 0))
+        return None
+    with metrics.measure('channel', hostname):
+        return client.get_transport().open_channel("direct-tcpip", (hostname, 22), ("127.0.0.1", 0))
+
+def agentNestedConnectWithPassword(client, hostname, username, password, look_for_keys=True):
+    socket = openNestedSocket(client, hostname)
 
     client2 = paramiko.SSHClient()
     client2.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     print(f"hostname={hostname}, username={username}, pass={password}, look_for_keys={look_for_keys}")
-    client2.connect(hostname, username=username, password=password, sock=socket, allow_agent=False, look_for_keys=look_for_keys)
+    with metrics.measure('handshake', hostname):
+        client2.connect(hostname, username=username, password=password, sock=socket, allow_agent=False, look_for_keys=look_for_keys)
+    metrics.setHostname(client2, hostname)
     return client2
 
 def getKeyFromClient(client: paramiko.SSHClient, key_filepath: str):
@@ -42,8 +188,9 @@ def getKeyFromClient(client: paramiko.SSHClient, key_filepath: str):
         with open(key_filepath, "r") as local_key_file:
             key_string = local_key_file.read()
     else:
-        with client.open_sftp() as sftp, sftp.open(key_filepath, "r") as remote_key_file:
-            key_string = remote_key_file.read().decode('utf-8')
+        with metrics.measure('sftp', metrics.hostnameOf(client)):
+            with client.open_sftp() as sftp, sftp.open(key_filepath, "r") as remote_key_file:
+                key_string = remote_key_file.read().decode('utf-8')
 
     key_stream = io.StringIO(key_string)
     for cls in (paramiko.RSAKey, paramiko.ECDSAKey, paramiko.Ed25519Key):
@@ -56,13 +203,167 @@ def getKeyFromClient(client: paramiko.SSHClient, key_filepath: str):
     return None
 
 def nestedConnectWithKeyFromClient(client: paramiko.SSHClient, hostname: str, username: str, key):
-    if client == None:
-        socket = None
-    else:
-        transport = client.get_transport()
-        socket = transport.open_channel("direct-tcpip", (hostname, 22), ("127.0.0.1", 0))
+    socket = openNestedSocket(client, hostname)
 
     client2 = paramiko.SSHClient()
     client2.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client2.connect(hostname, username=username, sock=socket, pkey=key, allow_agent=True, look_for_keys=False)
+    with metrics.measure('handshake', hostname):
+        client2.connect(hostname, username=username, sock=socket, pkey=key, allow_agent=True, look_for_keys=False)
+    metrics.setHostname(client2, hostname)
     return client2
+
+# Keeps the SSH connections (including the nested ones) open, so they can be reused
+# instead of doing a new handshake + auth every time we need to talk to the same host.
+# A connection is identified by its jump chain: ((host1, user1), (host2, user2), ...),
+# where the last element is the host itself and the ones before are the hosts we jumped through.
+# Connections are shared: many threads can borrow the same one at the same time
+# (every exec/scp/nested connection is just a new channel on the transport).
+#
+# usage:
+#   with ConnectionPool() as pool:
+#       with pool.connectWithPassword(None, 'fm1', 'ir', pw) as client_fm:
+#           key = pool.getKey(client_fm, '/home/ir/.ssh/id_rsa')
+#           with pool.connectWithKey(client_fm, 'ir1', 'ir', key) as client_blade:
+#               run(client_blade, 'ls /logs')
+class ConnectionPool:
+    def __init__(self, max_size: int = 64, idle_timeout: float = 300, keepalive: int = 30):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self._lock = threading.Lock()
+        # chain -> [client, number of borrowers, last time it was released]
+        self._entries = collections.OrderedDict()
+        # id(client) -> chain, to find out the chain of the parent client
+        self._chains = {}
+        # (chain of the client it was read through, key_filepath) -> parsed key
+        self._keys = {}
+        self._key_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _chain(self, parent: paramiko.SSHClient, hostname: str, username: str) -> tuple:
+        if parent == None:
+            return ((hostname, username),)
+        with self._lock:
+            parent_chain = self._chains.get(id(parent))
+        assert parent_chain, 'parent client is not from this pool'
+        return parent_chain + ((hostname, username),)
+
+    @contextlib.contextmanager
+    def _borrow(self, chain: tuple, connect):
+        client = self._acquire(chain, connect)
+        try:
+            yield client
+        finally:
+            with self._lock:
+                entry = self._entries.get(chain)
+                if entry and entry[0] is client:
+                    entry[1] -= 1
+                    entry[2] = time.monotonic()
+                self._evict()
+
+    def _acquire(self, chain: tuple, connect) -> paramiko.SSHClient:
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(chain)
+            if entry and isAlive(entry[0]):
+                entry[1] += 1
+                self._entries.move_to_end(chain)
+                metrics.record('reuse', chain[-1][0], 0)
+                return entry[0]
+            if entry:
+                # the connection died (eg. the remote restarted), dropping it with everything nested in it
+                self._close_chain(chain)
+
+        # connecting outside of the lock, so different hosts can do the handshake in parallel
+        client = connect()
+        client.get_transport().set_keepalive(self.keepalive)
+        with self._lock:
+            entry = self._entries.get(chain)
+            if entry and isAlive(entry[0]):
+                # another thread was faster, using its connection
+                client.close()
+                entry[1] += 1
+                return entry[0]
+            self._entries[chain] = [client, 1, time.monotonic()]
+            self._chains[id(client)] = chain
+            return client
+
+    # must be called with self._lock held
+    def _evict(self):
+        now = time.monotonic()
+        for chain, (client, borrowers, last_used) in list(self._entries.items()):
+            if chain in self._entries and borrowers == 0 and not self._has_borrowed_child(chain):
+                if now - last_used > self.idle_timeout or not isAlive(client):
+                    self._close_chain(chain)
+        # least recently used connections are at the beginning
+        for chain in list(self._entries):
+            if len(self._entries) < self.max_size:
+                break
+            if chain in self._entries and self._entries[chain][1] == 0 and not self._has_borrowed_child(chain):
+                self._close_chain(chain)
+
+    def _has_borrowed_child(self, chain: tuple) -> bool:
+        return any(c[:len(chain)] == chain and c != chain and e[1] > 0 for c, e in self._entries.items())
+
+    # closes the connection and every connection which was nested into it (children first),
+    # must be called with self._lock held
+    def _close_chain(self, chain: tuple):
+        for c in sorted([c for c in self._entries if c[:len(chain)] == chain], key=len, reverse=True):
+            client = self._entries.pop(c)[0]
+            self._chains.pop(id(client), None)
+            self._keys = {k: v for k, v in self._keys.items() if k[0] != c}
+            client.close()
+
+    def connectWithPassword(self, parent: paramiko.SSHClient, hostname: str, username: str, password: str, look_for_keys=True):
+        chain = self._chain(parent, hostname, username)
+        return self._borrow(chain, lambda: agentNestedConnectWithPassword(parent, hostname, username, password, look_for_keys=look_for_keys))
+
+    def connectWithKey(self, parent: paramiko.SSHClient, hostname: str, username: str, key):
+        chain = self._chain(parent, hostname, username)
+        return self._borrow(chain, lambda: nestedConnectWithKeyFromClient(parent, hostname, username, key))
+
+    # makes room for n more connections (eg. for the hosts of a cluster which is planned to be used)
+    def reserve(self, n: int):
+        with self._lock:
+            self.max_size += n
+
+    # closes the connection (and the ones nested into it) even if it's borrowed, eg. when a command got stuck on it,
+    # the next borrow connects again
+    def discard(self, client: paramiko.SSHClient):
+        with self._lock:
+            chain = self._chains.get(id(client))
+            if chain and chain in self._entries and self._entries[chain][0] is client:
+                self._close_chain(chain)
+
+    # same as getKeyFromClient, but reads and parses the key only once per client
+    def getKey(self, client: paramiko.SSHClient, key_filepath: str):
+        cache_key = (self._chain_of(client), key_filepath)
+        # if more threads need the key at the same time, only the first one reads it, the others wait for it
+        with self._key_lock:
+            with self._lock:
+                if cache_key in self._keys:
+                    return self._keys[cache_key]
+            key = getKeyFromClient(client, key_filepath)
+            with self._lock:
+                self._keys[cache_key] = key
+            return key
+
+    def _chain_of(self, client: paramiko.SSHClient):
+        if client == None:
+            return None
+        with self._lock:
+            return self._chains.get(id(client))
+
+    def close(self):
+        with self._lock:
+            for chain in [c for c in self._entries if len(c) == 1]:
+                self._close_chain(chain)
+
+def isAlive(client: paramiko.SSHClient) -> bool:
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
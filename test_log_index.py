@@ -0,0 +1,33 @@
+# tests of log_index.py, run with: python -m pytest test_log_index.py
+import subprocess
+
+import pytest
+
+import log_index
+
+LINES = [f'2024-01-30T17:05:{second:02d}.000000+00:00 INFO nfs::server line {second}\n'.encode() for second in range(10)]
+
+# the same log as a plain file (seekable) and as .zst (read from the zstd pipe, not seekable)
+@pytest.fixture(params=['plain', 'zst'])
+def logfile(request, tmp_path):
+    filepath = tmp_path / 'nfs.log'
+    filepath.write_bytes(b''.join(LINES))
+    if request.param == 'zst':
+        subprocess.run(['zstd', '-q', '--rm', str(filepath)], check=True)
+        filepath = tmp_path / 'nfs.log.zst'
+    return str(filepath)
+
+def test_read_ranges(logfile):
+    start = sum(len(line) for line in LINES[:2])
+    end = sum(len(line) for line in LINES[:4])
+    assert list(log_index.read_ranges(logfile, [(start, end)])) == LINES[2:4]
+
+def test_read_ranges_past_eof(logfile):
+    size = sum(len(line) for line in LINES)
+    ranges = [(0, len(LINES[0])), (size + 100, size + 200)]
+    assert list(log_index.read_ranges(logfile, ranges)) == LINES[:1]
+
+def test_read_ranges_over_eof(logfile):
+    start = sum(len(line) for line in LINES[:8])
+    size = sum(len(line) for line in LINES)
+    assert list(log_index.read_ranges(logfile, [(start, size + 100)])) == LINES[8:]
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# Brings up a testbed like run-ir-test.sh does, but faster:
+#  - the steps of the different clusters run at the same time (on threads), only the steps needing
+#    more clusters (array connection, certificate exchange) wait for each other
+#  - one pooled ssh connection per cluster (paramiko_utils.ConnectionPool) instead of an sshpass ssh per command,
+#    the commands of a step are sent in one session (eg. all the fbdiag calls of --nfs-debug-log)
+#  - instead of the fixed sleeps it polls until the cluster is ready (MW answers, the VIP is in purenetwork list)
+# and prints how long each step took on each cluster at the end.
+#
+# The local tools (simctl, deploy_env.py, restart_sw.py) are run with ./run, so it has to be started
+# from the root of the source tree, just like run-ir-test.sh. Tree deploy, realm connection and running
+# the tests are still done by run-ir-test.sh.
+#
+# usage:
+#   testbed.py --clusters=irp871-c01,irp871-c02 -i --sha=<sha> -a -r -c -e -f
+import argparse
+import concurrent.futures
+import contextlib
+import ipaddress
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+import paramiko_utils
+
+USERNAME = 'ir'
+PASSWORD = 'welcome'
+VIMRC_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vimrc-for-clusters')
+LOCAL_SIM_ADDRESS = '10.255.8.20'
+
+NFS_LOG_SERVICES = [
+    'replication::replica_link_manager',
+    'replication::replication_transport_svc',
+    'replication::realm_connection_manager',
+    'replication::realm_connection_manager_internal',
+    'replication.client',
+]
+
+FEATURE_FLAGS = [
+    'PS_FEATURE_FLAG_MULTITENANCY_REPLICATION',
+    'PS_FEATURE_FLAG_REALM_CONNECTION',
+    'PS_FEATURE_FLAG_MULTITENANCY_OBJECT_REALMS_AND_SERVERS',
+    'PS_FEATURE_FLAG_ETCD_TO_S3_MT2',
+]
+
+APPLIANCE_ID_TEMPLATE = '00000000-0000-4000-8000-00000000000{}'
+
+# how long a remote command may run (seconds), after that the connection is dropped and the command fails,
+# the checks of wait_until get less, so a stuck check is retried on a new connection
+COMMAND_TIMEOUT = 600
+CHECK_TIMEOUT = 60
+
+pool = paramiko_utils.ConnectionPool()
+
+# the timings of the steps, printed at the end by report()
+class Steps:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start_time = time.monotonic()
+        # [cluster, step, started at (seconds from the start), seconds, status]
+        self.timings = []
+
+    @contextlib.contextmanager
+    def step(self, cluster: str, name: str):
+        print(f'[{cluster}] ---> {name} <---')
+        start = time.monotonic()
+        status = 'failed'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            seconds = time.monotonic() - start
+            print(f'[{cluster}] ---> {name}: {status} in {seconds:.1f}s <---')
+            with self._lock:
+                self.timings.append([cluster, name, start - self.start_time, seconds, status])
+
+    def report(self):
+        print(f'\n{"cluster":<16} {"step":<24} {"start":>8} {"took":>8}  status')
+        for cluster, name, started, seconds, status in sorted(self.timings, key=lambda t: t[2]):
+            print(f'{cluster:<16} {name:<24} {started:>7.1f}s {seconds:>7.1f}s  {status}')
+        total_per_cluster = {}
+        for cluster, name, started, seconds, status in self.timings:
+            total_per_cluster[cluster] = total_per_cluster.get(cluster, 0) + seconds
+        serial = sum(total_per_cluster.values())
+        print(f'\nwall time: {time.monotonic() - self.start_time:.1f}s (the steps one after the other would take {serial:.1f}s)')
+
+steps = Steps()
+
+def connect(cluster: str):
+    return pool.connectWithPassword(None, cluster, username=USERNAME, password=PASSWORD, look_for_keys=False)
+
+# runs the command on the cluster, returns its stdout, raises if it fails or doesn't finish in timeout seconds
+def run_checked(cluster: str, command: str, timeout: float = COMMAND_TIMEOUT) -> str:
+    with connect(cluster) as client:
+        remote_command = paramiko_utils.RemoteCommand(client, command, timeout=timeout)
+        try:
+            output = remote_command.output()
+        except TimeoutError:
+            # the connection may be stuck too, the next command connects again
+            pool.discard(client)
+            raise
+    if remote_command.exit_status != 0:
+        raise Exception(f'[{cluster}] "{command}" failed with exit status {remote_command.exit_status}: {remote_command.stderr.strip()}')
+    return output.strip()
+
+# runs a local tool (eg. ./run tools/remote/restart_sw.py), its output is prefixed with the cluster
+def run_local(cluster: str, args: list[str]):
+    print(f'[{cluster}] running: {shlex.join(args)}')
+    with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace') as process:
+        for line in process.stdout:
+            print(f'[{cluster}] {line.rstrip()}')
+    if process.returncode != 0:
+        raise Exception(f'[{cluster}] {shlex.join(args)} failed with exit status {process.returncode}')
+
+# calls check until it returns something true, exceptions (eg. the cluster is restarting) count as not ready yet
+def wait_until(cluster: str, what: str, check, timeout: float, interval: float = 2):
+    start = time.monotonic()
+    last_error = None
+    while True:
+        try:
+            result = check()
+            if result:
+                print(f'[{cluster}] {what} after {time.monotonic() - start:.1f}s')
+                return result
+        except Exception as e:
+            last_error = e
+        if time.monotonic() - start > timeout:
+            raise Exception(f'[{cluster}] timed out after {timeout:.0f}s waiting for: {what} (last error: {last_error})')
+        time.sleep(interval)
+
+def wait_for_middleware(cluster: str, timeout: float):
+    # the pure* commands go through MW, so they succeed only when it's up
+    wait_until(cluster, 'MW is up', lambda: run_checked(cluster, 'purearray list --notitle', CHECK_TIMEOUT) is not None, timeout)
+
+# the lines of purenetwork list with the service
+def vips_of(cluster: str, service: str) -> list[str]:
+    return [line for line in run_checked(cluster, 'purenetwork list', CHECK_TIMEOUT).splitlines() if service in line]
+
+def wait_for_vip(cluster: str, service: str, timeout: float):
+    for line in wait_until(cluster, f'{service} VIP present in purenetwork list', lambda: vips_of(cluster, service), timeout):
+        print(f'[{cluster}] {line}')
+
+def bootstrap(cluster: str, sha: str):
+    run_local(cluster, ['./run', './tools/python/simctl', 'sim', '-a', cluster, '--skip-easim-check', 'clean', 'start', '--blades', '3', '--sha', sha])
+
+def spread_vimrc(cluster: str):
+    with connect(cluster) as client:
+        with client.open_sftp() as sftp:
+            sftp.put(VIMRC_FILEPATH, '.vimrc')
+    run_checked(cluster, 'exec.py -na -sa "scp sup:/home/ir/.vimrc ~"')
+
+def switch_version(cluster: str, debug: bool):
+    run_local(cluster, ['./run', 'tools/remote/deploy_env.py', '-a', cluster, '-xa', '-sa', '-na', '--debug-sw' if debug else '--defaults'])
+
+def restart(cluster: str, timeout: float):
+    run_local(cluster, ['./run', 'tools/remote/restart_sw.py', '--wait', '-sa', '-na', 'restart', '-a', cluster])
+    wait_for_middleware(cluster, timeout)
+
+def enable_nfs_debug_log(cluster: str):
+    fbdiag_commands = ' && '.join(f"fbdiag nfs-diag-level '{service}=debug' -v" for service in NFS_LOG_SERVICES)
+    run_checked(cluster, f'exec.py -na "{fbdiag_commands}"')
+
+def update_appliance_id(cluster: str, appliance_id: str, timeout: float):
+    print(f'[{cluster}] updating appliance_id to [{appliance_id}]')
+    # it fails with "EtcdError: KV client is not ready" for a while after a restart, retrying until etcd is ready
+    put_command = f"sudo /opt/ir/admin/internal/array_config.py put appliance_id '\"{appliance_id}\"'"
+    wait_until(cluster, 'appliance_id is updated', lambda: run_checked(cluster, put_command, CHECK_TIMEOUT) is not None, timeout)
+    run_checked(cluster, 'sudo fbservice stop middleware && sudo fbservice start middleware')
+    wait_for_middleware(cluster, timeout)
+
+def create_replication_vip(cluster: str, timeout: float):
+    run_local(cluster, ['./run', './tools/python/simctl', 'sim', '--skip-easim-check', '--admin-vip', cluster, 'create-repl-vip'])
+    wait_for_vip(cluster, 'replication', timeout)
+
+def create_data_vip(cluster: str, timeout: float):
+    if vips_of(cluster, 'data'):
+        print(f'[{cluster}] datavip already exists')
+        return
+    addresses = run_checked(cluster, 'purenetwork list --csv --notitle | cut -d "," -f5').split()
+    highest_ip = max(ipaddress.ip_address(address) for address in addresses if ':' not in address)
+    data_vip = highest_ip + 1
+    print(f'[{cluster}] creating datavip: {data_vip}')
+    run_checked(cluster, f'purenetwork vip create --address {data_vip} --servicelist data datavip')
+    wait_for_vip(cluster, 'data', timeout)
+
+def connect_arrays(source_cluster: str, target_cluster: str):
+    print(f'SOURCE_CLUSTER = [{source_cluster}], TARGET_CLUSTER = [{target_cluster}]')
+    # separate commands (on the same pooled connection), so the exit status of purearray/purenetwork is checked,
+    # not only the one of the last command of a pipeline
+    key_lines = run_checked(target_cluster, 'purearray create --connection-key').splitlines()
+    connection_key = key_lines[-1].strip() if key_lines else ''
+    mgmt_ips = [line.split(',')[4].strip() for line in run_checked(target_cluster, 'purenetwork list --service management --csv').splitlines()
+                if 'vir0' in line and len(line.split(',')) > 4]
+    mgmt_ip = mgmt_ips[0] if mgmt_ips else ''
+    if not connection_key or not mgmt_ip:
+        raise Exception(f'[{source_cluster} -> {target_cluster}] could not get the connection key ([{connection_key}]) '
+                        f'or the management VIP ([{mgmt_ip}]) of {target_cluster}')
+    print(f'MGMT_IP=[{mgmt_ip}], CONNECTION_KEY=[{connection_key[:34]}...]')
+    run_checked(source_cluster, f'echo {shlex.quote(connection_key)} | purearray connect --management-address {mgmt_ip}')
+
+def download_certificate(cluster: str) -> str:
+    return run_checked(cluster, 'purecert list --certificate global --notitle | cut -c9-')
+
+# uploads the global certificate of source_cluster to target_cluster (if it's not there yet)
+def upload_certificate(source_cluster: str, target_cluster: str, certificate: str):
+    name = f'global-{source_cluster}'
+    if name in run_checked(target_cluster, 'purecert list'):
+        print(f'[{target_cluster}] {name}.crt already exists, skipping...')
+        return
+    with connect(target_cluster) as client:
+        with client.open_sftp() as sftp:
+            with sftp.open(f'{name}.crt', 'w') as f:
+                f.write(certificate + '\n')
+    run_checked(target_cluster, f'cat {name}.crt | purecert create --ca-certificate {name} && purecert add --group _default_replication_certs {name}')
+
+def set_feature_flags(cluster: str, reset_only: bool, timeout: float):
+    command = 'sudo purefeatureflags reset-all'
+    if not reset_only:
+        command += f' && sudo purefeatureflags enable --flags {",".join(FEATURE_FLAGS)}'
+    run_checked(cluster, f'exec.py -na -sa "{command}"')
+    restart(cluster, timeout)
+
+def clean_logs(cluster: str):
+    run_checked(cluster, 'exec.py -na -sa "sudo rm -rf /logs/*"')
+
+# the steps which need only this cluster, in the order of run-ir-test.sh
+def prepare_cluster(args, cluster: str, cluster_num: int):
+    if args.i:
+        with steps.step(cluster, 'bootstrap'):
+            bootstrap(cluster, args.sha)
+        with steps.step(cluster, 'vimrc'):
+            spread_vimrc(cluster)
+    if args.debug or args.release:
+        with steps.step(cluster, 'switch version'):
+            switch_version(cluster, args.debug)
+        with steps.step(cluster, 'restart'):
+            restart(cluster, args.timeout)
+    if args.nfs_debug_log:
+        with steps.step(cluster, 'nfs debug log'):
+            enable_nfs_debug_log(cluster)
+    if args.a:
+        with steps.step(cluster, 'appliance_id'):
+            update_appliance_id(cluster, APPLIANCE_ID_TEMPLATE.format(0 if args.revert_appliance_ids else cluster_num), args.timeout)
+    if args.r:
+        with steps.step(cluster, 'replication vip'):
+            create_replication_vip(cluster, args.timeout)
+    if args.create_datavip:
+        with steps.step(cluster, 'data vip'):
+            create_data_vip(cluster, args.timeout)
+
+# the steps after the array connection and certificate exchange
+def finish_cluster(args, cluster: str):
+    if args.f or args.reset_feature_flags:
+        with steps.step(cluster, 'feature flags'):
+            set_feature_flags(cluster, args.reset_feature_flags, args.timeout)
+    if args.l:
+        with steps.step(cluster, 'clean logs'):
+            clean_logs(cluster)
+
+# runs the function for every cluster at the same time, returns False if it failed on any of them
+def for_each_cluster(clusters: list[str], function) -> bool:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(clusters)) as executor:
+        futures = {executor.submit(function, cluster): cluster for cluster in clusters}
+        ok = True
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception():
+                print(f'Error: [{futures[future]}] {future.exception()}')
+                ok = False
+    return ok
+
+def exchange_certificates(clusters: list[str]):
+    certificates = {}
+    def download(cluster):
+        with steps.step(cluster, 'download certificate'):
+            certificates[cluster] = download_certificate(cluster)
+    if not for_each_cluster(clusters, download):
+        return False
+    # uploading the certificate of each cluster to the other one
+    def upload(target_cluster):
+        source_cluster = clusters[(clusters.index(target_cluster) + 1) % 2]
+        with steps.step(target_cluster, 'upload certificate'):
+            upload_certificate(source_cluster, target_cluster, certificates[source_cluster])
+    return for_each_cluster(clusters, upload)
+
+def main(args) -> bool:
+    clusters = args.clusters.split(',')
+    if clusters in (['devvm'], ['local_sim']):
+        clusters = [LOCAL_SIM_ADDRESS]
+    print(f'Used clusters: {" ".join(f"[{cluster}]" for cluster in clusters)}')
+
+    if not for_each_cluster(clusters, lambda cluster: prepare_cluster(args, cluster, clusters.index(cluster))):
+        return False
+    if args.c:
+        source_cluster, target_cluster = (clusters[1], clusters[0]) if args.reverse_connect else (clusters[0], clusters[1])
+        with steps.step(source_cluster, 'connect arrays'):
+            connect_arrays(source_cluster, target_cluster)
+    if args.e and not exchange_certificates(clusters[:2]):
+        return False
+    return for_each_cluster(clusters, lambda cluster: finish_cluster(args, cluster))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                        prog='testbed.py',
+                        description='Brings up a testbed (the setup steps of run-ir-test.sh), the clusters are set up in parallel',
+                        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--clusters', type=str, required=True, help='comma separated list of clusters to use\nNote: some actions assume 2 clusters (eg. certificate exchange)')
+    parser.add_argument('-i', action='store_true', default=False, help='initiates (bootstraps) cluster (clean & start) and spreads the .vimrc')
+    parser.add_argument('--sha', type=str, help='sha of the commit to bootstrap to clusters (full sha needed)')
+    parser.add_argument('--branch', type=str, default='HEAD', help='the branch where the latest available sha shall be used\nif both --sha and --branch is specified, --sha is going to be used')
+    parser.add_argument('--debug', action='store_true', default=False, help='use debug version (need to specify only once when switching)')
+    parser.add_argument('--release', action='store_true', default=False, help='use release version (need to specify only once when switching)')
+    parser.add_argument('--nfs-debug-log', action='store_true', default=False, help=f'turns on nfs debug logs of these services: {" ".join(NFS_LOG_SERVICES)}')
+    parser.add_argument('-a', action='store_true', default=False, help=f'update appliance_id\nchange to {APPLIANCE_ID_TEMPLATE.format("X")}, where X = 0,1,2,...')
+    parser.add_argument('--revert-appliance-ids', action='store_true', default=False, help=f'revert them back to {APPLIANCE_ID_TEMPLATE.format(0)} (use together with -a)')
+    parser.add_argument('-r', action='store_true', default=False, help='create replication vip on all clusters')
+    parser.add_argument('--create-datavip', action='store_true', default=False, help='creates datavip on all clusters')
+    parser.add_argument('-c', action='store_true', default=False, help='create array connection between arrays')
+    parser.add_argument('--reverse-connect', action='store_true', default=False, help='when used with -c, second cluster is going to be the source array\nand first one is going to be the target array')
+    parser.add_argument('-e', action='store_true', default=False, help='exchange certificates')
+    parser.add_argument('-f', action='store_true', default=False, help='turning on feature flags on clusters')
+    parser.add_argument('--reset-feature-flags', action='store_true', default=False, help='disable every extra feature flags, reset system to the base state')
+    parser.add_argument('-l', action='store_true', default=False, help='clean logs (on FMs & blades: /logs/*)')
+    parser.add_argument('--timeout', type=float, default=600, help='how long to wait for a cluster to get ready (MW up, VIP present) in seconds (default: 600)')
+    args = parser.parse_args()
+
+    if args.debug and args.release:
+        parser.error("Please specify either '--debug' or '--release' but not both!")
+    if (args.c or args.e) and len(args.clusters.split(',')) < 2:
+        parser.error('-c and -e need 2 clusters')
+    if args.i and not args.sha:
+        args.sha = subprocess.run(['artifactory_search.sh', '-l', '-b', args.branch, '-c', '30'], stdout=subprocess.PIPE, text=True, check=True).stdout.strip()
+        print(f'artifactory_search.sh returned SHA=[{args.sha}] for BRANCH=[{args.branch}]')
+
+    try:
+        ok = main(args)
+    finally:
+        pool.close()
+        steps.report()
+    exit(0 if ok else 1)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# Merges every log of one or more log packs (made by collect.py or collect-fuse.py) into one timeline,
+# ordered by the timestamps of the lines, every line is tagged with <cluster>/<host>/<file>.
+#
+# The rotated files of a log of a host (eg. nfs.log.2024-01-30.16-00-00.zst, ..., nfs.log) are read one after
+# the other as one stream, and the streams are merged with a heap, so only one line per stream is in the memory,
+# no matter how big the pack is. .zst files are decompressed on the fly. Lines without timestamp
+# (eg. the rest of a multiline message) stay together with the line before them.
+# If the pack is indexed (see log_index.py), the files outside of the time window are not even opened,
+# and the reading starts at the first minute of the window.
+#
+# usage:
+#   timeline.py irp871-c01_2024-01-30-T17-00-37 --since '2024-01-30 17:05' --until '2024-01-30 17:10' --host 'ir[12]$|sup' --service 'replication'
+import argparse
+import collections
+import heapq
+import os
+import re
+import shlex
+import subprocess
+import sys
+
+import collect_utils
+import log_index
+
+# the logfiles of one log of one host (ordered by time)
+Series = collections.namedtuple('Series', ['pack_dir', 'cluster', 'host', 'logname', 'relpaths'])
+
+# the rotated files are ordered by the date in their name, the current logfile (without date) is the last one
+def rotation_order(relpath: str) -> tuple:
+    filename = os.path.basename(relpath)
+    if filename.endswith('.zst'):
+        filename = filename[:-len('.zst')]
+    return (not re.search(r'\.log\..', filename), filename)
+
+def find_series(pack_dir: str, host_re: str = None, lognames: list[str] = None) -> list[Series]:
+    relpaths_by_log = collections.defaultdict(list)
+    for root, dirs, files in os.walk(pack_dir):
+        for filename in files:
+            if not log_index.LOGFILE_RE.search(filename):
+                continue
+            relpath = os.path.relpath(os.path.join(root, filename), pack_dir)
+            cluster, host = collect_utils.parse_pack_path(pack_dir, relpath)
+            logname = re.sub(r'\.log\..*$', '.log', filename)
+            if host_re and not re.search(host_re, f'{cluster}/{host}'):
+                continue
+            if lognames and logname not in lognames:
+                continue
+            relpaths_by_log[(cluster, host, logname)].append(relpath)
+    return [Series(pack_dir, *key, sorted(relpaths, key=rotation_order)) for key, relpaths in sorted(relpaths_by_log.items())]
+
+# yields (timestamp, lines) for every line with a timestamp, lines are the line and the lines without timestamp after it
+def records(lines):
+    timestamp = ''
+    record = []
+    for line in lines:
+        if log_index.TIMESTAMP_RE.match(line):
+            if record:
+                yield timestamp, record
+            timestamp = line[:23].decode(errors='replace').replace('T', ' ', 1)
+            record = [line]
+        else:
+            record.append(line)
+    if record:
+        yield timestamp, record
+
+# the lines of the file which can be in the time window (all of them if there's no index)
+def read_file(pack_dir: str, relpath: str, since: str, until: str, index: log_index.LogIndex):
+    filepath = os.path.join(pack_dir, relpath)
+    indexed = index.file(relpath) if index else None
+    if not indexed or indexed[1] is None:
+        with collect_utils.open_log(filepath) as f:
+            yield from f
+        return
+    file_id, first_time, last_time = indexed
+    if (since and last_time < since) or (until and first_time > until):
+        return
+    yield from log_index.read_ranges(filepath, index.ranges(file_id, since or first_time, until or last_time))
+
+# yields (timestamp, tag, lines) of one series, in the time window, of the services matching service_re
+def read_series(series: Series, since: str, until: str, service_re: str, index: log_index.LogIndex):
+    for relpath in series.relpaths:
+        tag = f'{series.cluster}/{series.host}/{os.path.basename(relpath)}'
+        for timestamp, lines in records(read_file(series.pack_dir, relpath, since, until, index)):
+            if since and timestamp < since:
+                continue
+            # the lines are in time order, nothing comes from this log after until
+            if until and timestamp[:len(until)] > until:
+                return
+            if service_re and not re.search(service_re, log_index.service_of(lines[0]) or ''):
+                continue
+            yield timestamp, tag, lines
+
+def timeline(packs: list[str], since: str = None, until: str = None, host_re: str = None, service_re: str = None, lognames: list[str] = None):
+    streams = []
+    for pack_dir in packs:
+        index = log_index.LogIndex(pack_dir) if os.path.exists(os.path.join(pack_dir, log_index.INDEX_FILENAME)) else None
+        for series in find_series(pack_dir, host_re, lognames):
+            streams.append(read_series(series, since, until, service_re, index))
+    # heapq.merge keeps only the next record of every stream
+    return heapq.merge(*streams, key=lambda record: record[0])
+
+def open_output(output: str):
+    if output:
+        return open(output, 'w'), None
+    if not sys.stdout.isatty():
+        return sys.stdout, None
+    pager = subprocess.Popen(shlex.split(os.environ.get('PAGER', 'less -S')), stdin=subprocess.PIPE, text=True, errors='replace')
+    return pager.stdin, pager
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                        prog='timeline.py',
+                        description='Merges the logs of log packs into one timeline',
+                        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('packs', type=str, nargs='+', help='log pack directories (made by collect.py or collect-fuse.py)')
+    parser.add_argument('--since', type=str, help='only the lines after this time (format: "YYYY-MM-DD HH:MM[:SS]")')
+    parser.add_argument('--until', type=str, help='only the lines before this time (format: "YYYY-MM-DD HH:MM[:SS]")')
+    parser.add_argument('--host', type=str, help='only the hosts matching this regex (matched against <cluster>/<host>, ex. "c01/ir[12]$|sup")')
+    parser.add_argument('--service', type=str, help='only the lines of the services matching this regex (ex. "replication")')
+    parser.add_argument('--log', type=str, help='only these logs (separated by comma, ex. "nfs.log,middleware.log")')
+    parser.add_argument('-o', '--output', type=str, help='write the timeline into this file (by default it goes to the pager, or to stdout if it is not a terminal)')
+    args = parser.parse_args()
+
+    since = collect_utils.parse_time(args.since).strftime('%Y-%m-%d %H:%M:%S') if args.since else None
+    until = collect_utils.parse_time(args.until).strftime('%Y-%m-%d %H:%M:%S') if args.until else None
+    lognames = args.log.split(',') if args.log else None
+
+    out, pager = open_output(args.output)
+    try:
+        for timestamp, tag, lines in timeline(args.packs, since, until, args.host, args.service, lognames):
+            for line in lines:
+                out.write(f'{tag}: {line.decode("utf-8", errors="replace").rstrip()}\n')
+    except BrokenPipeError:
+        # the pager was closed or the output was piped into head
+        pass
+    finally:
+        try:
+            out.close()
+        except BrokenPipeError:
+            pass
+        if pager:
+            pager.wait()